@@ -1,7 +1,14 @@
 from django.contrib import admin
-from .models import UserProfile
+from .models import OutboxEmail, UserProfile
 
 @admin.register(UserProfile)
 class UserProfileAdmin(admin.ModelAdmin):
     list_display = ("user", "phone")
     search_fields = ("user__username", "phone")
+
+@admin.register(OutboxEmail)
+class OutboxEmailAdmin(admin.ModelAdmin):
+    list_display = ("subject", "status", "attempts", "next_attempt_at", "sent_at", "created_at")
+    list_filter = ("status",)
+    search_fields = ("subject", "to")
+    readonly_fields = ("created_at", "updated_at", "sent_at", "last_error")
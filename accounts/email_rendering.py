@@ -0,0 +1,97 @@
+"""Email rendering.
+
+Every email has an HTML template and a plain-text template side by side
+(emails/<name>.html and emails/<name>.txt), both compiled once and kept by the
+cached template loader. The text part is rendered from its own template instead
+of running strip_tags() over the HTML for each message; an email without a .txt
+template falls back to stripping its HTML.
+
+render_many() can render a large batch in a pool of forked worker processes.
+The pool is opt-in (processes > 1) and only for management commands and
+background workers: forking a threaded WSGI worker can deadlock, so request
+code renders in-process. Contexts sent to the pool must not need the database
+(prefetch related objects such as order items first).
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+
+from django.conf import settings
+from django.db import connections
+from django.template import TemplateDoesNotExist
+from django.template.loader import get_template
+from django.utils.html import strip_tags
+
+# Batches smaller than this are rendered in-process; a pool costs more to start
+EMAIL_RENDER_POOL_MIN = 200
+
+
+def get_email_templates(name):
+    """(html_template, text_template or None) for emails/<name>
+
+    The cached template loader keeps both compiled (and remembers a missing
+    .txt), so this is a dictionary lookup after the first call.
+    """
+    html_template = get_template(f'emails/{name}.html')
+    try:
+        text_template = get_template(f'emails/{name}.txt')
+    except TemplateDoesNotExist:
+        text_template = None
+    return html_template, text_template
+
+
+def render_email_parts(name, context):
+    """Render emails/<name> with context; returns (text, html)"""
+    html_template, text_template = get_email_templates(name)
+    html = html_template.render(context)
+    text = text_template.render(context) if text_template else strip_tags(html)
+    return text, html
+
+
+def render_processes():
+    """Pool size for commands and workers that opt into a render pool"""
+    return getattr(settings, 'EMAIL_RENDER_PROCESSES', None) or os.cpu_count() or 1
+
+
+_inherited_connections = []
+
+
+def _init_render_worker():
+    # The forked worker must not reuse (or close) the parent's database
+    # sockets; keep them referenced so they are never closed from here.
+    for conn in connections.all(initialized_only=True):
+        _inherited_connections.append(conn.connection)
+        conn.connection = None
+
+
+def _render_chunk(name, contexts):
+    return [render_email_parts(name, context) for context in contexts]
+
+
+def render_many(name, contexts, processes=1):
+    """Render emails/<name> for each context; returns a list of (text, html)
+
+    Renders in-process by default. Outside a request (e.g. processes=render_processes()
+    from a management command), batches of at least EMAIL_RENDER_POOL_MIN
+    contexts are split across that many forked workers.
+    """
+    contexts = list(contexts)
+    if (
+        processes < 2
+        or len(contexts) < EMAIL_RENDER_POOL_MIN
+        or 'fork' not in multiprocessing.get_all_start_methods()
+    ):
+        return _render_chunk(name, contexts)
+
+    get_email_templates(name)  # compile once in the parent, inherited by the workers
+    chunk_size = -(-len(contexts) // processes)
+    chunks = [contexts[i:i + chunk_size] for i in range(0, len(contexts), chunk_size)]
+    with ProcessPoolExecutor(
+        max_workers=len(chunks),
+        mp_context=multiprocessing.get_context('fork'),
+        initializer=_init_render_worker,
+    ) as pool:
+        rendered = []
+        for part in pool.map(_render_chunk, [name] * len(chunks), chunks):
+            rendered.extend(part)
+    return rendered
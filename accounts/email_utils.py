@@ -1,8 +1,10 @@
-from django.core.mail import send_mail, EmailMultiAlternatives
-from django.template.loader import render_to_string
-from django.utils.html import strip_tags
-from django.conf import settings
-from django.contrib.auth.models import User
+"""Transactional emails.
+
+Each helper renders its email and queues it in the outbox (see outbox.py); the
+process_email_outbox command delivers it. They return True once queued.
+"""
+from .email_rendering import render_email_parts, render_many
+from .outbox import make_email, queue_email, queue_emails
 import logging
 
 logger = logging.getLogger(__name__)
@@ -14,25 +16,17 @@ def send_welcome_email(user):
         
     try:
         subject = 'Welcome to Customise Clothing!'
-        html_content = render_to_string('emails/welcome.html', {
+        text_content, html_content = render_email_parts('welcome', {
             'user': user,
             'site_name': 'Customise Clothing'
         })
-        text_content = strip_tags(html_content)
-        
-        msg = EmailMultiAlternatives(
-            subject=subject,
-            body=text_content,
-            from_email=settings.DEFAULT_FROM_EMAIL,
-            to=[user.email]
-        )
-        msg.attach_alternative(html_content, "text/html")
-        msg.send()
-        
-        logger.info(f"Welcome email sent to {user.email}")
+        
+        queue_email(subject, text_content, [user.email], html_body=html_content)
+        
+        logger.info(f"Welcome email queued for {user.email}")
         return True
     except Exception as e:
-        logger.error(f"Failed to send welcome email to {user.email}: {str(e)}")
+        logger.error(f"Failed to queue welcome email for {user.email}: {str(e)}")
         return False
 
 def send_login_notification_email(user, request):
@@ -52,27 +46,19 @@ def send_login_notification_email(user, request):
         user_agent = request.META.get('HTTP_USER_AGENT', 'Unknown')
         
         subject = 'Login Alert - Customise Clothing'
-        html_content = render_to_string('emails/login_notification.html', {
+        text_content, html_content = render_email_parts('login_notification', {
             'user': user,
             'ip_address': ip_address,
             'user_agent': user_agent,
             'site_name': 'Customise Clothing'
         })
-        text_content = strip_tags(html_content)
-        
-        msg = EmailMultiAlternatives(
-            subject=subject,
-            body=text_content,
-            from_email=settings.DEFAULT_FROM_EMAIL,
-            to=[user.email]
-        )
-        msg.attach_alternative(html_content, "text/html")
-        msg.send()
-        
-        logger.info(f"Login notification sent to {user.email}")
+        
+        queue_email(subject, text_content, [user.email], html_body=html_content)
+        
+        logger.info(f"Login notification queued for {user.email}")
         return True
     except Exception as e:
-        logger.error(f"Failed to send login notification to {user.email}: {str(e)}")
+        logger.error(f"Failed to queue login notification for {user.email}: {str(e)}")
         return False
 
 def send_order_confirmation_email(order):
@@ -82,56 +68,59 @@ def send_order_confirmation_email(order):
         
     try:
         subject = f'Order Confirmation #{order.id}'
-        html_content = render_to_string('emails/order_confirmation.html', {
+        text_content, html_content = render_email_parts('order_confirmation', {
             'order': order,
             'user': order.user,
             'site_name': 'Customise Clothing'
         })
-        text_content = strip_tags(html_content)
-        
-        msg = EmailMultiAlternatives(
-            subject=subject,
-            body=text_content,
-            from_email=settings.DEFAULT_FROM_EMAIL,
-            to=[order.user.email]
-        )
-        msg.attach_alternative(html_content, "text/html")
-        msg.send()
-        
-        logger.info(f"Order confirmation sent to {order.user.email} for order #{order.id}")
+        
+        queue_email(subject, text_content, [order.user.email], html_body=html_content)
+        
+        logger.info(f"Order confirmation queued for {order.user.email} for order #{order.id}")
         return True
     except Exception as e:
-        logger.error(f"Failed to send order confirmation to {order.user.email}: {str(e)}")
+        logger.error(f"Failed to queue order confirmation for {order.user.email}: {str(e)}")
         return False
 
+def order_status_context(order, status_message):
+    return {
+        'order': order,
+        'user': order.user,
+        'status_message': status_message,
+        'site_name': 'Customise Clothing'
+    }
+
+def render_order_status_update_email(order, status_message):
+    """Rendered (unsaved) order status update email, or None without a recipient"""
+    emails = render_order_status_update_emails([order], status_message)
+    return emails[0] if emails else None
+
+def render_order_status_update_emails(orders, status_message, processes=1):
+    """Rendered emails for the orders that have a recipient.
+
+    Rendered in-process unless a command or worker passes processes > 1 (see render_many).
+    """
+    orders = [order for order in orders if order.user and order.user.email]
+    rendered = render_many(
+        'order_status_update', [order_status_context(order, status_message) for order in orders], processes
+    )
+    return [
+        make_email(f'Order Update #{order.id}', text_content, [order.user.email], html_body=html_content)
+        for order, (text_content, html_content) in zip(orders, rendered)
+    ]
+
 def send_order_status_update_email(order, status_message):
     """Send order status update email"""
     if not order.user or not order.user.email:
         return False
         
     try:
-        subject = f'Order Update #{order.id}'
-        html_content = render_to_string('emails/order_status_update.html', {
-            'order': order,
-            'user': order.user,
-            'status_message': status_message,
-            'site_name': 'Customise Clothing'
-        })
-        text_content = strip_tags(html_content)
-        
-        msg = EmailMultiAlternatives(
-            subject=subject,
-            body=text_content,
-            from_email=settings.DEFAULT_FROM_EMAIL,
-            to=[order.user.email]
-        )
-        msg.attach_alternative(html_content, "text/html")
-        msg.send()
-        
-        logger.info(f"Order status update sent to {order.user.email} for order #{order.id}")
+        queue_emails([render_order_status_update_email(order, status_message)])
+        
+        logger.info(f"Order status update queued for {order.user.email} for order #{order.id}")
         return True
     except Exception as e:
-        logger.error(f"Failed to send order status update to {order.user.email}: {str(e)}")
+        logger.error(f"Failed to queue order status update for {order.user.email}: {str(e)}")
         return False
 
 def send_personalization_update_email(personalization, status):
@@ -147,44 +136,50 @@ def send_personalization_update_email(personalization, status):
         }
         
         subject = f'Customization Update - {personalization.product.name}'
-        html_content = render_to_string('emails/personalization_update.html', {
+        text_content, html_content = render_email_parts('personalization_update', {
             'personalization': personalization,
             'user': personalization.user,
             'status_message': status_messages.get(status, f'Status updated to: {status}'),
             'site_name': 'Customise Clothing'
         })
-        text_content = strip_tags(html_content)
-        
-        msg = EmailMultiAlternatives(
-            subject=subject,
-            body=text_content,
-            from_email=settings.DEFAULT_FROM_EMAIL,
-            to=[personalization.user.email]
-        )
-        msg.attach_alternative(html_content, "text/html")
-        msg.send()
-        
-        logger.info(f"Personalization update sent to {personalization.user.email}")
+        
+        queue_email(subject, text_content, [personalization.user.email], html_body=html_content)
+        
+        logger.info(f"Personalization update queued for {personalization.user.email}")
         return True
     except Exception as e:
-        logger.error(f"Failed to send personalization update to {personalization.user.email}: {str(e)}")
+        logger.error(f"Failed to queue personalization update for {personalization.user.email}: {str(e)}")
         return False
 
 
+def render_email(to_email, subject, message):
+    """Unsaved simple text/html email for send_mass_email()"""
+    return make_email(subject, message, [to_email], html_body=message)
+
+
 def send_email(to_email, subject, message):
-    """Send a simple text/html email"""
+    """Queue a simple text/html email"""
     try:
-        msg = EmailMultiAlternatives(
-            subject=subject,
-            body=message,
-            from_email=settings.DEFAULT_FROM_EMAIL,
-            to=[to_email]
-        )
-        msg.attach_alternative(message, "text/html")
-        msg.send()
-        
-        logger.info(f"Email sent to {to_email}")
+        queue_emails([render_email(to_email, subject, message)])
+        
+        logger.info(f"Email queued for {to_email}")
         return True
     except Exception as e:
-        logger.error(f"Failed to send email to {to_email}: {str(e)}")
-        return False
\ No newline at end of file
+        logger.error(f"Failed to queue email for {to_email}: {str(e)}")
+        return False
+
+
+def send_mass_email(emails):
+    """Queue many emails rendered up front (render_* helpers) with batched INSERTs.
+
+    None entries (no recipient) are skipped. The outbox worker then delivers
+    them over one connection per batch. Returns the number queued.
+    """
+    emails = [email for email in emails if email is not None]
+    try:
+        queue_emails(emails)
+    except Exception as e:
+        logger.error(f"Failed to queue {len(emails)} emails: {str(e)}")
+        return 0
+    logger.info(f"Queued {len(emails)} emails")
+    return len(emails)
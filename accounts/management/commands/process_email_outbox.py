@@ -0,0 +1,38 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from accounts.outbox import OUTBOX_BATCH_SIZE, OUTBOX_MAX_ATTEMPTS, process_outbox
+
+
+class Command(BaseCommand):
+    help = 'Send queued emails from the outbox, retrying failures with backoff'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=OUTBOX_BATCH_SIZE,
+                            help='Emails sent per SMTP connection')
+        parser.add_argument('--max-attempts', type=int, default=OUTBOX_MAX_ATTEMPTS,
+                            help='Attempts before an email is marked failed')
+        parser.add_argument('--loop', type=int, metavar='SECONDS',
+                            help='Keep running, polling every SECONDS when the outbox is empty')
+
+    def handle(self, *args, **options):
+        batch_size = max(1, options['batch_size'])
+        total_sent = total_failed = 0
+        while True:
+            sent, failed = process_outbox(batch_size, options['max_attempts'])
+            total_sent += sent
+            total_failed += failed
+            if sent or failed:
+                if options['loop']:
+                    self.report(sent, failed)
+                continue
+            if not options['loop']:
+                break
+            time.sleep(options['loop'])
+        self.report(total_sent, total_failed)
+
+    def report(self, sent, failed):
+        self.stdout.write(self.style.SUCCESS(f'Sent {sent} emails'))
+        if failed:
+            self.stdout.write(self.style.WARNING(f'{failed} emails failed and will be retried or given up'))
@@ -34,7 +34,7 @@ class Command(BaseCommand):
         if email_type == 'welcome':
             success = send_welcome_email(test_user)
             if success:
-                self.stdout.write(self.style.SUCCESS(f'Welcome email sent successfully to {email}'))
+                self.stdout.write(self.style.SUCCESS(f'Welcome email queued for {email}; run process_email_outbox to deliver it'))
             else:
                 self.stdout.write(self.style.ERROR(f'Failed to send welcome email to {email}'))
         
@@ -49,6 +49,6 @@ class Command(BaseCommand):
             mock_request = MockRequest()
             success = send_login_notification_email(test_user, mock_request)
             if success:
-                self.stdout.write(self.style.SUCCESS(f'Login notification email sent successfully to {email}'))
+                self.stdout.write(self.style.SUCCESS(f'Login notification email queued for {email}; run process_email_outbox to deliver it'))
             else:
                 self.stdout.write(self.style.ERROR(f'Failed to send login notification email to {email}'))
\ No newline at end of file
@@ -0,0 +1,132 @@
+"""Database-backed email outbox.
+
+The email helpers call queue_email(), which only inserts an OutboxEmail row, so
+SMTP latency stays out of requests and admin actions (and an email queued
+inside a transaction is dropped if the transaction rolls back). The
+process_email_outbox command sends due emails in batches over one connection,
+retrying failures with exponential backoff.
+"""
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import OutboxEmail
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_BATCH_SIZE = 100
+OUTBOX_MAX_ATTEMPTS = 5
+OUTBOX_RETRY_BASE_SECONDS = 60
+OUTBOX_RETRY_MAX_SECONDS = 6 * 60 * 60
+# A claimed batch is retried after this long if its worker died mid-send
+OUTBOX_LEASE_SECONDS = 10 * 60
+
+
+def make_email(subject, body, to, html_body='', from_email=None):
+    """An unsaved OutboxEmail, due now"""
+    return OutboxEmail(
+        subject=subject,
+        body=body,
+        html_body=html_body,
+        from_email=from_email or settings.DEFAULT_FROM_EMAIL,
+        to=list(to),
+        next_attempt_at=timezone.now(),
+    )
+
+
+def queue_email(subject, body, to, html_body='', from_email=None):
+    """Queue an email for the outbox worker; returns the OutboxEmail"""
+    email = make_email(subject, body, to, html_body, from_email)
+    email.save()
+    return email
+
+
+def queue_emails(emails):
+    """Queue many unsaved OutboxEmails (see make_email) with batched INSERTs"""
+    return OutboxEmail.objects.bulk_create(emails, batch_size=500)
+
+
+def retry_delay(attempts):
+    """Backoff before the next try after attempts failures: 1, 2, 4... minutes, capped"""
+    return timedelta(seconds=min(OUTBOX_RETRY_BASE_SECONDS * 2 ** (attempts - 1), OUTBOX_RETRY_MAX_SECONDS))
+
+
+def claim_batch(batch_size=OUTBOX_BATCH_SIZE):
+    """Lease up to batch_size due emails so concurrent workers skip them"""
+    now = timezone.now()
+    with transaction.atomic():
+        batch = list(
+            OutboxEmail.objects.select_for_update(skip_locked=True)
+            .filter(status='pending', next_attempt_at__lte=now)
+            .order_by('next_attempt_at', 'id')[:batch_size]
+        )
+        OutboxEmail.objects.filter(id__in=[email.id for email in batch]).update(
+            next_attempt_at=now + timedelta(seconds=OUTBOX_LEASE_SECONDS)
+        )
+    return batch
+
+
+def build_message(email, connection=None):
+    msg = EmailMultiAlternatives(
+        subject=email.subject,
+        body=email.body,
+        from_email=email.from_email,
+        to=email.to,
+        connection=connection,
+    )
+    if email.html_body:
+        msg.attach_alternative(email.html_body, "text/html")
+    return msg
+
+
+def record_failure(email, error, max_attempts):
+    email.attempts += 1
+    email.last_error = str(error)
+    if email.attempts >= max_attempts:
+        email.status = 'failed'
+        logger.error(f"Giving up on email {email.id} to {', '.join(email.to)}: {error}")
+    else:
+        email.next_attempt_at = timezone.now() + retry_delay(email.attempts)
+        logger.warning(f"Email {email.id} failed (attempt {email.attempts}), retrying: {error}")
+    email.save(update_fields=['attempts', 'last_error', 'status', 'next_attempt_at', 'updated_at'])
+
+
+def process_outbox(batch_size=OUTBOX_BATCH_SIZE, max_attempts=OUTBOX_MAX_ATTEMPTS, connection=None):
+    """Send one batch of due emails over a single connection; returns (sent, failed)
+
+    connection defaults to a new connection of the configured EMAIL_BACKEND.
+    """
+    batch = claim_batch(batch_size)
+    if not batch:
+        return 0, 0
+
+    sent_ids = []
+    failed = 0
+    connection = connection or get_connection()
+    try:
+        connection.open()
+    except Exception as e:
+        for email in batch:
+            record_failure(email, e, max_attempts)
+        return 0, len(batch)
+
+    try:
+        for email in batch:
+            try:
+                build_message(email, connection).send()
+                sent_ids.append(email.id)
+            except Exception as e:
+                record_failure(email, e, max_attempts)
+                failed += 1
+    finally:
+        connection.close()
+
+    OutboxEmail.objects.filter(id__in=sent_ids).update(
+        status='sent', sent_at=timezone.now(), attempts=F('attempts') + 1, last_error='', updated_at=timezone.now()
+    )
+    return len(sent_ids), failed
@@ -1,3 +1,94 @@
-from django.test import TestCase
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core import mail
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from . import email_rendering
+from .email_rendering import render_email_parts, render_many
+from .email_utils import render_email, send_mass_email, send_welcome_email
+from .models import OutboxEmail
+from .outbox import process_outbox, queue_email, retry_delay
+
+
+@override_settings(EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend')
+class EmailOutboxTests(TestCase):
+    def test_helpers_queue_instead_of_sending(self):
+        user = User.objects.create_user(username='asha', email='asha@example.com')
+        self.assertTrue(send_welcome_email(user))
+        self.assertEqual(mail.outbox, [])
+
+        email = OutboxEmail.objects.get()
+        self.assertEqual(email.to, ['asha@example.com'])
+        self.assertIn('<', email.html_body)
+        self.assertNotIn('</', email.body)
+
+    def test_worker_sends_batches_over_one_connection(self):
+        for i in range(5):
+            queue_email(f'Hello {i}', 'Body', [f'user{i}@example.com'], html_body='<p>Body</p>')
+
+        with mock.patch('accounts.outbox.get_connection', wraps=mail.get_connection) as get_connection:
+            out = StringIO()
+            call_command('process_email_outbox', batch_size=2, stdout=out)
+
+        self.assertIn('Sent 5 emails', out.getvalue())
+        self.assertEqual(get_connection.call_count, 3)
+        self.assertEqual(len(mail.outbox), 5)
+        self.assertEqual(mail.outbox[0].alternatives[0][0], '<p>Body</p>')
+        self.assertFalse(OutboxEmail.objects.exclude(status='sent').exists())
+        self.assertEqual(process_outbox(), (0, 0))
+
+    def test_mass_email_queues_with_one_insert(self):
+        emails = [render_email(f'user{i}@example.com', 'Return approved', '<p>Refunded</p>') for i in range(20)]
+        with self.assertNumQueries(1):
+            self.assertEqual(send_mass_email(emails + [None]), 20)
+
+        process_outbox()
+        self.assertEqual(len(mail.outbox), 20)
+
+    def test_failures_back_off_then_give_up(self):
+        email = queue_email('Hello', 'Body', ['asha@example.com'])
+        with mock.patch('django.core.mail.EmailMessage.send', side_effect=OSError('connection refused')):
+            self.assertEqual(process_outbox(max_attempts=2), (0, 1))
+            email.refresh_from_db()
+            self.assertEqual((email.status, email.attempts), ('pending', 1))
+            self.assertGreater(email.next_attempt_at, timezone.now() + retry_delay(1) - timedelta(seconds=5))
+
+            # Not due yet
+            self.assertEqual(process_outbox(max_attempts=2), (0, 0))
+            OutboxEmail.objects.update(next_attempt_at=timezone.now())
+            self.assertEqual(process_outbox(max_attempts=2), (0, 1))
+
+        email.refresh_from_db()
+        self.assertEqual((email.status, email.attempts, email.last_error), ('failed', 2, 'connection refused'))
+        self.assertEqual(retry_delay(3), timedelta(minutes=4))
+
+
+class EmailRenderingTests(TestCase):
+    def setUp(self):
+        self.users = [User(username=f'user{i}', email=f'user{i}@example.com') for i in range(6)]
+
+    def test_text_part_comes_from_text_template(self):
+        text, html = render_email_parts('welcome', {'user': self.users[0], 'site_name': 'Shop & Co'})
+        self.assertIn('<strong>Shop &amp; Co</strong>', html)
+        self.assertIn('Thank you for joining Shop & Co', text)
+        self.assertNotIn('<', text)
+
+    def test_pool_renders_the_same_as_in_process(self):
+        contexts = [{'user': user, 'site_name': 'Shop'} for user in self.users]
+        with mock.patch.object(email_rendering, 'EMAIL_RENDER_POOL_MIN', 2):
+            pooled = render_many('welcome', contexts, processes=3)
+        self.assertEqual(pooled, render_many('welcome', contexts, processes=1))
+        self.assertIn('user5@example.com', pooled[5][0])
+
+    def test_pool_is_opt_in(self):
+        # Request code (e.g. admin actions) must never fork the serving process
+        contexts = [{'user': user, 'site_name': 'Shop'} for user in self.users]
+        with mock.patch.object(email_rendering, 'EMAIL_RENDER_POOL_MIN', 2), \
+                mock.patch.object(email_rendering, 'ProcessPoolExecutor') as pool:
+            render_many('welcome', contexts)
+        pool.assert_not_called()
@@ -7,6 +7,7 @@ from django.contrib.auth.models import User
 from .forms import RegistrationForm, CustomLoginForm
 from .models import UserProfile
 from store.models import Order
+from store.cart_utils import merge_carts
 from .email_utils import send_welcome_email, send_login_notification_email
 
 # Create your views here.
@@ -73,7 +74,11 @@ def custom_login(request):
                 user = authenticate(request, username=login_field, password=password)
             
             if user is not None:
+                # login() rotates the session key, so remember the guest cart's first
+                guest_session_key = request.session.session_key
                 auth_login(request, user)
+                if guest_session_key:
+                    merge_carts(user, guest_session_key)
                 
                 # Send login notification email if user has email
                 if user.email:
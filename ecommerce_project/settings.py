@@ -103,6 +103,19 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/5.2/topics/cache/
+# Catalog fragments are invalidated through a version counter stored here, so use a
+# shared backend (Redis/Memcached) when running more than one worker process.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'customise-clothing',
+    }
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
 
@@ -218,3 +231,10 @@ EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
 DEFAULT_FROM_EMAIL = 'Customize Clothing <noreply@customizeclothing.com>'
 EMAIL_SUBJECT_PREFIX = '[Customize Clothing] '
 ADMIN_EMAIL = 'admin@customizeclothing.com'
+
+# Stock holds
+# When enabled, adding to or updating a cart holds the stock for that cart for
+# STOCK_HOLD_SECONDS; other carts only see stock minus active holds. Run
+# `manage.py sweep_stock_holds --loop 60` (or cron it) to delete expired holds.
+STOCK_HOLDS_ENABLED = False
+STOCK_HOLD_SECONDS = 15 * 60
@@ -1,6 +1,8 @@
 from django.contrib import admin
 from django import forms
-from .models import Product, CustomizationRequest, Category, Cart, CartItem, PersonalizationRequest, Order, OrderItem, Wallet, WalletTransaction, UPIPaymentMethod, ReturnRequest, Size
+from .cart_utils import sync_personalization_cart_totals
+from .category_tree import get_category_tree
+from .models import Product, CustomizationRequest, Category, Cart, CartItem, PersonalizationRequest, Order, OrderItem, Wallet, WalletMonthlySummary, WalletTransaction, UPIPaymentMethod, ReturnRequest, Size, StockHold
 
 class CategoryInline(admin.TabularInline):
     model = Category
@@ -31,10 +33,8 @@ class ProductAdminForm(forms.ModelForm):
         # Order categories and display hierarchical labels
         self.fields['category'].queryset = Category.objects.all().order_by('parent__name', 'name')
 
-        def make_label(cat: Category):
-            return f"{cat.parent.name} > {cat.name}" if cat.parent else cat.name
-
-        self.fields['category'].label_from_instance = make_label
+        tree = get_category_tree()
+        self.fields['category'].label_from_instance = lambda cat: tree.label(cat.id, separator=' > ')
 
 @admin.register(Product)
 class ProductAdmin(admin.ModelAdmin):
@@ -64,10 +64,10 @@ class CartItemInline(admin.TabularInline):
 
 @admin.register(Cart)
 class CartAdmin(admin.ModelAdmin):
-    list_display = ('__str__', 'user', 'session_key', 'total_items', 'total_price', 'created_at', 'updated_at')
+    list_display = ('__str__', 'user', 'session_key', 'total_quantity', 'total_price', 'created_at', 'updated_at')
     list_filter = ('created_at', 'updated_at')
     search_fields = ('user__username', 'session_key')
-    readonly_fields = ('total_items', 'total_price', 'created_at', 'updated_at')
+    readonly_fields = ('item_count', 'total_quantity', 'total_price', 'created_at', 'updated_at')
     inlines = [CartItemInline]
     
     fieldsets = (
@@ -75,7 +75,7 @@ class CartAdmin(admin.ModelAdmin):
             'fields': ('user', 'session_key')
         }),
         ('Summary', {
-            'fields': ('total_items', 'total_price')
+            'fields': ('item_count', 'total_quantity', 'total_price')
         }),
         ('Timestamps', {
             'fields': ('created_at', 'updated_at'),
@@ -83,6 +83,11 @@ class CartAdmin(admin.ModelAdmin):
         }),
     )
 
+    def save_related(self, request, form, formsets, change):
+        super().save_related(request, form, formsets, change)
+        # Inline edits bypass cart_utils, so rebuild the cached totals
+        form.instance.recalculate_totals()
+
 @admin.register(CartItem)
 class CartItemAdmin(admin.ModelAdmin):
     list_display = ('cart', 'product', 'size', 'quantity', 'total_price', 'created_at')
@@ -103,6 +108,21 @@ class CartItemAdmin(admin.ModelAdmin):
         }),
     )
 
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        obj.cart.recalculate_totals()
+
+    def delete_model(self, request, obj):
+        super().delete_model(request, obj)
+        obj.cart.recalculate_totals()
+
+@admin.register(StockHold)
+class StockHoldAdmin(admin.ModelAdmin):
+    list_display = ('product', 'cart', 'quantity', 'expires_at')
+    list_filter = ('expires_at',)
+    search_fields = ('product__name', 'cart__user__username')
+    raw_id_fields = ('cart', 'product')
+
 @admin.register(Size)
 class SizeAdmin(admin.ModelAdmin):
     list_display = ('code', 'display_order')
@@ -136,6 +156,12 @@ class PersonalizationRequestAdmin(admin.ModelAdmin):
         return obj.user.username if obj.user else '-'
     user_display.short_description = 'User'
 
+    def save_model(self, request, obj, form, change):
+        # Status edits move the request in or out of the owner's cached cart totals
+        old_quantity = obj.cart_quantity if change and form.initial.get('status') == 'order_accepted' else 0
+        super().save_model(request, obj, form, change)
+        sync_personalization_cart_totals(obj, old_quantity)
+
 
 class OrderItemInline(admin.TabularInline):
     model = OrderItem
@@ -159,6 +185,14 @@ class WalletAdmin(admin.ModelAdmin):
     inlines = [WalletTransactionInline]
 
 
+@admin.register(WalletMonthlySummary)
+class WalletMonthlySummaryAdmin(admin.ModelAdmin):
+    list_display = ('wallet', 'month', 'credit_total', 'debit_total', 'transaction_count')
+    list_filter = ('month',)
+    search_fields = ('wallet__user__username',)
+    readonly_fields = ('wallet', 'month', 'credit_total', 'debit_total', 'transaction_count')
+
+
 @admin.register(WalletTransaction)
 class WalletTransactionAdmin(admin.ModelAdmin):
     list_display = ('wallet_user', 'transaction_type', 'amount', 'balance_after', 'created_at')
@@ -173,10 +207,11 @@ class WalletTransactionAdmin(admin.ModelAdmin):
 
 def approve_return_requests(modeladmin, request, queryset):
     """Admin action to approve return requests and process refunds"""
-    from accounts.email_utils import send_email
+    from accounts.email_utils import render_email, send_mass_email
     
     approved = 0
-    for return_request in queryset:
+    emails = []
+    for return_request in queryset.select_related('user', 'order'):
         if return_request.status == 'pending':
             try:
                 return_request.approve_return("Approved by admin")
@@ -197,11 +232,14 @@ Thank you for shopping with us!
 Best regards,
 Customize Clothing Team"""
                     
-                    send_email(return_request.user.email, subject, message)
+                    emails.append(render_email(return_request.user.email, subject, message))
                     
             except Exception as e:
                 modeladmin.message_user(request, f"Error processing return request #{return_request.id}: {str(e)}", level='ERROR')
-    
+
+    # Queue all notifications at once
+    send_mass_email(emails)
+
     if approved > 0:
         modeladmin.message_user(request, f"Successfully approved {approved} return request(s) and processed refunds to wallets.")
     else:
@@ -212,10 +250,11 @@ approve_return_requests.short_description = "Approve selected return requests an
 
 def reject_return_requests(modeladmin, request, queryset):
     """Admin action to reject return requests"""
-    from accounts.email_utils import send_email
+    from accounts.email_utils import render_email, send_mass_email
     
     rejected = 0
-    for return_request in queryset:
+    emails = []
+    for return_request in queryset.select_related('user', 'order'):
         if return_request.status == 'pending':
             try:
                 return_request.reject_return("Rejected by admin - does not meet return policy criteria")
@@ -235,11 +274,14 @@ If you have any questions, please contact our customer support.
 Best regards,
 Customize Clothing Team"""
                     
-                    send_email(return_request.user.email, subject, message)
+                    emails.append(render_email(return_request.user.email, subject, message))
                     
             except Exception as e:
                 modeladmin.message_user(request, f"Error rejecting return request #{return_request.id}: {str(e)}", level='ERROR')
-    
+
+    # Queue all notifications at once
+    send_mass_email(emails)
+
     if rejected > 0:
         modeladmin.message_user(request, f"Successfully rejected {rejected} return request(s).")
     else:
@@ -273,22 +315,23 @@ class ReturnRequestAdmin(admin.ModelAdmin):
 
 def approve_upi_orders(modeladmin, request, queryset):
     """Admin action to approve UPI orders and move them to processing"""
-    from accounts.email_utils import send_order_status_update_email
+    from accounts.email_utils import render_order_status_update_emails, send_mass_email
     
     updated = 0
-    for order in queryset:
+    approved_orders = []
+    for order in queryset.select_related('user'):
         if order.status == 'pending' and order.payment_method == 'upi':
             order.status = 'processing'
             order.save(update_fields=['status'])
             updated += 1
-            
-            # Send notification email to customer
-            if order.user and order.user.email:
-                send_order_status_update_email(
-                    order, 
-                    "Your UPI payment has been verified and your order is now being processed!"
-                )
-    
+            approved_orders.append(order)
+
+    # Notify the customers: render every email, then queue them together
+    send_mass_email(render_order_status_update_emails(
+        approved_orders,
+        "Your UPI payment has been verified and your order is now being processed!"
+    ))
+
     if updated > 0:
         modeladmin.message_user(request, f"Successfully approved {updated} UPI order(s). They are now in processing status and customers have been notified.")
     else:
@@ -1,11 +1,53 @@
-from django.shortcuts import get_object_or_404
 from django.db import transaction
+from django.db.models import Count, DecimalField, F, Q, Sum
+from django.utils import timezone
 from decimal import Decimal
-from .models import Cart, CartItem, Product, Size
+from .holds import available_stock, held_by_other_carts, holds_enabled, refresh_hold, refresh_holds
+from .models import Cart, CartItem, PersonalizationRequest, Product, quantize_price
+from .sizes import allowed_size_ids_for, get_size, validate_size
+
+# Personalization statuses shown alongside the cart
+ACTIVE_PERSONALIZATION_STATUSES = ['pending', 'admin_approved', 'user_approved', 'order_accepted']
+
+
+# Session key remembering the visitor's cart id, so later requests look it up by primary key
+CART_SESSION_KEY = 'cart_id'
+
+
+def get_cart(request):
+    """The visitor's existing cart, or None; resolved once per request.
+
+    Never creates a cart or a session, so read-only views stay read-only.
+    """
+    if not hasattr(request, '_cached_cart'):
+        request._cached_cart = _find_cart(request)
+    return request._cached_cart
+
+
+def _find_cart(request):
+    if request.user.is_authenticated:
+        owner = {'user': request.user}
+    elif request.session.session_key:
+        owner = {'session_key': request.session.session_key, 'user': None}
+    else:
+        return None
+
+    cart_id = request.session.get(CART_SESSION_KEY)
+    cart = Cart.objects.filter(pk=cart_id, **owner).first() if cart_id else None
+    if cart is None:
+        # First visit, or the remembered cart is gone (e.g. merged on login)
+        cart = Cart.objects.filter(**owner).first()
+        if cart is not None:
+            request.session[CART_SESSION_KEY] = cart.pk
+    return cart
 
 
 def get_or_create_cart(request):
     """Get or create cart for user or session"""
+    cart = get_cart(request)
+    if cart is not None:
+        return cart
+
     if request.user.is_authenticated:
         cart, created = Cart.objects.get_or_create(user=request.user)
     else:
@@ -17,188 +59,444 @@ def get_or_create_cart(request):
             session_key=request.session.session_key
         )
     
+    request._cached_cart = cart
+    request.session[CART_SESSION_KEY] = cart.pk
     return cart
 
 
+def resolve_size(size_code):
+    """The Size for a submitted code (None for no code) from the in-process registry"""
+    if not size_code:
+        return None
+    size = get_size(size_code)
+    if size is None:
+        raise ValueError("Invalid size selected")
+    return size
+
+
+def lock_product(product_id):
+    """Read and lock a product row for a cart mutation; call inside a transaction"""
+    try:
+        return Product.objects.select_for_update().get(id=product_id)
+    except (Product.DoesNotExist, TypeError, ValueError):
+        raise ValueError("Product not found")
+
+
 def add_to_cart(request, product_id, quantity=1, size_code=None):
-    """Add product to cart or update quantity"""
-    cart = get_or_create_cart(request)
-    product = get_object_or_404(Product, id=product_id)
+    """Add product to cart or update quantity.
 
+    The product row is read once, under lock. Raises ValueError when the
+    product is missing or out of stock, or the size does not fit.
+    """
     # Validate quantity
     if quantity <= 0:
         raise ValueError("Quantity must be positive")
 
     # Resolve size if provided
-    size_obj = None
-    if size_code:
-        try:
-            size_obj = Size.objects.get(code=size_code)
-        except Size.DoesNotExist:
-            raise ValueError("Invalid size selected")
+    size_obj = resolve_size(size_code)
 
-    # Use get_or_create with a lock to prevent race conditions
     with transaction.atomic():
         # Lock the product row to check stock
-        product = Product.objects.select_for_update().get(id=product_id)
+        product = lock_product(product_id)
+        if product.stock <= 0:
+            raise ValueError(f'Product "{product.name}" is out of stock')
 
         # Validate size vs product configuration
-        product_has_sizes = product.sizes.exists()
-        if product_has_sizes and size_obj is None:
-            raise ValueError("Please select a size for this product")
-        if size_obj is not None and product_has_sizes and not product.sizes.filter(id=size_obj.id).exists():
-            raise ValueError("Selected size is not available for this product")
-        
-        # Try to get or create the cart item
-        cart_item, created = CartItem.objects.select_for_update().get_or_create(
-            cart=cart,
-            product=product,
-            size=size_obj,
-            defaults={'quantity': 0}  # Will be updated below
-        )
+        validate_size(product, size_obj)
+
+        # Check against the existing cart; a cart (and a guest session) is only
+        # created once the add is known to succeed
+        cart = get_cart(request)
+        cart_item = CartItem.objects.select_for_update().filter(
+            cart=cart, product=product, size=size_obj
+        ).first() if cart is not None else None
+        created = cart_item is None
         
         # Calculate new total quantity
         new_quantity = quantity if created else cart_item.quantity + quantity
         
-        # Check stock availability
-        if new_quantity > product.stock:
-            raise ValueError(f"Insufficient stock. Available: {product.stock}, Requested: {new_quantity}")
+        # Check stock availability (less other carts' holds when stock holds are on)
+        available = available_stock(product, cart)
+        if new_quantity > available:
+            raise ValueError(f"Insufficient stock. Available: {available}, Requested: {new_quantity}")
         
         if created:
-            # New item, set the quantity
-            cart_item.quantity = quantity
-            cart_item.save()
+            cart = get_or_create_cart(request)
+            cart_item = CartItem.objects.create(cart=cart, product=product, size=size_obj, quantity=quantity)
         else:
             # Item exists, update quantity safely
             cart_item.quantity = new_quantity
-            cart_item.save()
+            cart_item.save(update_fields=['quantity', 'updated_at'])
+        # The locked product and the registry's size, so neither is lazily reloaded
+        cart_item.product, cart_item.size = product, size_obj
+        
+        cart.adjust_totals(lines=1 if created else 0, quantity=quantity, price=quantity * product.price)
+        refresh_hold(cart, product)
     
     return cart_item
 
 
 def update_cart_item(request, product_id, quantity, size_code=None):
-    """Update cart item quantity"""
-    cart = get_or_create_cart(request)
-    product = get_object_or_404(Product, id=product_id)
-    
+    """Update cart item quantity (0 removes it); the product is read once, under lock.
+
+    Returns the updated item, or None when it was removed or is not in the cart.
+    """
+    if quantity < 0:
+        raise ValueError("Quantity cannot be negative")
+
     # Resolve size if provided
-    size_obj = None
-    if size_code:
-        try:
-            size_obj = Size.objects.get(code=size_code)
-        except Size.DoesNotExist:
-            raise ValueError("Invalid size selected")
+    size_obj = resolve_size(size_code)
 
     with transaction.atomic():
         try:
             # Lock both product and cart item
-            product = Product.objects.select_for_update().get(id=product_id)
+            product = lock_product(product_id)
             # Validate size vs product configuration
-            product_has_sizes = product.sizes.exists()
-            if product_has_sizes and size_obj is None:
-                raise ValueError("Please select a size for this product")
-            if size_obj is not None and product_has_sizes and not product.sizes.filter(id=size_obj.id).exists():
-                raise ValueError("Selected size is not available for this product")
+            validate_size(product, size_obj)
 
+            cart = get_cart(request)
+            if cart is None:
+                return None
             cart_item = CartItem.objects.select_for_update().get(cart=cart, product=product, size=size_obj)
+            cart_item.product, cart_item.size = product, size_obj
+            
+            old_quantity = cart_item.quantity
             
             if quantity <= 0:
                 cart_item.delete()
+                cart.adjust_totals(lines=-1, quantity=-old_quantity, price=-old_quantity * product.price)
+                refresh_hold(cart, product)
                 return None
             else:
-                # Check stock availability
-                if quantity > product.stock:
-                    raise ValueError(f"Insufficient stock. Available: {product.stock}, Requested: {quantity}")
+                # Check stock availability (less other carts' holds when stock holds are on)
+                available = available_stock(product, cart)
+                if quantity > available:
+                    raise ValueError(f"Insufficient stock. Available: {available}, Requested: {quantity}")
                 
                 cart_item.quantity = quantity
-                cart_item.save()
+                cart_item.save(update_fields=['quantity', 'updated_at'])
+                delta = quantity - old_quantity
+                cart.adjust_totals(quantity=delta, price=delta * product.price)
+                refresh_hold(cart, product)
                 return cart_item
         except CartItem.DoesNotExist:
             return None
 
 
 def remove_from_cart(request, product_id, size_code=None):
-    """Remove product from cart"""
-    cart = get_or_create_cart(request)
-    product = get_object_or_404(Product, id=product_id)
+    """Remove product from cart; the line and its product are read in one locking query"""
+    cart = get_cart(request)
+    if cart is None:
+        return False
     
     try:
-        size_obj = None
-        if size_code:
-            size_obj = Size.objects.get(code=size_code)
-        cart_item = CartItem.objects.get(cart=cart, product=product, size=size_obj)
-        cart_item.delete()
+        size_obj = resolve_size(size_code)
+        with transaction.atomic():
+            cart_item = CartItem.objects.select_for_update().select_related('product').get(
+                cart=cart, product_id=product_id, size=size_obj
+            )
+            product = cart_item.product
+            cart_item.delete()
+            cart.adjust_totals(lines=-1, quantity=-cart_item.quantity, price=-cart_item.quantity * product.price)
+            refresh_hold(cart, product)
         return True
-    except CartItem.DoesNotExist:
+    except (CartItem.DoesNotExist, ValueError):
         return False
 
 
+def apply_cart_operations(request, operations):
+    """Set the quantity of many cart lines in one transaction.
+
+    operations is an iterable of (product_id, size_code, quantity); quantity 0
+    removes the line and a positive quantity on a missing line adds it. Later
+    operations on the same line win. Products are locked in id order and stock
+    is checked per product from that one locking query; either every operation
+    applies or ValueError is raised and nothing changes.
+
+    Returns the cart lines that were set, keyed by (product_id, size_code);
+    removed lines map to None.
+    """
+    wanted = {}
+    for product_id, size_code, quantity in operations:
+        if quantity < 0:
+            raise ValueError("Quantity cannot be negative")
+        wanted[int(product_id), size_code or None] = quantity
+    if not wanted:
+        return {}
+
+    sizes = {size_code: resolve_size(size_code) for _, size_code in wanted if size_code}
+
+    # Validate against the existing cart; one is only created once everything passed
+    cart = get_cart(request)
+    product_ids = sorted({product_id for product_id, _ in wanted})
+    with transaction.atomic():
+        products = {
+            product.id: product
+            for product in Product.objects.select_for_update().filter(id__in=product_ids).order_by('id')
+        }
+        if len(products) != len(product_ids):
+            raise ValueError("Product not found")
+
+        product_sizes = allowed_size_ids_for(product_ids)
+        for product_id, size_code in wanted:
+            allowed = product_sizes.get(product_id)
+            if allowed and size_code is None:
+                raise ValueError(f'Please select a size for "{products[product_id].name}"')
+            if allowed and sizes[size_code].id not in allowed:
+                raise ValueError(f'Selected size is not available for "{products[product_id].name}"')
+
+        lines = {
+            (item.product_id, item.size.code if item.size else None): item
+            for item in cart.items.select_for_update().filter(product_id__in=product_ids).select_related('size')
+        } if cart is not None else {}
+
+        # Stock applies to the cart's quantity of a product over all its sizes
+        quantities = {}
+        for key, item in lines.items():
+            quantities[key[0]] = quantities.get(key[0], 0) + wanted.get(key, item.quantity)
+        for (product_id, size_code), quantity in wanted.items():
+            if (product_id, size_code) not in lines:
+                quantities[product_id] = quantities.get(product_id, 0) + quantity
+        held = held_by_other_carts(product_ids, cart) if holds_enabled() else {}
+        for product_id, quantity in quantities.items():
+            product = products[product_id]
+            available = product.stock - held.get(product_id, 0)
+            growing = any(
+                quantity_wanted > (lines[key].quantity if key in lines else 0)
+                for key, quantity_wanted in wanted.items() if key[0] == product_id
+            )
+            if growing and quantity > available:
+                raise ValueError(
+                    f'Insufficient stock for "{product.name}". Available: {max(available, 0)}, Requested: {quantity}'
+                )
+
+        if cart is None and any(wanted.values()):
+            cart = get_or_create_cart(request)
+
+        now = timezone.now()
+        removed, changed, created, result = [], [], [], {}
+        line_delta = quantity_delta = 0
+        price_delta = Decimal('0.00')
+        for key, quantity in wanted.items():
+            product_id, size_code = key
+            item = lines.get(key)
+            old_quantity = item.quantity if item else 0
+            if item is None and quantity:
+                item = CartItem(
+                    cart=cart, product=products[product_id],
+                    size=sizes[size_code] if size_code else None, quantity=quantity,
+                )
+                created.append(item)
+                line_delta += 1
+            elif item is not None and not quantity:
+                removed.append(item.id)
+                line_delta -= 1
+            elif item is not None and quantity != old_quantity:
+                item.quantity, item.updated_at = quantity, now
+                changed.append(item)
+            quantity_delta += quantity - old_quantity
+            price_delta += (quantity - old_quantity) * products[product_id].price
+            if item is not None:
+                item.product = products[product_id]
+            result[key] = item if quantity else None
+
+        if removed:
+            CartItem.objects.filter(id__in=removed).delete()
+        if changed:
+            CartItem.objects.bulk_update(changed, ['quantity', 'updated_at'])
+        if created:
+            CartItem.objects.bulk_create(created)
+        if removed or changed or created:
+            cart.adjust_totals(lines=line_delta, quantity=quantity_delta, price=price_delta)
+            refresh_holds(cart)
+    return result
+
+
 def get_cart_items(request):
     """Get all cart items for user/session"""
-    cart = get_or_create_cart(request)
+    cart = get_cart(request)
+    if cart is None:
+        return CartItem.objects.none()
     return cart.items.all().select_related('product')
 
 
 def get_cart_total(request):
     """Get cart total price and item count"""
-    cart = get_or_create_cart(request)
-    return {
-        'total_price': cart.total_price,
-        'total_items': cart.total_items,
-        'item_count': cart.items.count()
-    }
+    cart = get_cart(request)
+    if cart is None:
+        return {'total_price': Decimal('0.00'), 'total_items': 0, 'item_count': 0}
+    return cart.get_summary()
 
 
 def clear_cart(request):
     """Clear all items from cart"""
-    cart = get_or_create_cart(request)
-    cart.items.all().delete()
+    cart = get_cart(request)
+    if cart is not None:
+        cart.clear()
     return True
 
 
 def merge_carts(user, session_key):
-    """Merge guest cart with user cart when user logs in"""
+    """Merge guest cart with user cart when user logs in.
+
+    Lines are matched on (product, size). Stock caps the cart's quantity of a
+    product over all its sizes, as in apply_cart_operations: the user's own
+    lines are kept as they are (even above stock) and guest lines only add what
+    is left of each product's stock, oldest line first. Both carts are read
+    once and written with bulk statements, so the query count does not grow
+    with the cart.
+    """
     with transaction.atomic():
         try:
             # Get guest cart
             guest_cart = Cart.objects.select_for_update().get(session_key=session_key, user=None)
-            
-            # Get or create user cart
-            user_cart, created = Cart.objects.get_or_create(user=user)
-            
-            # Merge items from guest cart to user cart
-            for guest_item in guest_cart.items.select_for_update().all():
-                try:
-                    # Check if user cart already has this product
-                    user_item = user_cart.items.select_for_update().get(product=guest_item.product)
-                    
-                    # Check stock before merging
-                    new_quantity = user_item.quantity + guest_item.quantity
-                    if new_quantity > guest_item.product.stock:
-                        # If stock insufficient, keep original user quantity
-                        continue
-                    
-                    user_item.quantity = new_quantity
-                    user_item.save()
-                except CartItem.DoesNotExist:
-                    # Create new item in user cart
-                    if guest_item.quantity <= guest_item.product.stock:
-                        CartItem.objects.create(
-                            cart=user_cart,
-                            product=guest_item.product,
-                            quantity=guest_item.quantity
-                        )
-            
-            # Delete guest cart
-            guest_cart.delete()
-            
-            return user_cart
-            
         except Cart.DoesNotExist:
             # No guest cart exists
             user_cart, created = Cart.objects.get_or_create(user=user)
             return user_cart
 
+        # Get or create user cart
+        user_cart, created = Cart.objects.get_or_create(user=user)
+
+        guest_lines = list(guest_cart.items.select_for_update().order_by('id'))
+        product_ids = {line.product_id for line in guest_lines}
+        stock = dict(
+            Product.objects.select_for_update().filter(id__in=product_ids).order_by('id').values_list('id', 'stock')
+        )
+        user_lines = {
+            (line.product_id, line.size_id): line
+            for line in user_cart.items.select_for_update().filter(product_id__in=product_ids)
+        }
+
+        # What each product's stock still allows on top of the user's own lines
+        allowance = dict(stock)
+        for line in user_lines.values():
+            allowance[line.product_id] -= line.quantity
+
+        now = timezone.now()
+        changed, moved, capped = [], [], []
+        for line in guest_lines:
+            quantity = min(line.quantity, max(allowance.get(line.product_id, 0), 0))
+            if not quantity:
+                continue
+            allowance[line.product_id] -= quantity
+            user_line = user_lines.get((line.product_id, line.size_id))
+            if user_line is not None:
+                user_line.quantity += quantity
+                user_line.updated_at = now
+                changed.append(user_line)
+            elif quantity == line.quantity:
+                moved.append(line.id)
+            else:
+                line.cart, line.quantity, line.updated_at = user_cart, quantity, now
+                capped.append(line)
+
+        if changed:
+            CartItem.objects.bulk_update(changed, ['quantity', 'updated_at'])
+        if moved:
+            # Lines moving over whole need no per-row values
+            CartItem.objects.filter(id__in=moved).update(cart=user_cart, updated_at=now)
+        if capped:
+            CartItem.objects.bulk_update(capped, ['cart', 'quantity', 'updated_at'])
+
+        # Delete guest cart (remaining lines and its stock holds go with it)
+        guest_cart.delete()
+
+        user_cart.recalculate_totals()
+        refresh_holds(user_cart)
+        return user_cart
+
+
+def get_cart_count(request):
+    """Total units in the cart read from the cached totals (no cart is created)"""
+    cart = get_cart(request)
+    return cart.total_quantity if cart is not None else 0
+
+
+def sync_personalization_cart_totals(personalization, old_quantity):
+    """Apply a personalization's in-cart quantity change to its owner's cached cart totals.
+
+    old_quantity is the quantity that was counted in the cart before the change
+    (0 if the request was not in the cart).
+    """
+    new_quantity = personalization.cart_quantity if personalization.status == 'order_accepted' else 0
+    if new_quantity == old_quantity:
+        return
+    cart, _ = Cart.objects.get_or_create(user_id=personalization.user_id)
+    delta = new_quantity - old_quantity
+    cart.adjust_totals(
+        lines=int(new_quantity > 0) - int(old_quantity > 0),
+        quantity=delta,
+        price=delta * personalization.product.price,
+    )
+
+
+# Cached Cart columns maintained by the functions above
+CART_TOTAL_FIELDS = ('item_count', 'total_quantity', 'total_price')
+
+
+def expected_cart_totals(carts):
+    """{cart_id: totals} recomputed for a batch of carts with two grouped aggregates"""
+    price_field = DecimalField(max_digits=12, decimal_places=2)
+    line_totals = {
+        row['cart_id']: row
+        for row in CartItem.objects.filter(cart__in=carts).values('cart_id').annotate(
+            item_count=Count('id'),
+            total_quantity=Sum('quantity'),
+            total_price=Sum(F('quantity') * F('product__price'), output_field=price_field),
+        )
+    }
+    user_ids = [cart.user_id for cart in carts if cart.user_id]
+    personalized_totals = {
+        row['user_id']: row
+        for row in PersonalizationRequest.objects.filter(
+            user_id__in=user_ids,
+            status='order_accepted',
+            cart_quantity__gt=0
+        ).values('user_id').annotate(
+            item_count=Count('id'),
+            total_quantity=Sum('cart_quantity'),
+            total_price=Sum(F('cart_quantity') * F('product__price'), output_field=price_field),
+        )
+    }
+
+    empty = {'item_count': 0, 'total_quantity': 0, 'total_price': Decimal('0.00')}
+    totals = {}
+    for cart in carts:
+        lines = line_totals.get(cart.id, empty)
+        personalized = personalized_totals.get(cart.user_id, empty) if cart.user_id else empty
+        totals[cart.id] = {
+            field: (lines[field] or 0) + (personalized[field] or 0)
+            for field in CART_TOTAL_FIELDS
+        }
+        totals[cart.id]['total_price'] = quantize_price(totals[cart.id]['total_price'])
+    return totals
+
+
+def carts_holding_products(product_ids):
+    """Carts whose cached totals include any of the products (lines or in-cart personalizations)"""
+    user_ids = PersonalizationRequest.objects.filter(
+        product_id__in=product_ids, status='order_accepted', cart_quantity__gt=0
+    ).values('user_id')
+    return Cart.objects.filter(Q(items__product_id__in=product_ids) | Q(user_id__in=user_ids)).distinct()
+
+
+def recalculate_carts(carts):
+    """Rewrite the cached totals of carts that drifted; returns the carts that changed"""
+    carts = list(carts)
+    if not carts:
+        return []
+    expected = expected_cart_totals(carts)
+    stale = []
+    for cart in carts:
+        if expected[cart.id] != {field: getattr(cart, field) for field in CART_TOTAL_FIELDS}:
+            for field, value in expected[cart.id].items():
+                setattr(cart, field, value)
+            stale.append(cart)
+    if stale:
+        Cart.objects.bulk_update(stale, CART_TOTAL_FIELDS)
+    return stale
+
 
 def calculate_delivery_charges(order_total):
     """
@@ -233,3 +531,67 @@ def calculate_delivery_charges(order_total):
             'is_free_delivery': False,
             'free_delivery_threshold': FREE_DELIVERY_THRESHOLD
         }
+
+
+class CartSnapshot:
+    """Cart lines and the user's active personalizations, loaded once.
+
+    Loads everything in a fixed number of queries (cart, cart lines with their
+    products and sizes, personalization requests with their products) and
+    derives the regular, personalized and combined totals from those rows.
+    """
+
+    def __init__(self, cart, items, personalization_requests):
+        self.cart = cart
+        self.items = items
+        self.personalization_requests = personalization_requests
+        self.personalized_items = [req for req in personalization_requests if req.is_in_cart]
+
+    @classmethod
+    def for_request(cls, request, create=False):
+        """Snapshot of the visitor's cart; without a cart (and create=False) it is empty"""
+        cart = get_or_create_cart(request) if create else get_cart(request)
+        items = list(cart.items.select_related('product', 'size')) if cart is not None else []
+        personalization_requests = []
+        if request.user.is_authenticated:
+            personalization_requests = list(
+                PersonalizationRequest.objects.filter(
+                    user=request.user,
+                    status__in=ACTIVE_PERSONALIZATION_STATUSES
+                ).select_related('product', 'size').order_by('-created_at')
+            )
+        return cls(cart, items, personalization_requests)
+
+    @property
+    def regular_total(self):
+        """Totals for regular cart lines, same shape as get_cart_total()"""
+        return {
+            'total_price': sum((item.total_price for item in self.items), Decimal('0.00')),
+            'total_items': sum(item.quantity for item in self.items),
+            'item_count': len(self.items),
+        }
+
+    @property
+    def personalization_total(self):
+        return sum((req.cart_total_price for req in self.personalized_items), Decimal('0.00'))
+
+    @property
+    def total(self):
+        """Combined totals for regular lines and personalized items in the cart"""
+        regular = self.regular_total
+        return {
+            'total_price': regular['total_price'] + self.personalization_total,
+            'total_items': regular['total_items'] + sum(req.cart_quantity for req in self.personalized_items),
+            'item_count': regular['item_count'] + len(self.personalized_items),
+        }
+
+    @property
+    def delivery_info(self):
+        return calculate_delivery_charges(self.total['total_price'])
+
+    def as_json(self):
+        """Combined totals in the shape the cart AJAX endpoints return"""
+        total = self.total
+        total['total_price'] = float(total['total_price'])
+        return total
+
@@ -5,53 +5,28 @@ from django.views.decorators.csrf import csrf_exempt
 from django.contrib.auth.decorators import login_required
 from django.utils.decorators import method_decorator
 from django.views import View
-from decimal import Decimal
 import json
 
-from .models import Product, Cart, CartItem, PersonalizationRequest
+from .holds import held_by_other_carts, holds_enabled
+from .models import Cart, CartItem, PersonalizationRequest
 from .cart_utils import (
-    get_or_create_cart, add_to_cart, update_cart_item, 
-    remove_from_cart, get_cart_items, get_cart_total, clear_cart,
-    calculate_delivery_charges
+    get_cart, add_to_cart, update_cart_item, 
+    remove_from_cart, apply_cart_operations, get_cart_items, get_cart_total, clear_cart,
+    get_cart_count, CartSnapshot
 )
 
 
 def cart_page(request):
     """Display cart page with all items"""
-    cart_items = get_cart_items(request)
-    cart_total = get_cart_total(request)
-    
-    # Get personalization requests for the user
-    personalization_requests = []
-    personalization_cart_total = Decimal('0.00')
-    if request.user.is_authenticated:
-        personalization_requests = PersonalizationRequest.objects.filter(
-            user=request.user,
-            status__in=['pending', 'admin_approved', 'user_approved', 'order_accepted']
-        ).select_related('product').order_by('-created_at')
-        
-        # Calculate total for personalized items in cart
-        for req in personalization_requests:
-            if req.is_in_cart:
-                personalization_cart_total += req.cart_total_price
-    
-    # Calculate combined totals
-    combined_cart_total = {
-        'total_price': cart_total['total_price'] + personalization_cart_total,
-        'total_items': cart_total['total_items'] + sum(req.cart_quantity for req in personalization_requests if req.is_in_cart),
-        'item_count': cart_total['item_count'] + sum(1 for req in personalization_requests if req.is_in_cart)
-    }
-    
-    # Calculate delivery charges for display
-    delivery_info = calculate_delivery_charges(combined_cart_total['total_price'])
+    snapshot = CartSnapshot.for_request(request)
     
     context = {
-        'cart_items': cart_items,
-        'cart_total': combined_cart_total,
-        'regular_cart_total': cart_total,
-        'personalization_cart_total': personalization_cart_total,
-        'personalization_requests': personalization_requests,
-        'delivery_info': delivery_info,
+        'cart_items': snapshot.items,
+        'cart_total': snapshot.total,
+        'regular_cart_total': snapshot.regular_total,
+        'personalization_cart_total': snapshot.personalization_total,
+        'personalization_requests': snapshot.personalization_requests,
+        'delivery_info': snapshot.delivery_info,
     }
     return render(request, 'store/cart.html', context)
 
@@ -72,14 +47,8 @@ def add_to_cart_ajax(request):
         if quantity <= 0:
             return JsonResponse({'success': False, 'error': 'Quantity must be positive'})
         
-        # Check if product exists and is in stock
-        try:
-            product = Product.objects.get(id=product_id)
-            if product.stock <= 0:
-                return JsonResponse({'success': False, 'error': f'Product "{product.name}" is out of stock'})
-        except Product.DoesNotExist:
-            return JsonResponse({'success': False, 'error': 'Product not found'})
-        
+        # add_to_cart reads the product once under lock and reports a missing
+        # or out-of-stock product as ValueError
         cart_item = add_to_cart(request, product_id, quantity, size_code)
         cart_total = get_cart_total(request)
         
@@ -121,18 +90,7 @@ def update_cart_ajax(request):
         if quantity < 0:
             return JsonResponse({'success': False, 'error': 'Quantity cannot be negative'})
         
-        # Check if product exists when quantity > 0
-        if quantity > 0:
-            try:
-                product = Product.objects.get(id=product_id)
-                if quantity > product.stock:
-                    return JsonResponse({
-                        'success': False, 
-                        'error': f'Insufficient stock. Available: {product.stock}'
-                    })
-            except Product.DoesNotExist:
-                return JsonResponse({'success': False, 'error': 'Product not found'})
-        
+        # Stock and product checks happen under the product lock in update_cart_item
         cart_item = update_cart_item(request, product_id, quantity, size_code)
         cart_total = get_cart_total(request)
         
@@ -194,6 +152,66 @@ def remove_from_cart_ajax(request):
         return JsonResponse({'success': False, 'error': f'An error occurred: {str(e)}'})
 
 
+# Most line operations accepted by one batch request
+CART_BATCH_MAX_OPERATIONS = 100
+
+
+@require_POST
+def batch_update_cart_ajax(request):
+    """Apply many line quantity changes at once via AJAX.
+
+    Expects {"operations": [{"product_id", "size", "quantity"}, ...]}; quantity 0
+    removes the line. All operations apply or none do, and totals are returned once.
+    """
+    try:
+        data = json.loads(request.body)
+        operations = data.get('operations')
+        if not isinstance(operations, list) or not operations:
+            return JsonResponse({'success': False, 'error': 'Operations required'}, status=400)
+        if len(operations) > CART_BATCH_MAX_OPERATIONS:
+            return JsonResponse({
+                'success': False,
+                'error': f'At most {CART_BATCH_MAX_OPERATIONS} operations per request'
+            }, status=400)
+
+        parsed = []
+        for operation in operations:
+            if not isinstance(operation, dict) or not operation.get('product_id'):
+                return JsonResponse({'success': False, 'error': 'Product ID required'}, status=400)
+            try:
+                parsed.append((int(operation['product_id']), operation.get('size') or None, int(operation.get('quantity', 0))))
+            except (KeyError, TypeError, ValueError):
+                return JsonResponse({'success': False, 'error': 'Invalid operation data'}, status=400)
+
+        lines = apply_cart_operations(request, parsed)
+        cart_total = get_cart_total(request)
+
+        return JsonResponse({
+            'success': True,
+            'message': 'Cart updated successfully',
+            'cart_total': cart_total,
+            'items': [
+                {
+                    'id': item.id if item else None,
+                    'product_id': product_id,
+                    'quantity': item.quantity if item else 0,
+                    'total_price': float(item.total_price) if item else 0.0,
+                    'size': size_code,
+                    'item_removed': item is None,
+                }
+                for (product_id, size_code), item in lines.items()
+            ]
+        })
+
+    except json.JSONDecodeError:
+        return JsonResponse({'success': False, 'error': 'Invalid JSON data'}, status=400)
+    except ValueError as e:
+        # Validation messages raised by apply_cart_operations
+        return JsonResponse({'success': False, 'error': str(e)})
+    except Exception as e:
+        return JsonResponse({'success': False, 'error': f'An error occurred: {str(e)}'})
+
+
 def get_cart_data_ajax(request):
     """Get cart data for AJAX requests"""
     try:
@@ -274,23 +292,10 @@ def clear_cart_ajax(request):
 def cart_count(request):
     """Get cart item count for navbar badge"""
     try:
-        cart_total = get_cart_total(request)
-        
-        # Add personalized items to cart count
-        personalized_count = 0
-        if request.user.is_authenticated:
-            personalized_requests = PersonalizationRequest.objects.filter(
-                user=request.user,
-                status='order_accepted',
-                cart_quantity__gt=0
-            )
-            personalized_count = sum(req.cart_quantity for req in personalized_requests)
-        
-        total_count = cart_total['total_items'] + personalized_count
-        
+        # Cached totals already include personalized items in the cart
         return JsonResponse({
             'success': True,
-            'count': total_count
+            'count': get_cart_count(request)
         })
     except Exception as e:
         return JsonResponse({'success': False, 'error': str(e)})
@@ -299,16 +304,20 @@ def cart_count(request):
 def validate_cart_stock(request):
     """Validate stock availability for all cart items"""
     try:
-        cart_items = get_cart_items(request)
+        cart = get_cart(request)
+        cart_items = list(cart.items.select_related('product')) if cart is not None else []
+        # Other carts' active holds are not available to this cart
+        held = held_by_other_carts({item.product_id for item in cart_items}, cart) if holds_enabled() else {}
         stock_issues = []
         
         for item in cart_items:
-            if item.quantity > item.product.stock:
+            available = max(item.product.stock - held.get(item.product_id, 0), 0)
+            if item.quantity > available:
                 stock_issues.append({
                     'product_id': item.product.id,
                     'product_name': item.product.name,
                     'requested': item.quantity,
-                    'available': item.product.stock
+                    'available': available
                 })
         
         return JsonResponse({
@@ -0,0 +1,72 @@
+import time
+
+from django.core.cache import cache
+
+# Version counters stored in the cache. Cached catalog data includes the current
+# version in its key (or checks it before use), so bumping a counter
+# invalidates everything derived from it at once.
+CATALOG_VERSION_KEY = 'store:catalog_version'
+CATEGORY_TREE_VERSION_KEY = 'store:category_tree_version'
+PRODUCT_PAGE_VERSION_KEY = 'store:product_page_version'
+SIZE_REGISTRY_VERSION_KEY = 'store:size_registry_version'
+
+
+def _initial_version():
+    # Start from the clock rather than 1 so a counter lost to eviction or a cache
+    # flush never repeats a version that in-process data was built against
+    return int(time.time() * 1000)
+
+
+def _get_version(key):
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, _initial_version(), timeout=None)
+        version = cache.get(key)
+    return version
+
+
+def _bump_version(key):
+    try:
+        return cache.incr(key)
+    except ValueError:
+        # Key missing (evicted or never set): start a fresh version
+        version = _initial_version()
+        cache.set(key, version, timeout=None)
+        return version
+
+
+def get_catalog_version():
+    """Current catalog version (initialised from the clock on first use)"""
+    return _get_version(CATALOG_VERSION_KEY)
+
+
+def bump_catalog_version():
+    """Invalidate every catalog fragment keyed by the version counter"""
+    return _bump_version(CATALOG_VERSION_KEY)
+
+
+def get_category_tree_version():
+    return _get_version(CATEGORY_TREE_VERSION_KEY)
+
+
+def bump_category_tree_version():
+    """Force every process to rebuild its in-memory category tree"""
+    return _bump_version(CATEGORY_TREE_VERSION_KEY)
+
+
+def get_product_page_version():
+    return _get_version(PRODUCT_PAGE_VERSION_KEY)
+
+
+def bump_product_page_version():
+    """Invalidate every cached product page (category or size changes)"""
+    return _bump_version(PRODUCT_PAGE_VERSION_KEY)
+
+
+def get_size_registry_version():
+    return _get_version(SIZE_REGISTRY_VERSION_KEY)
+
+
+def bump_size_registry_version():
+    """Force every process to reload its in-memory size registry"""
+    return _bump_version(SIZE_REGISTRY_VERSION_KEY)
@@ -0,0 +1,79 @@
+from collections import namedtuple
+
+from .catalog import get_category_tree_version
+
+CategoryNode = namedtuple('CategoryNode', ['id', 'name', 'parent_id'])
+
+
+class CategoryTree:
+    """Whole category hierarchy precomputed from one query.
+
+    Children, ancestors and descendants are resolved at build time, so
+    lookups are dictionary reads instead of per-node queries.
+    """
+
+    def __init__(self, rows):
+        self.nodes = {row[0]: CategoryNode(*row) for row in rows}
+        self._children = {node_id: [] for node_id in self.nodes}
+        self.roots = []
+        for node in sorted(self.nodes.values(), key=lambda node: (node.name.lower(), node.id)):
+            if node.parent_id in self._children:
+                self._children[node.parent_id].append(node)
+            else:
+                self.roots.append(node)
+
+        self._ancestors = {}
+        self._descendant_ids = {}
+        for root in self.roots:
+            self._walk(root, ())
+
+    def _walk(self, node, ancestors):
+        self._ancestors[node.id] = ancestors
+        descendant_ids = set()
+        for child in self._children[node.id]:
+            descendant_ids.add(child.id)
+            descendant_ids |= self._walk(child, ancestors + (node,))
+        self._descendant_ids[node.id] = frozenset(descendant_ids)
+        return descendant_ids
+
+    @classmethod
+    def load(cls):
+        from .models import Category
+        return cls(Category.objects.values_list('id', 'name', 'parent_id'))
+
+    def children(self, category_id):
+        return list(self._children.get(category_id, ()))
+
+    def has_children(self, category_id):
+        return bool(self._children.get(category_id))
+
+    def descendant_ids(self, category_id, include_self=False):
+        ids = set(self._descendant_ids.get(category_id, ()))
+        if include_self:
+            ids.add(category_id)
+        return ids
+
+    def breadcrumb(self, category_id):
+        """Nodes from the root down to (and including) the category"""
+        node = self.nodes.get(category_id)
+        if node is None:
+            return []
+        return list(self._ancestors.get(category_id, ())) + [node]
+
+    def label(self, category_id, separator=' › '):
+        """Hierarchical label such as "Parent › Child" """
+        return separator.join(node.name for node in self.breadcrumb(category_id))
+
+
+_tree = None
+_tree_version = None
+
+
+def get_category_tree():
+    """Process-wide category tree, rebuilt when a category changes anywhere"""
+    global _tree, _tree_version
+    version = get_category_tree_version()
+    if _tree is None or _tree_version != version:
+        _tree = CategoryTree.load()
+        _tree_version = version
+    return _tree
@@ -0,0 +1,111 @@
+"""Server-side facet filters for product listings.
+
+Facet counts for a listing are computed with two aggregate queries (one for
+price bands, customizable and in-stock, one grouped by size) and cached under
+the catalog version, so any product write invalidates them.
+"""
+import hashlib
+from decimal import Decimal
+
+from django.core.cache import cache
+from django.db.models import Count, Q
+
+from .catalog import get_catalog_version
+from .models import Product
+
+FACET_CACHE_TIMEOUT = 86400
+
+# (key, label, lower bound inclusive, upper bound exclusive)
+PRICE_BUCKETS = (
+    ('under-300', 'Under ₹300', None, Decimal('300')),
+    ('300-600', '₹300 – ₹600', Decimal('300'), Decimal('600')),
+    ('600-1000', '₹600 – ₹1000', Decimal('600'), Decimal('1000')),
+    ('1000-plus', '₹1000 & above', Decimal('1000'), None),
+)
+
+
+def price_bucket_q(low, high):
+    condition = Q()
+    if low is not None:
+        condition &= Q(price__gte=low)
+    if high is not None:
+        condition &= Q(price__lt=high)
+    return condition
+
+
+def parse_filters(request):
+    """Selected facets from the query string; unknown values are ignored"""
+    bucket_keys = {bucket[0] for bucket in PRICE_BUCKETS}
+    return {
+        'price': [key for key in request.GET.getlist('price') if key in bucket_keys],
+        'size': request.GET.getlist('size'),
+        'customizable': request.GET.get('customizable') == '1',
+        'in_stock': request.GET.get('in_stock') == '1',
+    }
+
+
+def has_active_filters(filters):
+    return any(filters.values())
+
+
+def apply_filters(products, filters):
+    """Narrow a product queryset to the selected facets.
+
+    Values within a facet are OR-ed, facets are AND-ed together.
+    """
+    if filters['price']:
+        condition = Q()
+        for key, label, low, high in PRICE_BUCKETS:
+            if key in filters['price']:
+                condition |= price_bucket_q(low, high)
+        products = products.filter(condition)
+    if filters['size']:
+        # Subquery instead of a join so products with several sizes are not duplicated
+        products = products.filter(id__in=Product.sizes.through.objects.filter(
+            size__code__in=filters['size']
+        ).values('product_id'))
+    if filters['customizable']:
+        products = products.filter(can_customize=True)
+    if filters['in_stock']:
+        products = products.filter(stock__gt=0)
+    return products
+
+
+def compute_facet_counts(products):
+    aggregates = {
+        'total': Count('id'),
+        'customizable': Count('id', filter=Q(can_customize=True)),
+        'in_stock': Count('id', filter=Q(stock__gt=0)),
+    }
+    for index, (key, label, low, high) in enumerate(PRICE_BUCKETS):
+        aggregates[f'price_{index}'] = Count('id', filter=price_bucket_q(low, high))
+    totals = products.order_by().aggregate(**aggregates)
+
+    sizes = Product.sizes.through.objects.filter(
+        product_id__in=products.order_by().values('id')
+    ).values('size__code').annotate(count=Count('product_id')).order_by('size__display_order', 'size__code')
+
+    return {
+        'total': totals['total'],
+        'customizable': totals['customizable'],
+        'in_stock': totals['in_stock'],
+        'price': [
+            {'key': key, 'label': label, 'count': totals[f'price_{index}']}
+            for index, (key, label, low, high) in enumerate(PRICE_BUCKETS)
+        ],
+        'sizes': [{'code': row['size__code'], 'count': row['count']} for row in sizes],
+    }
+
+
+def get_facet_counts(scope, products):
+    """Facet counts for an unfiltered listing, cached per scope and catalog version.
+
+    scope identifies the listing (e.g. "category:12"); products is its base queryset.
+    """
+    scope_hash = hashlib.md5(scope.encode()).hexdigest()
+    key = f'store:facets:{scope_hash}:{get_catalog_version()}'
+    counts = cache.get(key)
+    if counts is None:
+        counts = compute_facet_counts(products)
+        cache.set(key, counts, FACET_CACHE_TIMEOUT)
+    return counts
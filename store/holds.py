@@ -0,0 +1,80 @@
+"""Time-boxed stock holds.
+
+With settings.STOCK_HOLDS_ENABLED, every cart mutation holds the cart's
+quantity of a product for STOCK_HOLD_SECONDS. Other carts (and checkouts)
+only see stock minus the active holds of other carts, so a shopper who got an
+item into the cart can still buy it during a rush. Expired holds stop counting
+immediately and are deleted by the sweep_stock_holds command.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Sum
+from django.utils import timezone
+
+from .models import StockHold
+
+
+def holds_enabled():
+    return getattr(settings, 'STOCK_HOLDS_ENABLED', False)
+
+
+def hold_duration():
+    return timedelta(seconds=getattr(settings, 'STOCK_HOLD_SECONDS', 15 * 60))
+
+
+def held_by_other_carts(product_ids, cart=None):
+    """{product_id: quantity} held by active holds of carts other than cart"""
+    holds = StockHold.objects.filter(product_id__in=product_ids, expires_at__gt=timezone.now())
+    if cart is not None:
+        holds = holds.exclude(cart=cart)
+    return dict(holds.values('product_id').annotate(held=Sum('quantity')).values_list('product_id', 'held'))
+
+
+def available_stock(product, cart=None):
+    """Stock the cart can still take: stock minus other carts' active holds"""
+    if not holds_enabled():
+        return product.stock
+    return product.stock - held_by_other_carts([product.id], cart).get(product.id, 0)
+
+
+def refresh_hold(cart, product):
+    """Hold the cart's current quantity of product (all sizes) for another hold period"""
+    if not holds_enabled():
+        return
+    quantity = cart.items.filter(product=product).aggregate(total=Sum('quantity'))['total'] or 0
+    if quantity:
+        StockHold.objects.update_or_create(
+            cart=cart,
+            product=product,
+            defaults={'quantity': quantity, 'expires_at': timezone.now() + hold_duration()},
+        )
+    else:
+        StockHold.objects.filter(cart=cart, product=product).delete()
+
+
+def refresh_holds(cart):
+    """refresh_hold() for every product of the cart at once (e.g. after merging carts)"""
+    if not holds_enabled():
+        return
+    quantities = cart.items.values('product_id').annotate(total=Sum('quantity')).values_list('product_id', 'total')
+    expires_at = timezone.now() + hold_duration()
+    with transaction.atomic():
+        cart.stock_holds.all().delete()
+        StockHold.objects.bulk_create([
+            StockHold(cart=cart, product_id=product_id, quantity=total, expires_at=expires_at)
+            for product_id, total in quantities
+        ])
+
+
+def sweep_expired_holds(batch_size=1000):
+    """Delete expired holds in batches; returns the number deleted"""
+    deleted = 0
+    while True:
+        batch = list(
+            StockHold.objects.filter(expires_at__lte=timezone.now()).values_list('id', flat=True)[:batch_size]
+        )
+        if not batch:
+            return deleted
+        deleted += StockHold.objects.filter(id__in=batch).delete()[0]
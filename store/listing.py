@@ -0,0 +1,63 @@
+"""Lightweight product rows for large listings.
+
+Listings such as category_page only need a handful of columns per product plus
+its size codes. Fetching them with values_list() and aggregating the size codes
+in the same query avoids building a model instance per product and per size.
+"""
+from django.db.models import Aggregate, CharField
+
+from .models import Product, Size
+
+# Canonical size order (S, M, L, XL, XXL) used to sort aggregated codes
+SIZE_ORDER = {code: index for index, (code, label) in enumerate(Size.CODE_CHOICES)}
+
+ROW_FIELDS = ('id', 'name', 'description', 'price', 'image')
+
+
+class GroupConcat(Aggregate):
+    """Comma separated values per group: GROUP_CONCAT (SQLite/MySQL) or STRING_AGG (PostgreSQL)"""
+    function = 'GROUP_CONCAT'
+    template = '%(function)s(%(distinct)s%(expressions)s)'
+    allow_distinct = True
+    output_field = CharField()
+
+    def as_postgresql(self, compiler, connection, **extra_context):
+        return self.as_sql(
+            compiler, connection,
+            function='STRING_AGG',
+            template="%(function)s(%(distinct)s%(expressions)s::text, ',')",
+            **extra_context,
+        )
+
+
+class ProductRow:
+    """Read-only product listing row"""
+    __slots__ = ('id', 'name', 'description', 'price', 'image', 'size_codes')
+
+    image_storage = Product._meta.get_field('image').storage
+
+    def __init__(self, id, name, description, price, image, size_codes):
+        self.id = id
+        self.name = name
+        self.description = description
+        self.price = price
+        self.image = image
+        self.size_codes = size_codes
+
+    @property
+    def image_url(self):
+        return self.image_storage.url(self.image) if self.image else ''
+
+
+def iter_product_rows(products, chunk_size=2000):
+    """Yield a ProductRow per product of the queryset, in id order, from a single query"""
+    rows = products.order_by('id').annotate(
+        size_code_list=GroupConcat('sizes__code'),
+    ).values_list(*ROW_FIELDS, 'size_code_list')
+    for *fields, size_code_list in rows.iterator(chunk_size=chunk_size):
+        size_codes = sorted(size_code_list.split(','), key=size_sort_key) if size_code_list else []
+        yield ProductRow(*fields, size_codes)
+
+
+def size_sort_key(code):
+    return SIZE_ORDER.get(code, len(SIZE_ORDER)), code
@@ -0,0 +1,460 @@
+import time
+import tracemalloc
+from decimal import Decimal
+
+from django.contrib.auth.models import User
+from django.core.mail import get_connection
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Q
+from django.template.loader import render_to_string
+from django.utils.html import strip_tags
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+
+from accounts.email_rendering import render_email_parts, render_many
+from accounts.email_utils import render_order_status_update_email, send_mass_email, send_order_status_update_email
+from accounts.models import OutboxEmail
+from accounts.outbox import build_message, process_outbox
+from store import search, views
+from store.listing import iter_product_rows
+from store.models import Cart, CartItem, Category, Order, OrderItem, Product, Size
+from store.cart_utils import merge_carts
+from store.orders import place_order
+
+
+class Command(BaseCommand):
+    help = 'Run performance benchmarks against synthetic data (all writes are rolled back)'
+
+    scenarios = {
+        'cart-summary': 'bench_cart_summary',
+        'catalog-pages': 'bench_catalog_pages',
+        'search': 'bench_search',
+        'category-listing': 'bench_category_listing',
+        'checkout': 'bench_checkout',
+        'admin-email': 'bench_admin_email',
+        'email-render': 'bench_email_render',
+        'merge-carts': 'bench_merge_carts',
+    }
+
+    def add_arguments(self, parser):
+        parser.add_argument('scenario', choices=sorted(self.scenarios), help='Benchmark to run')
+        parser.add_argument('--repeat', type=int, default=5, help='Timed runs per measurement')
+        parser.add_argument('--products', type=int, action='append',
+                            help='Synthetic catalog size (repeatable, scenario specific default)')
+        parser.add_argument('--smtp-port', type=int, default=8025,
+                            help='admin-email: local SMTP stub port (started in-process if aiosmtpd is installed)')
+
+    def handle(self, *args, **options):
+        self.repeat = max(1, options['repeat'])
+        bench = getattr(self, self.scenarios[options['scenario']])
+
+        # Everything a benchmark creates lives inside this transaction and is discarded
+        with transaction.atomic():
+            bench(**options)
+            transaction.set_rollback(True)
+
+    # Helpers
+
+    def measure(self, func):
+        """Return (best wall time in ms, query count) for func()"""
+        with CaptureQueriesContext(connection) as ctx:
+            func()
+        queries = len(ctx.captured_queries)
+
+        best = None
+        for _ in range(self.repeat):
+            start = time.perf_counter()
+            func()
+            elapsed = (time.perf_counter() - start) * 1000
+            best = elapsed if best is None else min(best, elapsed)
+        return best, queries
+
+    def latencies(self, func, runs):
+        """Per-call wall times in ms, sorted, for percentile reporting"""
+        timings = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            func()
+            timings.append((time.perf_counter() - start) * 1000)
+        return sorted(timings)
+
+    def make_products(self, count, category=None, **fields):
+        category = category or Category.objects.create(name='Benchmark')
+        Product.objects.bulk_create(
+            [
+                Product(
+                    name=f'Benchmark Product {i}',
+                    category=category,
+                    price=Decimal('100.00') + i % 50,
+                    stock=1000,
+                    **fields,
+                )
+                for i in range(count)
+            ],
+            batch_size=1000,
+        )
+        return list(Product.objects.filter(category=category).order_by('id'))
+
+    # Scenarios
+
+    def bench_cart_summary(self, **options):
+        user = User.objects.create_user(username='benchmark_cart_user')
+        cart = Cart.objects.create(user=user)
+        products = self.make_products(200)
+
+        def legacy():
+            items = list(cart.items.all())
+            return {
+                'total_price': sum(item.total_price for item in items),
+                'total_items': sum(item.quantity for item in items),
+                'item_count': cart.items.count(),
+            }
+
+        self.stdout.write(f"{'lines':>6} {'legacy ms':>10} {'legacy q':>9} {'aggregate ms':>13} {'aggregate q':>12}")
+        added = 0
+        for lines in (1, 10, 50, 100, 200):
+            CartItem.objects.bulk_create(
+                [CartItem(cart=cart, product=product, quantity=2) for product in products[added:lines]]
+            )
+            added = lines
+            legacy_ms, legacy_queries = self.measure(legacy)
+            summary_ms, summary_queries = self.measure(cart.get_summary)
+            self.stdout.write(
+                f'{lines:>6} {legacy_ms:>10.2f} {legacy_queries:>9} {summary_ms:>13.2f} {summary_queries:>12}'
+            )
+
+    def bench_catalog_pages(self, **options):
+        factory = RequestFactory()
+        category = Category.objects.create(name='Benchmark')
+        created = 0
+
+        def full_render():
+            products = Product.objects.select_related('category').order_by('-id')
+            return render_to_string('store/_product_cards.html', {'products': products})
+
+        def cursor_page(cursor=None):
+            params = {'format': 'json'}
+            if cursor:
+                params['cursor'] = cursor
+            return lambda: views.all_products(factory.get('/all-products/', params))
+
+        self.stdout.write(f"{'products':>9} {'full ms':>10} {'first page ms':>14} {'deep page ms':>13} {'page q':>7}")
+        for size in sorted(options['products'] or [10000, 100000]):
+            Product.objects.bulk_create(
+                [
+                    Product(name=f'Benchmark Product {i}', category=category, price=Decimal('100.00'), stock=10)
+                    for i in range(created, size)
+                ],
+                batch_size=1000,
+            )
+            created = size
+            # A cursor just above the oldest rows of the catalog
+            deep_cursor = Product.objects.order_by('id').values_list('id', flat=True)[views.ALL_PRODUCTS_PAGE_SIZE]
+
+            full_ms, _ = self.measure(full_render)
+            first_ms, page_queries = self.measure(cursor_page())
+            deep_ms, _ = self.measure(cursor_page(deep_cursor))
+            self.stdout.write(
+                f'{size:>9} {full_ms:>10.1f} {first_ms:>14.2f} {deep_ms:>13.2f} {page_queries:>7}'
+            )
+
+    def bench_search(self, **options):
+        words = ['cotton', 'oversize', 'polo', 'hoodie', 'mug', 'bottle', 'cap', 'printed', 'classic', 'sports']
+        categories = [Category.objects.create(name=name) for name in ('Shirts', 'Drinkware', 'Accessories')]
+        # Broad queries match a large share of the synthetic catalog; the last ones are selective or miss
+        queries = [
+            ('classic polo', False), ('cotton', False), ('hoo', True),
+            ('number 4242', False), ('zebra', False), ('zeb', True),
+        ]
+        runs = max(20, self.repeat * 20)
+        created = 0
+
+        def legacy(query):
+            terms = search.parse_terms(query)
+            products = Product.objects.all()
+            for term in terms:
+                products = products.filter(Q(name__icontains=term) | Q(description__icontains=term))
+            return list(products.values_list('id', flat=True)[:20])
+
+        self.stdout.write(f"{'products':>9} {'query':>14} {'icontains p95':>14} {'index p50':>10} {'index p95':>10}")
+        for size in sorted(options['products'] or [10000, 100000]):
+            Product.objects.bulk_create(
+                [
+                    Product(
+                        name=f'{words[i % 10].title()} {words[(i // 10) % 10]} {i}',
+                        description=f'{words[(i * 7) % 10]} {words[(i * 3) % 10]} product number {i}',
+                        category=categories[i % 3],
+                        price=Decimal('100.00'),
+                        stock=10,
+                    )
+                    for i in range(created, size)
+                ],
+                batch_size=1000,
+            )
+            created = size
+            # bulk_create skips the indexing signals
+            search.rebuild_index()
+
+            for query, prefix in queries:
+                legacy_times = self.latencies(lambda: legacy(query), max(5, runs // 10))
+                index_times = self.latencies(lambda: search.search_products(query, prefix=prefix), runs)
+                self.stdout.write(
+                    f'{size:>9} {query:>14} {percentile(legacy_times, 95):>14.2f} '
+                    f'{percentile(index_times, 50):>10.2f} {percentile(index_times, 95):>10.2f}'
+                )
+
+    def bench_category_listing(self, **options):
+        sizes = [Size.objects.get_or_create(code=code)[0] for code in ('S', 'M', 'L', 'XL')]
+        category = Category.objects.create(name='Benchmark Listing')
+        created = 0
+
+        def legacy():
+            products = Product.objects.filter(category=category).prefetch_related('sizes')
+            return [{'product': product, 'available_sizes': list(product.sizes.all())} for product in products]
+
+        def rows():
+            return list(iter_product_rows(Product.objects.filter(category=category)))
+
+        def peak_kb(func):
+            tracemalloc.start()
+            func()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            return peak / 1024
+
+        self.stdout.write(
+            f"{'products':>9} {'legacy ms':>10} {'legacy q':>9} {'legacy KB':>10} "
+            f"{'rows ms':>8} {'rows q':>7} {'rows KB':>8}"
+        )
+        for size in sorted(options['products'] or [1000, 5000]):
+            products = self.make_products(size - created, category=category)[created:]
+            Product.sizes.through.objects.bulk_create(
+                [
+                    Product.sizes.through(product_id=product.id, size_id=size_obj.id)
+                    for index, product in enumerate(products)
+                    for size_obj in sizes[:index % 5]
+                ],
+                batch_size=1000,
+            )
+            created = size
+
+            legacy_ms, legacy_queries = self.measure(legacy)
+            rows_ms, rows_queries = self.measure(rows)
+            self.stdout.write(
+                f'{size:>9} {legacy_ms:>10.1f} {legacy_queries:>9} {peak_kb(legacy):>10.0f} '
+                f'{rows_ms:>8.1f} {rows_queries:>7} {peak_kb(rows):>8.0f}'
+            )
+
+    def bench_checkout(self, **options):
+        user = User.objects.create_user(username='benchmark_checkout_user')
+        cart = Cart.objects.create(user=user)
+        products = self.make_products(200)
+        Product.objects.filter(id__in=[product.id for product in products]).update(stock=10 ** 6)
+        order_fields = {
+            'user': user, 'full_name': 'Benchmark', 'address_line1': '1 Test Street',
+            'city': 'Pune', 'state': 'MH', 'postal_code': '411001', 'phone': '9999999999',
+        }
+
+        def legacy(items):
+            order = Order.objects.create(**order_fields)
+            for item in items:
+                OrderItem.objects.create(
+                    order=order, product=item.product, product_name=item.product.name,
+                    unit_price=item.product.price, quantity=item.quantity,
+                    line_total=item.total_price, size=item.size,
+                )
+                item.product.stock = max(0, item.product.stock - item.quantity)
+                item.product.save(update_fields=['stock'])
+            cart.clear()
+
+        def pipeline(items):
+            place_order(cart, items, **order_fields)
+
+        def timed(place, lines):
+            """Best time and query count of placing an order for a freshly filled cart"""
+            best, queries = None, None
+            for _ in range(self.repeat):
+                CartItem.objects.bulk_create([CartItem(cart=cart, product=p, quantity=1) for p in products[:lines]])
+                cart.recalculate_totals()
+                items = list(cart.items.select_related('product', 'size'))
+                with CaptureQueriesContext(connection) as ctx:
+                    start = time.perf_counter()
+                    place(items)
+                    elapsed = (time.perf_counter() - start) * 1000
+                best = elapsed if best is None else min(best, elapsed)
+                queries = len(ctx.captured_queries)
+            return best, queries
+
+        self.stdout.write(f"{'lines':>6} {'legacy ms':>10} {'legacy q':>9} {'pipeline ms':>12} {'pipeline q':>11}")
+        for lines in (1, 10, 50, 100, 200):
+            legacy_ms, legacy_queries = timed(legacy, lines)
+            pipeline_ms, pipeline_queries = timed(pipeline, lines)
+            self.stdout.write(
+                f'{lines:>6} {legacy_ms:>10.2f} {legacy_queries:>9} {pipeline_ms:>12.2f} {pipeline_queries:>11}'
+            )
+
+    def bench_admin_email(self, **options):
+        count = 500
+        status_message = 'Your UPI payment has been verified and your order is now being processed!'
+        users = User.objects.bulk_create([
+            User(username=f'benchmark_email_{i}', email=f'benchmark{i}@example.com') for i in range(count)
+        ])
+        Order.objects.bulk_create([
+            Order(user=user, full_name='Benchmark', address_line1='1 Test Street', city='Pune', state='MH',
+                  postal_code='411001', phone='9999999999', payment_method='upi', status='pending')
+            for user in users
+        ])
+        orders = list(Order.objects.filter(user__in=users).select_related('user'))
+
+        def per_order():
+            for order in orders:
+                send_order_status_update_email(order, status_message)
+
+        def batched():
+            send_mass_email([render_order_status_update_email(order, status_message) for order in orders])
+
+        self.stdout.write(f'Queueing {count} order status emails (admin action)')
+        self.stdout.write(f"{'mode':>10} {'ms':>10} {'queries':>8}")
+        for mode, func in (('per-order', per_order), ('batched', batched)):
+            elapsed, queries = self.measure(func)
+            self.stdout.write(f'{mode:>10} {elapsed:>10.1f} {queries:>8}')
+
+        try:
+            from aiosmtpd.controller import Controller
+        except ImportError:
+            Controller = None
+
+        class Sink:
+            async def handle_DATA(self, server, session, envelope):
+                return '250 OK'
+
+        backend = {
+            'backend': 'django.core.mail.backends.smtp.EmailBackend',
+            'host': '127.0.0.1',
+            'port': options['smtp_port'],
+        }
+        controller = None
+        if Controller is not None:
+            controller = Controller(Sink(), hostname='127.0.0.1', port=options['smtp_port'])
+            controller.start()
+        else:
+            self.stdout.write(self.style.WARNING(
+                f"aiosmtpd is not installed; expecting an SMTP stub on 127.0.0.1:{options['smtp_port']} "
+                f"(e.g. python -m aiosmtpd -n -l 127.0.0.1:{options['smtp_port']})"
+            ))
+
+        def requeue():
+            OutboxEmail.objects.all().delete()
+            batched()
+
+        def connection_per_email():
+            for email in OutboxEmail.objects.all():
+                build_message(email, get_connection(**backend)).send()
+
+        def shared_connection():
+            process_outbox(batch_size=count, connection=get_connection(**backend))
+
+        self.stdout.write(f'Delivering {count} emails to the SMTP stub')
+        self.stdout.write(f"{'mode':>16} {'ms':>10}")
+        try:
+            for mode, func in (('connection/email', connection_per_email), ('shared', shared_connection)):
+                best = None
+                for _ in range(self.repeat):
+                    requeue()
+                    start = time.perf_counter()
+                    func()
+                    elapsed = (time.perf_counter() - start) * 1000
+                    best = elapsed if best is None else min(best, elapsed)
+                self.stdout.write(f'{mode:>16} {best:>10.1f}')
+        except OSError as e:
+            self.stdout.write(self.style.ERROR(f'Could not reach the SMTP stub: {e}'))
+        finally:
+            if controller is not None:
+                controller.stop()
+
+    def bench_email_render(self, **options):
+        user = User.objects.create_user(username='benchmark_render_user', email='render@example.com')
+        order = Order.objects.create(user=user, full_name='Benchmark', address_line1='1 Test Street', city='Pune',
+                                     state='MH', postal_code='411001', phone='9999999999', total_amount=Decimal('4500.00'))
+        OrderItem.objects.bulk_create([
+            OrderItem(order=order, product_name=f'Benchmark Product {i}', unit_price=Decimal('150.00'),
+                      quantity=2, line_total=Decimal('300.00'))
+            for i in range(15)
+        ])
+        order = Order.objects.select_related('user').prefetch_related('items').get(id=order.id)
+        context = {'order': order, 'user': user, 'site_name': 'Customise Clothing'}
+        runs = 200
+
+        def legacy():
+            html = render_to_string('emails/order_confirmation.html', context)
+            return strip_tags(html), html
+
+        def text_template():
+            return render_email_parts('order_confirmation', context)
+
+        self.stdout.write(f'order_confirmation with {order.items.count()} items')
+        self.stdout.write(f"{'mode':>22} {'renders/s':>10}")
+        for mode, func in (('render + strip_tags', legacy), ('html + txt templates', text_template)):
+            # Median-based rate, robust against scheduler noise
+            timings = self.latencies(func, runs)
+            self.stdout.write(f'{mode:>22} {1000 / percentile(timings, 50):>10.0f}')
+
+        batch = [context] * 2000
+        for processes in (1, 2, 4):
+            start = time.perf_counter()
+            render_many('order_confirmation', batch, processes=processes)
+            elapsed = time.perf_counter() - start
+            self.stdout.write(f"{f'batch of {len(batch)}, {processes} proc':>22} {len(batch) / elapsed:>10.0f}")
+
+    def bench_merge_carts(self, **options):
+        user = User.objects.create_user(username='benchmark_merge_user')
+        products = self.make_products(200)
+
+        def legacy(session_key):
+            guest_cart = Cart.objects.select_for_update().get(session_key=session_key, user=None)
+            user_cart, created = Cart.objects.get_or_create(user=user)
+            for guest_item in guest_cart.items.select_for_update().all():
+                try:
+                    user_item = user_cart.items.select_for_update().get(product=guest_item.product)
+                    new_quantity = user_item.quantity + guest_item.quantity
+                    if new_quantity > guest_item.product.stock:
+                        continue
+                    user_item.quantity = new_quantity
+                    user_item.save()
+                except CartItem.DoesNotExist:
+                    if guest_item.quantity <= guest_item.product.stock:
+                        CartItem.objects.create(cart=user_cart, product=guest_item.product,
+                                                quantity=guest_item.quantity)
+            guest_cart.delete()
+            user_cart.recalculate_totals()
+
+        def timed(merge, lines):
+            """Best time and query count of merging a guest cart of lines (half already in the user cart)"""
+            best, queries = None, None
+            for run in range(self.repeat):
+                Cart.objects.filter(user=user).delete()
+                user_cart = Cart.objects.create(user=user)
+                CartItem.objects.bulk_create([CartItem(cart=user_cart, product=p) for p in products[:lines // 2]])
+                guest_cart = Cart.objects.create(session_key=f'benchmark-merge-{lines}-{run}')
+                CartItem.objects.bulk_create([CartItem(cart=guest_cart, product=p, quantity=2) for p in products[:lines]])
+                with CaptureQueriesContext(connection) as ctx:
+                    start = time.perf_counter()
+                    merge(guest_cart.session_key)
+                    elapsed = (time.perf_counter() - start) * 1000
+                best = elapsed if best is None else min(best, elapsed)
+                queries = len(ctx.captured_queries)
+            return best, queries
+
+        self.stdout.write(f"{'lines':>6} {'legacy ms':>10} {'legacy q':>9} {'set-based ms':>13} {'set-based q':>12}")
+        for lines in (10, 50, 100, 200):
+            legacy_ms, legacy_queries = timed(legacy, lines)
+            merged_ms, merged_queries = timed(lambda key: merge_carts(user, key), lines)
+            self.stdout.write(
+                f'{lines:>6} {legacy_ms:>10.2f} {legacy_queries:>9} {merged_ms:>13.2f} {merged_queries:>12}'
+            )
+
+
+def percentile(sorted_values, pct):
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
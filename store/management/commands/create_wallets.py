@@ -1,3 +1,5 @@
+import time
+
 from django.core.management.base import BaseCommand
 from django.contrib.auth.models import User
 from store.models import Wallet
@@ -6,23 +8,46 @@ from store.models import Wallet
 class Command(BaseCommand):
     help = 'Create wallets for existing users'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Wallets inserted per statement')
+        parser.add_argument('--dry-run', action='store_true', help='Only count the users without a wallet')
+
     def handle(self, *args, **options):
-        users_without_wallet = User.objects.filter(wallet__isnull=True)
-        created_count = 0
-
-        for user in users_without_wallet:
-            wallet, created = Wallet.objects.get_or_create(user=user)
-            if created:
-                created_count += 1
-                self.stdout.write(
-                    self.style.SUCCESS(f'Created wallet for user: {user.username}')
-                )
+        batch_size = max(1, options['batch_size'])
+        users_without_wallet = User.objects.filter(wallet__isnull=True).order_by('id').values_list('id', flat=True)
+
+        if options['dry_run']:
+            missing = users_without_wallet.count()
+            self.stdout.write(self.style.WARNING(f'Dry run: {missing} users have no wallet'))
+            return
 
-        if created_count == 0:
+        start = time.perf_counter()
+        wallets_before = Wallet.objects.count()
+        processed = 0
+        batch = []
+        # Stream ids instead of loading users; ignore_conflicts lets a wallet
+        # created meanwhile by a signup or another run win without an error
+        for user_id in users_without_wallet.iterator(chunk_size=batch_size):
+            batch.append(Wallet(user_id=user_id))
+            if len(batch) == batch_size:
+                Wallet.objects.bulk_create(batch, ignore_conflicts=True)
+                processed += len(batch)
+                batch = []
+        if batch:
+            Wallet.objects.bulk_create(batch, ignore_conflicts=True)
+            processed += len(batch)
+
+        elapsed = time.perf_counter() - start
+        created_count = Wallet.objects.count() - wallets_before
+
+        if processed == 0:
             self.stdout.write(
                 self.style.WARNING('All users already have wallets')
             )
         else:
             self.stdout.write(
-                self.style.SUCCESS(f'Successfully created {created_count} wallets')
-            )
\ No newline at end of file
+                self.style.SUCCESS(
+                    f'Successfully created {created_count} wallets for {processed} users '
+                    f'in {elapsed:.2f}s ({processed / elapsed:.0f} users/s)'
+                )
+            )
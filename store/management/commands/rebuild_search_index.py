@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from store import search
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the full-text product search index from scratch'
+
+    def handle(self, *args, **options):
+        if search.get_index() is None:
+            self.stdout.write(self.style.WARNING('This database backend has no search index; search uses icontains'))
+            return
+        count = search.rebuild_index()
+        self.stdout.write(self.style.SUCCESS(f'Indexed {count} products'))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from store.models import WalletMonthlySummary
+
+
+class Command(BaseCommand):
+    help = 'Recompute monthly wallet summaries from the transaction ledger (backfill or repair)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--wallet', type=int, action='append', help='Only rebuild this wallet id (repeatable)')
+
+    def handle(self, *args, **options):
+        written = WalletMonthlySummary.rebuild(options['wallet'])
+        self.stdout.write(self.style.SUCCESS(f'Wrote {written} monthly wallet summaries'))
@@ -0,0 +1,55 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from store.cart_utils import CART_TOTAL_FIELDS, expected_cart_totals
+from store.models import Cart
+
+
+class Command(BaseCommand):
+    help = 'Detect and repair drift between cached cart totals and the actual cart contents'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Report drifted carts without repairing them')
+        parser.add_argument('--batch-size', type=int, default=500, help='Carts checked per batch')
+
+    def handle(self, *args, **options):
+        dry_run = options['dry_run']
+        batch_size = max(1, options['batch_size'])
+
+        checked = drifted = 0
+        batch = []
+        carts = Cart.objects.only('id', 'user_id', *CART_TOTAL_FIELDS).order_by('id')
+        for cart in carts.iterator(chunk_size=batch_size):
+            batch.append(cart)
+            if len(batch) >= batch_size:
+                drifted += self.reconcile(batch, dry_run)
+                checked += len(batch)
+                batch = []
+        if batch:
+            drifted += self.reconcile(batch, dry_run)
+            checked += len(batch)
+
+        if drifted == 0:
+            self.stdout.write(self.style.SUCCESS(f'Checked {checked} carts, no drift found'))
+        elif dry_run:
+            self.stdout.write(self.style.WARNING(f'Checked {checked} carts, {drifted} have drifted totals (dry run)'))
+        else:
+            self.stdout.write(self.style.SUCCESS(f'Checked {checked} carts, repaired {drifted}'))
+
+    def reconcile(self, carts, dry_run):
+        """Compare a batch of carts against grouped aggregates and fix the ones that drifted"""
+        expected_totals = expected_cart_totals(carts)
+        stale = []
+        for cart in carts:
+            expected = expected_totals[cart.id]
+            actual = {field: getattr(cart, field) for field in CART_TOTAL_FIELDS}
+            if expected != actual:
+                self.stdout.write(f'Cart #{cart.id}: cached {actual}, actual {expected}')
+                for field, value in expected.items():
+                    setattr(cart, field, value)
+                stale.append(cart)
+
+        if stale and not dry_run:
+            with transaction.atomic():
+                Cart.objects.bulk_update(stale, CART_TOTAL_FIELDS)
+        return len(stale)
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from store import related
+from store.product_pages import invalidate_product_pages
+
+
+class Command(BaseCommand):
+    help = 'Recompute the precomputed related products shown on product pages'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--category', type=int, help='Only refresh this category id')
+
+    def handle(self, *args, **options):
+        if options['category']:
+            changed = related.refresh_category(options['category'])
+        else:
+            changed = related.refresh_all()
+        invalidate_product_pages(changed)
+        self.stdout.write(self.style.SUCCESS(f'Updated related products for {len(changed)} products'))
@@ -0,0 +1,23 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from store.holds import sweep_expired_holds
+
+
+class Command(BaseCommand):
+    help = 'Delete expired stock holds in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Holds deleted per statement')
+        parser.add_argument('--loop', type=int, metavar='SECONDS',
+                            help='Keep running, sweeping every SECONDS (for a background worker)')
+
+    def handle(self, *args, **options):
+        batch_size = max(1, options['batch_size'])
+        while True:
+            deleted = sweep_expired_holds(batch_size)
+            self.stdout.write(self.style.SUCCESS(f'Deleted {deleted} expired stock holds'))
+            if not options['loop']:
+                return
+            time.sleep(options['loop'])
@@ -1,10 +1,19 @@
-from django.db import models, transaction
+from django.db import IntegrityError, models, transaction
+from django.db.models import Count, DecimalField, F, Q, Sum
 from django.contrib.auth.models import User
 from decimal import Decimal
 from django.utils import timezone
 
 # Create your models here.
 
+CENT = Decimal('0.01')
+
+
+def quantize_price(value):
+    """Round a money amount to paise; SQL sums come back with arbitrary scale"""
+    return (value or Decimal('0.00')).quantize(CENT)
+
+
 class TimeStampedModel(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
@@ -32,7 +41,8 @@ class Category(TimeStampedModel):
 
     @property
     def has_children(self):
-        return self.children.exists()
+        from .category_tree import get_category_tree
+        return get_category_tree().has_children(self.id)
 
 
 class Size(models.Model):
@@ -71,6 +81,22 @@ class Product(TimeStampedModel):
     def __str__(self):
         return self.name
 
+
+class RelatedProduct(models.Model):
+    """Precomputed "related products" shown on a product page (see store.related)"""
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='related_links')
+    related = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='+')
+    rank = models.PositiveSmallIntegerField(default=0)
+
+    class Meta:
+        ordering = ['product', 'rank']
+        constraints = [
+            models.UniqueConstraint(fields=['product', 'related'], name='unique_related_product'),
+        ]
+
+    def __str__(self):
+        return f"{self.product} -> {self.related}"
+
 class CustomizationRequest(TimeStampedModel):
     STATUS_CHOICES = [
         ('pending', 'Pending'),
@@ -150,6 +176,11 @@ class UserAddress(TimeStampedModel):
 class Cart(TimeStampedModel):
     user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True)
     session_key = models.CharField(max_length=40, null=True, blank=True)
+    # Cached totals for regular lines plus in-cart personalizations, maintained by
+    # cart_utils on every mutation (see the reconcile_cart_totals command)
+    item_count = models.PositiveIntegerField(default=0, help_text='Distinct lines in cart')
+    total_quantity = models.PositiveIntegerField(default=0, help_text='Total units in cart')
+    total_price = models.DecimalField(max_digits=12, decimal_places=2, default=Decimal('0.00'))
     
     class Meta:
         indexes = [
@@ -164,11 +195,72 @@ class Cart(TimeStampedModel):
     
     @property
     def total_items(self):
-        return sum(item.quantity for item in self.items.all())
+        return self.get_summary()['total_items']
+    
+    def get_summary(self):
+        """Total quantity, distinct line count and price computed in one aggregate query"""
+        totals = self.items.aggregate(
+            total_items=Sum('quantity'),
+            item_count=Count('id'),
+            total_price=Sum(
+                F('quantity') * F('product__price'),
+                output_field=DecimalField(max_digits=12, decimal_places=2),
+            ),
+        )
+        return {
+            'total_price': quantize_price(totals['total_price']),
+            'total_items': totals['total_items'] or 0,
+            'item_count': totals['item_count'],
+        }
     
-    @property
-    def total_price(self):
-        return sum(item.total_price for item in self.items.all())
+    def calculate_totals(self):
+        """Recompute the cached totals from cart lines and in-cart personalizations"""
+        summary = self.get_summary()
+        totals = {
+            'item_count': summary['item_count'],
+            'total_quantity': summary['total_items'],
+            'total_price': summary['total_price'],
+        }
+        if self.user_id:
+            personalized = PersonalizationRequest.objects.filter(
+                user_id=self.user_id,
+                status='order_accepted',
+                cart_quantity__gt=0
+            ).aggregate(
+                item_count=Count('id'),
+                total_quantity=Sum('cart_quantity'),
+                total_price=Sum(
+                    F('cart_quantity') * F('product__price'),
+                    output_field=DecimalField(max_digits=12, decimal_places=2),
+                ),
+            )
+            totals['item_count'] += personalized['item_count']
+            totals['total_quantity'] += personalized['total_quantity'] or 0
+            totals['total_price'] = quantize_price(totals['total_price'] + (personalized['total_price'] or 0))
+        return totals
+    
+    def recalculate_totals(self):
+        """Rewrite the cached totals from scratch"""
+        totals = self.calculate_totals()
+        Cart.objects.filter(pk=self.pk).update(**totals)
+        for field, value in totals.items():
+            setattr(self, field, value)
+        return totals
+    
+    def adjust_totals(self, lines=0, quantity=0, price=Decimal('0.00')):
+        """Apply an incremental change to the cached totals with a single UPDATE"""
+        if not (lines or quantity or price):
+            return
+        Cart.objects.filter(pk=self.pk).update(
+            item_count=F('item_count') + lines,
+            total_quantity=F('total_quantity') + quantity,
+            total_price=F('total_price') + price,
+            updated_at=timezone.now(),
+        )
+        # Keep this instance (which may be the request's cached cart) in step
+        self.item_count += lines
+        self.total_quantity += quantity
+        self.total_price += price
     
     def get_or_create_item(self, product):
         """Get existing cart item or create new one with stock validation"""
@@ -190,20 +282,23 @@ class Cart(TimeStampedModel):
         if quantity <= 0:
             raise ValueError("Quantity must be positive")
         
-        item, created = self.get_or_create_item(product)
-        if not created:
-            # Check if adding quantity exceeds stock
-            new_quantity = item.quantity + quantity
-            if new_quantity > product.stock:
-                raise ValueError(f"Insufficient stock. Available: {product.stock}, Requested: {new_quantity}")
-            item.quantity = new_quantity
-            item.save()
-        else:
-            # New item, set the requested quantity
-            if quantity > product.stock:
-                raise ValueError(f"Insufficient stock. Available: {product.stock}, Requested: {quantity}")
-            item.quantity = quantity
-            item.save()
+        with transaction.atomic():
+            item, created = self.get_or_create_item(product)
+            if not created:
+                # Check if adding quantity exceeds stock
+                new_quantity = item.quantity + quantity
+                if new_quantity > product.stock:
+                    raise ValueError(f"Insufficient stock. Available: {product.stock}, Requested: {new_quantity}")
+                item.quantity = new_quantity
+                item.save()
+            else:
+                # New item, set the requested quantity
+                if quantity > product.stock:
+                    raise ValueError(f"Insufficient stock. Available: {product.stock}, Requested: {quantity}")
+                item.quantity = quantity
+                item.save()
+            
+            self.adjust_totals(lines=1 if created else 0, quantity=quantity, price=quantity * product.price)
         
         return item
     
@@ -213,14 +308,36 @@ class Cart(TimeStampedModel):
         return self.items.count() == 0
     
     def clear(self):
-        """Clear all items from cart"""
-        self.items.all().delete()
+        """Clear all items from cart and release its stock holds"""
+        with transaction.atomic():
+            self.items.all().delete()
+            self.stock_holds.all().delete()
+            self.recalculate_totals()
     
     def get_item_count(self):
         """Get distinct item count (not total quantity)"""
         return self.items.count()
 
 
+class StockHold(models.Model):
+    """Soft reservation of a product's stock by a cart (see store.holds)"""
+    cart = models.ForeignKey(Cart, on_delete=models.CASCADE, related_name='stock_holds')
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='stock_holds')
+    quantity = models.PositiveIntegerField()
+    expires_at = models.DateTimeField(db_index=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['cart', 'product'], name='unique_stock_hold'),
+        ]
+        indexes = [
+            models.Index(fields=['product', 'expires_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.quantity}x {self.product} held by cart #{self.cart_id}"
+
+
 class CartItem(TimeStampedModel):
     cart = models.ForeignKey(Cart, related_name='items', on_delete=models.CASCADE)
     product = models.ForeignKey(Product, on_delete=models.CASCADE)
@@ -254,6 +371,7 @@ class CartItem(TimeStampedModel):
             
             self.quantity = new_quantity
             self.save(update_fields=['quantity'])
+            self.cart.adjust_totals(quantity=amount, price=amount * self.product.price)
     
     def decrease_quantity(self, amount=1):
         """Decrease item quantity, delete if reaches 0"""
@@ -261,25 +379,34 @@ class CartItem(TimeStampedModel):
             # Refresh from database and lock the row
             self.refresh_from_db()
             
-            new_quantity = self.quantity - amount
+            old_quantity = self.quantity
+            new_quantity = old_quantity - amount
             
             if new_quantity <= 0:
                 self.delete()
+                self.cart.adjust_totals(lines=-1, quantity=-old_quantity, price=-old_quantity * self.product.price)
             else:
                 self.quantity = new_quantity
                 self.save(update_fields=['quantity'])
+                self.cart.adjust_totals(quantity=-amount, price=-amount * self.product.price)
     
     def set_quantity(self, quantity):
         """Set specific quantity with stock validation"""
+        old_quantity = self.quantity
         if quantity <= 0:
-            self.delete()
+            with transaction.atomic():
+                self.delete()
+                self.cart.adjust_totals(lines=-1, quantity=-old_quantity, price=-old_quantity * self.product.price)
             return
         
         if quantity > self.product.stock:
             raise ValueError(f"Insufficient stock. Available: {self.product.stock}, Requested: {quantity}")
         
-        self.quantity = quantity
-        self.save(update_fields=['quantity'])
+        with transaction.atomic():
+            self.quantity = quantity
+            self.save(update_fields=['quantity'])
+            delta = quantity - old_quantity
+            self.cart.adjust_totals(quantity=delta, price=delta * self.product.price)
 
 
 class Wallet(TimeStampedModel):
@@ -291,34 +418,51 @@ class Wallet(TimeStampedModel):
 
     def add_money(self, amount, description=""):
         """Add money to wallet with transaction record"""
-        with transaction.atomic():
-            self.balance += Decimal(str(amount))
-            self.save()
-            WalletTransaction.objects.create(
-                wallet=self,
-                transaction_type='credit',
-                amount=Decimal(str(amount)),
-                description=description,
-                balance_after=self.balance
-            )
+        return self._apply(Decimal(str(amount)), 'credit', description)
     
     def deduct_money(self, amount, description=""):
         """Deduct money from wallet with transaction record"""
         amount = Decimal(str(amount))
-        if self.balance < amount:
+        if self._apply(amount, 'debit', description) is None:
             raise ValueError("Insufficient wallet balance")
-        
+
+    def _apply(self, amount, transaction_type, description):
+        """Change the balance in the database and append the ledger entry.
+
+        The balance is changed with a single UPDATE (balance = balance +/- amount,
+        debits only WHERE balance >= amount), never from this possibly stale
+        instance. The UPDATE keeps the row locked until commit, so the balance
+        read back right after it is the one this change produced. Returns the
+        WalletTransaction, or None when a debit finds too little balance.
+        """
         with transaction.atomic():
-            self.balance -= amount
-            self.save()
-            WalletTransaction.objects.create(
+            wallets = Wallet.objects.filter(pk=self.pk)
+            if transaction_type == 'debit':
+                updated = wallets.filter(balance__gte=amount).update(
+                    balance=F('balance') - amount, updated_at=timezone.now()
+                )
+            else:
+                updated = wallets.update(balance=F('balance') + amount, updated_at=timezone.now())
+            if not updated:
+                self.balance = wallets.values_list('balance', flat=True).first()
+                return None
+            self.balance = wallets.values_list('balance', flat=True).get()
+            return WalletTransaction.objects.create(
                 wallet=self,
-                transaction_type='debit',
+                transaction_type=transaction_type,
                 amount=amount,
                 description=description,
                 balance_after=self.balance
             )
 
+    def ledger_balance(self):
+        """Balance derived from the append-only transaction ledger"""
+        totals = self.transactions.aggregate(
+            credits=Sum('amount', filter=Q(transaction_type='credit')),
+            debits=Sum('amount', filter=Q(transaction_type='debit')),
+        )
+        return (totals['credits'] or Decimal('0.00')) - (totals['debits'] or Decimal('0.00'))
+
 
 class WalletTransaction(TimeStampedModel):
     TRANSACTION_TYPES = [
@@ -333,11 +477,93 @@ class WalletTransaction(TimeStampedModel):
     balance_after = models.DecimalField(max_digits=10, decimal_places=2, default=Decimal('0.00'))
 
     class Meta:
-        ordering = ['-created_at']
+        ordering = ['-created_at', '-id']
+        indexes = [
+            # Statement pages: one wallet's entries, newest first
+            models.Index(fields=['wallet', '-created_at', '-id'], name='wallet_txn_history_idx'),
+        ]
 
     def __str__(self):
         return f"{self.wallet.user.username} - {self.transaction_type} ₹{self.amount}"
 
+    def save(self, *args, **kwargs):
+        # Ledger entries are append-only: each new one is added to its month's rollup
+        adding = self._state.adding
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if adding:
+                WalletMonthlySummary.record(self)
+
+
+class WalletMonthlySummary(models.Model):
+    """Per wallet and month credit/debit totals, kept up to date on every ledger insert"""
+    wallet = models.ForeignKey(Wallet, on_delete=models.CASCADE, related_name='monthly_summaries')
+    month = models.DateField(help_text="First day of the month")
+    credit_total = models.DecimalField(max_digits=12, decimal_places=2, default=Decimal('0.00'))
+    debit_total = models.DecimalField(max_digits=12, decimal_places=2, default=Decimal('0.00'))
+    transaction_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        ordering = ['-month']
+        constraints = [
+            models.UniqueConstraint(fields=['wallet', 'month'], name='unique_wallet_month'),
+        ]
+
+    def __str__(self):
+        return f"{self.wallet.user.username} - {self.month:%b %Y}"
+
+    @property
+    def net(self):
+        return self.credit_total - self.debit_total
+
+    @staticmethod
+    def month_of(moment):
+        return timezone.localdate(moment).replace(day=1)
+
+    @classmethod
+    def record(cls, entry):
+        """Add a new WalletTransaction to its month's totals"""
+        total_field = 'credit_total' if entry.transaction_type == 'credit' else 'debit_total'
+        month = cls.month_of(entry.created_at)
+        changes = {total_field: F(total_field) + entry.amount, 'transaction_count': F('transaction_count') + 1}
+        if cls.objects.filter(wallet_id=entry.wallet_id, month=month).update(**changes):
+            return
+        try:
+            with transaction.atomic():
+                cls.objects.create(wallet_id=entry.wallet_id, month=month, transaction_count=1,
+                                   **{total_field: entry.amount})
+        except IntegrityError:
+            # Another entry created the month first
+            cls.objects.filter(wallet_id=entry.wallet_id, month=month).update(**changes)
+
+    @classmethod
+    def rebuild(cls, wallet_ids=None):
+        """Recompute rollups from the full ledger (backfill); returns the rows written"""
+        entries = WalletTransaction.objects.all()
+        summaries = cls.objects.all()
+        if wallet_ids is not None:
+            entries = entries.filter(wallet_id__in=wallet_ids)
+            summaries = summaries.filter(wallet_id__in=wallet_ids)
+
+        totals = {}
+        for wallet_id, created_at, transaction_type, amount in entries.order_by().values_list(
+            'wallet_id', 'created_at', 'transaction_type', 'amount'
+        ).iterator(chunk_size=2000):
+            key = wallet_id, cls.month_of(created_at)
+            summary = totals.get(key)
+            if summary is None:
+                summary = totals[key] = cls(wallet_id=wallet_id, month=key[1])
+            if transaction_type == 'credit':
+                summary.credit_total += amount
+            else:
+                summary.debit_total += amount
+            summary.transaction_count += 1
+
+        with transaction.atomic():
+            summaries.delete()
+            cls.objects.bulk_create(totals.values(), batch_size=1000)
+        return len(totals)
+
 
 class UPIPaymentMethod(TimeStampedModel):
     name = models.CharField(max_length=50, unique=True, help_text="e.g., PhonePe, Paytm, Google Pay")
@@ -394,6 +620,8 @@ class Order(TimeStampedModel):
     return_reason = models.TextField(blank=True, null=True)
     returned_at = models.DateTimeField(null=True, blank=True)
     delivery_date = models.DateField(null=True, blank=True)
+    # Client token from the checkout form; repeats of a submission map back to this order
+    idempotency_key = models.CharField(max_length=64, unique=True, null=True, blank=True, editable=False)
 
     def __str__(self):
         return f"Order #{self.id}"
@@ -473,6 +701,8 @@ class Order(TimeStampedModel):
                     cart=cart,
                     product=request.product
                 ).delete()
+            
+            cart.recalculate_totals()
                 
         except Cart.DoesNotExist:
             pass  # No cart exists, nothing to clean up
@@ -513,6 +743,10 @@ class Order(TimeStampedModel):
             raise ValueError("Cannot process return for guest orders")
         
         with transaction.atomic():
+            # Claim the return so a concurrent call cannot refund twice
+            if not Order.objects.filter(pk=self.pk, is_returned=False).update(is_returned=True):
+                raise ValueError("Order is already returned")
+
             # Mark order as returned
             self.is_returned = True
             self.return_reason = reason
@@ -569,6 +803,10 @@ class ReturnRequest(TimeStampedModel):
             raise ValueError("Return request is not in pending status")
         
         with transaction.atomic():
+            # Claim the pending request so a concurrent approval cannot refund twice
+            if not ReturnRequest.objects.filter(pk=self.pk, status='pending').update(status='approved'):
+                raise ValueError("Return request is not in pending status")
+
             # Update return request status
             self.status = 'approved'
             self.approved_at = timezone.now()
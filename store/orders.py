@@ -0,0 +1,166 @@
+"""Order placement.
+
+place_order() turns a checked-out cart into an Order in a single transaction:
+reserve_stock() checks and decrements stock in the database (or fails without
+overselling), order items are written with one bulk_create, and personalized
+items leave the cart with one UPDATE.
+
+Checkouts carry an idempotency key. The order row is inserted first, so a
+repeated submission with the same key waits on (or fails on) that unique row
+before touching stock, and gets the original order back as DuplicateOrder.
+"""
+from collections import defaultdict, namedtuple
+
+from django.db import IntegrityError, transaction
+from django.db.models import F
+
+from .catalog import bump_catalog_version
+from .holds import held_by_other_carts, holds_enabled
+from .models import Order, OrderItem, PersonalizationRequest, Product
+
+
+# One product that cannot be reserved, shaped like validate_cart_stock's stock_issues
+StockShortfall = namedtuple('StockShortfall', ['product_id', 'product_name', 'requested', 'available'])
+
+
+class InsufficientStock(Exception):
+    """Raised when products no longer have the requested stock.
+
+    shortfalls is a list of StockShortfall, one per product that falls short.
+    """
+
+    def __init__(self, shortfalls):
+        self.shortfalls = shortfalls
+        super().__init__(', '.join(
+            f'{shortfall.product_name} (need {shortfall.requested}, have {shortfall.available})'
+            for shortfall in shortfalls
+        ))
+
+
+class DuplicateOrder(Exception):
+    """Raised when an order was already placed with the same idempotency key"""
+
+    def __init__(self, order):
+        self.order = order
+        super().__init__(f'{order} was already placed with this idempotency key')
+
+
+class _StockConflict(Exception):
+    pass
+
+
+def reserve_stock(quantities, cart=None):
+    """Atomically take quantities ({product_id: qty}) out of stock.
+
+    The product rows are locked in id order first, so concurrent reservations
+    over overlapping products queue instead of deadlocking. Products that need
+    the same headroom then share one conditional UPDATE
+    (stock = stock - qty WHERE stock >= qty + held). held is what other carts
+    hold when stock holds are enabled, 0 otherwise. Either every product has
+    enough stock and all are decremented, or nothing changes and
+    InsufficientStock is raised.
+    """
+    if not quantities:
+        return
+
+    try:
+        with transaction.atomic():
+            # No-op on SQLite, which serializes writers anyway
+            list(Product.objects.select_for_update().filter(id__in=quantities).order_by('id').values_list('id'))
+            held = held_by_other_carts(quantities, cart) if holds_enabled() else {}
+
+            groups = defaultdict(list)
+            for product_id, qty in quantities.items():
+                groups[qty, held.get(product_id, 0)].append(product_id)
+            for (qty, held_qty), product_ids in groups.items():
+                updated = Product.objects.filter(id__in=product_ids, stock__gte=qty + held_qty).update(
+                    stock=F('stock') - qty
+                )
+                if updated != len(product_ids):
+                    raise _StockConflict
+    except _StockConflict:
+        # The savepoint rolled back, so these are the stock levels the UPDATE saw
+        products = Product.objects.filter(id__in=quantities).values_list('id', 'name', 'stock')
+        found = {product_id: (name, stock) for product_id, name, stock in products}
+        shortfalls = []
+        for product_id, qty in quantities.items():
+            name, stock = found.get(product_id, ('Unavailable product', 0))
+            available = stock - held.get(product_id, 0)
+            if available < qty:
+                shortfalls.append(StockShortfall(product_id, name, qty, max(available, 0)))
+        raise InsufficientStock(shortfalls)
+
+    # Sold-out products drop out of cached in-stock facets
+    if Product.objects.filter(id__in=quantities, stock=0).exists():
+        transaction.on_commit(bump_catalog_version)
+
+
+def find_order_by_key(idempotency_key, user):
+    """The user's order placed with idempotency_key, or None"""
+    if not idempotency_key:
+        return None
+    return Order.objects.filter(idempotency_key=idempotency_key, user=user).first()
+
+
+def place_order(cart, cart_items, personalized_items=(), wallet=None, wallet_amount=None, **order_fields):
+    """Create an Order for cart lines and in-cart personalizations, then empty the cart.
+
+    The cart's own stock holds count as available and are released with the cart.
+
+    order_fields are passed to Order. Raises InsufficientStock, or ValueError
+    for an insufficient wallet balance; nothing is written in either case.
+    With an idempotency_key that already has an order of the same user,
+    DuplicateOrder is raised instead and nothing is written either.
+    """
+    order_lines = [
+        OrderItem(
+            product=item.product,
+            product_name=item.product.name,
+            unit_price=item.product.price,
+            quantity=item.quantity,
+            line_total=item.total_price,
+            size=item.size,
+        )
+        for item in cart_items
+    ] + [
+        OrderItem(
+            product=req.product,
+            product_name=req.product.name,
+            unit_price=req.product.price,
+            quantity=req.cart_quantity,
+            line_total=req.cart_total_price,
+            size=req.size,
+        )
+        for req in personalized_items
+    ]
+
+    quantities = defaultdict(int)
+    for line in order_lines:
+        quantities[line.product_id] += line.quantity
+
+    with transaction.atomic():
+        try:
+            # Concurrent duplicates block here on the unique key until the first commits
+            with transaction.atomic():
+                order = Order.objects.create(**order_fields)
+        except IntegrityError:
+            # Only the same user's order counts as a duplicate; never show someone else's
+            existing = find_order_by_key(order_fields.get('idempotency_key'), order_fields.get('user'))
+            if not existing:
+                raise
+            raise DuplicateOrder(existing)
+        reserve_stock(quantities, cart)
+        for line in order_lines:
+            line.order = order
+        OrderItem.objects.bulk_create(order_lines)
+
+        if personalized_items:
+            PersonalizationRequest.objects.filter(
+                id__in=[req.id for req in personalized_items]
+            ).update(cart_quantity=0)
+
+        if wallet is not None and wallet_amount:
+            wallet.deduct_money(wallet_amount, f"Payment for Order #{order.id}")
+
+        cart.clear()
+    return order
@@ -0,0 +1,57 @@
+"""Cached product detail page payloads.
+
+Each payload holds the product (with its category), its sizes and the ids of
+its precomputed related products. Payloads are deleted on writes to that
+product and all of them are dropped (by bumping the product page version) when
+a category or size changes. Stock is not trusted from the cache; product_detail
+reads it live.
+"""
+from django.core.cache import cache
+
+from .catalog import get_product_page_version
+from .models import Product, RelatedProduct
+
+PRODUCT_PAGE_CACHE_TIMEOUT = 86400
+
+
+def product_page_key(product_id, version):
+    return f'store:product_page:{version}:{product_id}'
+
+
+def get_product_pages(product_ids):
+    """Payloads keyed by product id; ids of missing products are left out.
+
+    Cache misses are built together with three queries whatever their number.
+    """
+    version = get_product_page_version()
+    keys = {product_id: product_page_key(product_id, version) for product_id in product_ids}
+    cached = cache.get_many(keys.values())
+    pages = {product_id: cached[key] for product_id, key in keys.items() if key in cached}
+
+    missing = [product_id for product_id in keys if product_id not in pages]
+    if missing:
+        products = Product.objects.select_related('category').prefetch_related('sizes').in_bulk(missing)
+        related_ids = {}
+        for product_id, related_id in RelatedProduct.objects.filter(
+            product_id__in=products
+        ).values_list('product_id', 'related_id'):
+            related_ids.setdefault(product_id, []).append(related_id)
+
+        built = {}
+        for product_id, product in products.items():
+            pages[product_id] = built[keys[product_id]] = {
+                'product': product,
+                'sizes': list(product.sizes.all()),
+                'related_ids': related_ids.get(product_id, []),
+            }
+        cache.set_many(built, PRODUCT_PAGE_CACHE_TIMEOUT)
+    return pages
+
+
+def get_product_page(product_id):
+    return get_product_pages([product_id]).get(product_id)
+
+
+def invalidate_product_pages(product_ids):
+    version = get_product_page_version()
+    cache.delete_many([product_page_key(product_id, version) for product_id in product_ids])
@@ -0,0 +1,94 @@
+"""Precomputed related products.
+
+A product's related products are other products of the same category, in-stock
+ones first, closest in price first. They are stored in RelatedProduct and
+refreshed per category by the refresh_related_products command and whenever a
+product's category or price changes.
+"""
+from bisect import bisect_left
+
+from django.db import transaction
+
+from .models import Product, RelatedProduct
+
+RELATED_PRODUCTS_LIMIT = 4
+
+
+def nearest_by_price(candidates, prices, product_id, price, limit, exclude):
+    """Up to limit ids from candidates (sorted by price) closest to price"""
+    picked = []
+    right = bisect_left(prices, price)
+    left = right - 1
+    while len(picked) < limit and (left >= 0 or right < len(candidates)):
+        # Take whichever neighbour is closer in price, the cheaper one on ties
+        take_left = right >= len(candidates) or (
+            left >= 0 and price - prices[left] <= prices[right] - price
+        )
+        if take_left:
+            candidate_id = candidates[left][0]
+            left -= 1
+        else:
+            candidate_id = candidates[right][0]
+            right += 1
+        if candidate_id != product_id and candidate_id not in exclude:
+            picked.append(candidate_id)
+    return picked
+
+
+def compute_related(rows, limit=RELATED_PRODUCTS_LIMIT):
+    """Map each (id, price, stock) row to the ids of its related rows"""
+    in_stock = sorted((row for row in rows if row[2] > 0), key=lambda row: (row[1], row[0]))
+    out_of_stock = sorted((row for row in rows if row[2] <= 0), key=lambda row: (row[1], row[0]))
+    in_stock_prices = [row[1] for row in in_stock]
+    out_of_stock_prices = [row[1] for row in out_of_stock]
+
+    related = {}
+    for product_id, price, stock in rows:
+        picked = nearest_by_price(in_stock, in_stock_prices, product_id, price, limit, ())
+        if len(picked) < limit:
+            picked += nearest_by_price(
+                out_of_stock, out_of_stock_prices, product_id, price, limit - len(picked), set(picked)
+            )
+        related[product_id] = picked
+    return related
+
+
+def refresh_category(category_id):
+    """Recompute related products for one category (None: uncategorized products).
+
+    Only products whose list changed are rewritten; their ids are returned so
+    cached product pages can be invalidated.
+    """
+    products = Product.objects.filter(category_id=category_id)
+    related = compute_related(list(products.values_list('id', 'price', 'stock')))
+
+    current = {}
+    for product_id, related_id in RelatedProduct.objects.filter(
+        product__category_id=category_id
+    ).values_list('product_id', 'related_id'):
+        current.setdefault(product_id, []).append(related_id)
+
+    changed = [product_id for product_id, ids in related.items() if current.get(product_id, []) != ids]
+    if not changed:
+        return []
+
+    with transaction.atomic():
+        RelatedProduct.objects.filter(product_id__in=changed).delete()
+        RelatedProduct.objects.bulk_create(
+            [
+                RelatedProduct(product_id=product_id, related_id=related_id, rank=rank)
+                for product_id in changed
+                for rank, related_id in enumerate(related[product_id])
+            ],
+            batch_size=1000,
+        )
+    return changed
+
+
+def refresh_all():
+    """Recompute related products for every category; returns the changed product ids"""
+    changed = []
+    category_ids = Product.objects.order_by().values_list('category_id', flat=True).distinct()
+    for category_id in category_ids:
+        changed += refresh_category(category_id)
+    return changed
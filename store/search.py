@@ -0,0 +1,227 @@
+"""Full-text product search.
+
+Products are indexed on name, description and category name in a table
+maintained next to store_product:
+
+* SQLite: an FTS5 virtual table ranked with bm25()
+* PostgreSQL: a tsvector column with a GIN index ranked with ts_rank()
+
+The table is created after migrate (see signals.ensure_search_index) and kept in
+sync by the Product/Category signals. Other backends fall back to icontains.
+"""
+import re
+
+from django.db import connection
+from django.db.models import Q
+
+from .models import Category, Product
+
+# Longer queries add little precision but make the match expression expensive
+MAX_TERMS = 8
+
+_TERM_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def parse_terms(query):
+    return _TERM_RE.findall((query or '').lower())[:MAX_TERMS]
+
+
+class SQLiteIndex:
+    table = 'store_product_fts'
+    id_column = 'rowid'
+
+    def install(self, cursor):
+        cursor.execute(f"""
+            CREATE VIRTUAL TABLE IF NOT EXISTS {self.table} USING fts5(
+                name, description, category, category_id UNINDEXED,
+                tokenize = 'unicode61 remove_diacritics 2',
+                prefix = '2 3'
+            )
+        """)
+
+    def insert_sql(self, where):
+        return f"""
+            INSERT INTO {self.table} (rowid, name, description, category, category_id)
+            SELECT p.id, p.name, p.description, COALESCE(c.name, ''), p.category_id
+            FROM {Product._meta.db_table} p
+            LEFT JOIN {Category._meta.db_table} c ON c.id = p.category_id
+            WHERE {where}
+        """
+
+    def search_sql(self, terms, prefix):
+        # Quote every term so user input can never be read as FTS5 syntax
+        phrases = [f'"{term}"' for term in terms]
+        if prefix:
+            phrases[-1] += '*'
+        # Column weights: name, description, category
+        sql = f"""
+            SELECT rowid FROM {self.table}
+            WHERE {self.table} MATCH %s
+            ORDER BY bm25({self.table}, 10.0, 1.0, 4.0), rowid DESC
+            LIMIT %s OFFSET %s
+        """
+        return sql, [' '.join(phrases)]
+
+
+class PostgresIndex:
+    table = 'store_product_search'
+    id_column = 'product_id'
+
+    def install(self, cursor):
+        cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS {self.table} (
+                product_id bigint PRIMARY KEY,
+                category_id bigint,
+                document tsvector NOT NULL
+            )
+        """)
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS {self.table}_document ON {self.table} USING GIN (document)')
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS {self.table}_category ON {self.table} (category_id)')
+
+    def insert_sql(self, where):
+        return f"""
+            INSERT INTO {self.table} (product_id, category_id, document)
+            SELECT p.id, p.category_id,
+                   setweight(to_tsvector('simple', p.name), 'A')
+                   || setweight(to_tsvector('simple', COALESCE(c.name, '')), 'B')
+                   || setweight(to_tsvector('simple', p.description), 'C')
+            FROM {Product._meta.db_table} p
+            LEFT JOIN {Category._meta.db_table} c ON c.id = p.category_id
+            WHERE {where}
+        """
+
+    def search_sql(self, terms, prefix):
+        lexemes = list(terms)
+        if prefix:
+            lexemes[-1] += ':*'
+        sql = f"""
+            SELECT product_id FROM {self.table}, to_tsquery('simple', %s) query
+            WHERE document @@ query
+            ORDER BY ts_rank(document, query) DESC, product_id DESC
+            LIMIT %s OFFSET %s
+        """
+        return sql, [' & '.join(lexemes)]
+
+
+BACKENDS = {
+    'sqlite': SQLiteIndex,
+    'postgresql': PostgresIndex,
+}
+
+
+def get_index():
+    """Search index for the default database, or None if the backend has none"""
+    backend = BACKENDS.get(connection.vendor)
+    return backend() if backend else None
+
+
+def install_index():
+    """Create the index table if needed; returns True when it was just created"""
+    index = get_index()
+    if index is None:
+        return False
+    existed = index.table in connection.introspection.table_names()
+    with connection.cursor() as cursor:
+        index.install(cursor)
+    return not existed
+
+
+def index_out_of_sync():
+    """True when the index does not hold one row per product (e.g. after flush)"""
+    index = get_index()
+    if index is None:
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute(f'SELECT COUNT(*) FROM {index.table}')
+        indexed = cursor.fetchone()[0]
+    return indexed != Product.objects.count()
+
+
+# Ids bound per statement, well under SQLite's limit on query parameters
+BATCH_SIZE = 500
+
+
+def _batches(product_ids):
+    product_ids = list(product_ids)
+    for start in range(0, len(product_ids), BATCH_SIZE):
+        batch = product_ids[start:start + BATCH_SIZE]
+        yield batch, ', '.join(['%s'] * len(batch))
+
+
+def index_products(product_ids):
+    """(Re)index the given products; ids that no longer exist are dropped"""
+    index = get_index()
+    if index is None:
+        return
+    with connection.cursor() as cursor:
+        for batch, marks in _batches(product_ids):
+            cursor.execute(f'DELETE FROM {index.table} WHERE {index.id_column} IN ({marks})', batch)
+            cursor.execute(index.insert_sql(f'p.id IN ({marks})'), batch)
+
+
+def remove_products(product_ids):
+    index = get_index()
+    if index is None:
+        return
+    with connection.cursor() as cursor:
+        for batch, marks in _batches(product_ids):
+            cursor.execute(f'DELETE FROM {index.table} WHERE {index.id_column} IN ({marks})', batch)
+
+
+def reindex_category(category_id):
+    """Refresh products filed under a category after it was renamed or deleted"""
+    index = get_index()
+    if index is None:
+        return
+    # Deleting a category nulls its products' category_id without signals, so
+    # uncategorized products whose rows were just dropped are indexed again too
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {index.table} WHERE category_id = %s', [category_id])
+        cursor.execute(index.insert_sql(f"""
+            p.category_id = %s OR (p.category_id IS NULL AND NOT EXISTS (
+                SELECT 1 FROM {index.table} WHERE {index.id_column} = p.id
+            ))
+        """), [category_id])
+
+
+def rebuild_index():
+    """Drop every indexed row and index the whole catalog again"""
+    index = get_index()
+    if index is None:
+        return 0
+    with connection.cursor() as cursor:
+        index.install(cursor)
+        cursor.execute(f'DELETE FROM {index.table}')
+        cursor.execute(index.insert_sql('1 = 1'))
+    return Product.objects.count()
+
+
+def search_product_ids(query, limit=20, offset=0, prefix=False):
+    """Ids of matching products, best match first.
+
+    With prefix=True the last term also matches longer words, for typeahead.
+    """
+    terms = parse_terms(query)
+    if not terms:
+        return []
+
+    index = get_index()
+    if index is None:
+        condition = Q()
+        for term in terms:
+            condition &= (Q(name__icontains=term) | Q(description__icontains=term)
+                          | Q(category__name__icontains=term))
+        matches = Product.objects.filter(condition).order_by('-id').values_list('id', flat=True)
+        return list(matches[offset:offset + limit])
+
+    sql, params = index.search_sql(terms, prefix)
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params + [limit, offset])
+        return [row[0] for row in cursor.fetchall()]
+
+
+def search_products(query, limit=20, offset=0, prefix=False):
+    """Matching products in rank order (one index query plus one product query)"""
+    ids = search_product_ids(query, limit=limit, offset=offset, prefix=prefix)
+    products = Product.objects.select_related('category').in_bulk(ids)
+    return [products[product_id] for product_id in ids if product_id in products]
@@ -0,0 +1,168 @@
+from django.db import connection, transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+
+from . import related, search
+from .cart_utils import carts_holding_products, recalculate_carts
+from .catalog import (
+    bump_catalog_version, bump_category_tree_version, bump_product_page_version, bump_size_registry_version,
+)
+from .models import Cart, Category, Product, Size
+from .product_pages import invalidate_product_pages
+
+# Product fields that feed the search index
+SEARCH_FIELDS = {'name', 'description', 'category', 'category_id'}
+# Product fields that decide related products
+RELATED_FIELDS = {'category', 'category_id', 'price'}
+
+
+def invalidate(bump):
+    # Bump now, and again once the transaction commits so nothing rebuilt from
+    # pre-commit data in the meantime survives
+    bump()
+    transaction.on_commit(bump)
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+@receiver(post_save, sender=Size)
+@receiver(post_delete, sender=Size)
+def catalog_changed(sender, **kwargs):
+    """Any product or size write invalidates cached catalog fragments"""
+    invalidate(bump_catalog_version)
+
+
+@receiver(m2m_changed, sender=Product.sizes.through)
+def product_sizes_changed(sender, action, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        invalidate(bump_catalog_version)
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def category_changed(sender, **kwargs):
+    """Category writes also force a category tree rebuild"""
+    invalidate(bump_category_tree_version)
+    invalidate(bump_catalog_version)
+
+
+def ensure_search_index(sender, **kwargs):
+    """post_migrate: create the full-text index table and fill it on first run or after a flush"""
+    # The store tables may not exist yet (the app has no migration files)
+    if Product._meta.db_table not in connection.introspection.table_names():
+        return
+    # flush empties store_product but not the index table, so resync it too
+    if search.install_index() or search.index_out_of_sync():
+        search.rebuild_index()
+
+
+@receiver(post_save, sender=Product)
+def index_product(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and not SEARCH_FIELDS & set(update_fields):
+        return
+    search.index_products([instance.pk])
+
+
+@receiver(post_delete, sender=Product)
+def unindex_product(sender, instance, **kwargs):
+    search.remove_products([instance.pk])
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def reindex_category(sender, instance, **kwargs):
+    search.reindex_category(instance.pk)
+
+
+def invalidate_pages(product_ids):
+    """Drop cached product pages now and again after commit (see invalidate)"""
+    product_ids = list(product_ids)
+    if product_ids:
+        invalidate(lambda: invalidate_product_pages(product_ids))
+
+
+@receiver(post_save, sender=Product)
+def product_saved(sender, instance, update_fields=None, **kwargs):
+    invalidate_pages([instance.pk])
+    if update_fields is not None and not RELATED_FIELDS & set(update_fields):
+        return
+    stored = getattr(instance, '_stored_values', None)
+    if stored is None:
+        # A new product joins its category's related lists
+        categories = {instance.category_id}
+    elif stored['category_id'] != instance.category_id:
+        # Products of the old category may still list this one as related
+        categories = {stored['category_id'], instance.category_id}
+    elif stored['price'] != instance.price:
+        categories = {instance.category_id}
+    else:
+        return
+    for category_id in categories:
+        invalidate_pages(related.refresh_category(category_id))
+
+
+@receiver(post_delete, sender=Product)
+def product_deleted(sender, instance, **kwargs):
+    invalidate_pages([instance.pk])
+    invalidate_pages(related.refresh_category(instance.category_id))
+
+
+@receiver(m2m_changed, sender=Product.sizes.through)
+def product_sizes_changed_page(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        invalidate_pages([instance.pk])
+    elif pk_set:
+        invalidate_pages(pk_set)
+    else:
+        # size.products.clear() does not report which products were affected
+        invalidate(bump_product_page_version)
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+@receiver(post_save, sender=Size)
+@receiver(post_delete, sender=Size)
+def product_pages_changed(sender, **kwargs):
+    """Cached pages embed category names and sizes"""
+    invalidate(bump_product_page_version)
+
+
+@receiver(post_save, sender=Size)
+@receiver(post_delete, sender=Size)
+def size_registry_changed(sender, **kwargs):
+    invalidate(bump_size_registry_version)
+
+
+@receiver(pre_save, sender=Product)
+def remember_product_values(sender, instance, update_fields=None, **kwargs):
+    """Keep the stored price and category so post_save can tell what changed"""
+    if update_fields is not None and not RELATED_FIELDS & set(update_fields):
+        # Neither can change, so there is nothing to compare against
+        instance._stored_values = None
+        return
+    instance._stored_values = (
+        Product.objects.filter(pk=instance.pk).values('price', 'category_id').first() if instance.pk else None
+    )
+
+
+@receiver(post_save, sender=Product)
+def reprice_carts(sender, instance, **kwargs):
+    """Cached cart totals are priced at the product's price"""
+    stored = getattr(instance, '_stored_values', None)
+    if stored and stored['price'] != instance.price:
+        recalculate_carts(carts_holding_products([instance.pk]))
+
+
+@receiver(pre_delete, sender=Product)
+def remember_product_carts(sender, instance, **kwargs):
+    # The cascade removes the cart lines before post_delete could find these carts
+    instance._cart_ids = list(carts_holding_products([instance.pk]).values_list('id', flat=True))
+
+
+@receiver(post_delete, sender=Product)
+def recalculate_product_carts(sender, instance, **kwargs):
+    cart_ids = getattr(instance, '_cart_ids', None)
+    if cart_ids:
+        recalculate_carts(Cart.objects.filter(id__in=cart_ids))
@@ -0,0 +1,48 @@
+"""In-process size registry.
+
+Size is a small reference table (S to XXL), so every process keeps all rows
+keyed by code and reloads them only when a size changes anywhere (the size
+registry version is bumped on Size writes). The sizes a product allows are
+read from its cached product page (see product_pages), which is invalidated
+whenever the product's sizes change.
+"""
+from .catalog import get_size_registry_version
+from .product_pages import get_product_pages
+
+_sizes = None
+_sizes_version = None
+
+
+def get_sizes():
+    """Process-wide {code: Size}, reloaded when a size changes anywhere"""
+    global _sizes, _sizes_version
+    version = get_size_registry_version()
+    if _sizes is None or _sizes_version != version:
+        from .models import Size
+        _sizes = {size.code: size for size in Size.objects.all()}
+        _sizes_version = version
+    return _sizes
+
+
+def get_size(code):
+    """The Size with this code, or None"""
+    return get_sizes().get(code)
+
+
+def allowed_size_ids_for(product_ids):
+    """{product_id: ids of the sizes it is sold in}; empty sets for products needing no size"""
+    pages = get_product_pages(product_ids)
+    return {product_id: {size.id for size in page['sizes']} for product_id, page in pages.items()}
+
+
+def allowed_size_ids(product_id):
+    return allowed_size_ids_for([product_id]).get(product_id, set())
+
+
+def validate_size(product, size):
+    """Raise ValueError unless size (a Size or None) suits product"""
+    allowed = allowed_size_ids(product.id)
+    if allowed and size is None:
+        raise ValueError("Please select a size for this product")
+    if size is not None and allowed and size.id not in allowed:
+        raise ValueError("Selected size is not available for this product")
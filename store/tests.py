@@ -1,3 +1,1323 @@
-from django.test import TestCase
+import json
+import random
+import threading
+import time
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import IntegrityError, OperationalError, connection, connections
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from accounts.models import OutboxEmail
+
+from .cart_utils import merge_carts
+from .catalog import get_catalog_version
+from .category_tree import get_category_tree
+from .product_pages import get_product_pages
+from .search import index_products, remove_products, search_product_ids, search_products
+from .models import (
+    Cart, CartItem, Category, Order, OrderItem, PersonalizationRequest, Product, RelatedProduct, Size, StockHold, UserAddress, Wallet,
+    WalletMonthlySummary, WalletTransaction,
+)
+from .orders import DuplicateOrder, InsufficientStock, StockShortfall, place_order, reserve_stock
+from .related import compute_related
+
+
+class CartSummaryTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='shopper', password='pass12345')
+        cls.category = Category.objects.create(name='Shirts')
+        cls.products = Product.objects.bulk_create([
+            Product(name=f'Shirt {i}', category=cls.category, price=Decimal('199.50'), stock=50)
+            for i in range(30)
+        ])
+
+    def setUp(self):
+        self.cart = Cart.objects.create(user=self.user)
+
+    def test_empty_cart_summary(self):
+        self.assertEqual(self.cart.get_summary(), {
+            'total_price': Decimal('0.00'),
+            'total_items': 0,
+            'item_count': 0,
+        })
+
+    def test_summary_totals(self):
+        CartItem.objects.create(cart=self.cart, product=self.products[0], quantity=2)
+        CartItem.objects.create(cart=self.cart, product=self.products[1], quantity=3)
+
+        summary = self.cart.get_summary()
+        self.assertEqual(summary['total_items'], 5)
+        self.assertEqual(summary['item_count'], 2)
+        self.assertEqual(summary['total_price'], Decimal('997.50'))
+
+    def test_summary_query_count_is_constant(self):
+        CartItem.objects.create(cart=self.cart, product=self.products[0], quantity=1)
+        with self.assertNumQueries(1):
+            self.cart.get_summary()
+
+        CartItem.objects.bulk_create([
+            CartItem(cart=self.cart, product=product, quantity=1) for product in self.products[1:]
+        ])
+        with CaptureQueriesContext(connection) as ctx:
+            summary = self.cart.get_summary()
+        self.assertEqual(len(ctx.captured_queries), 1)
+        self.assertEqual(summary['item_count'], 30)
+
+
+class CachedCartTotalsTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='shopper', password='pass12345')
+        cls.category = Category.objects.create(name='Mugs')
+        cls.mug = Product.objects.create(name='Mug', category=cls.category, price=Decimal('150.00'), stock=10)
+        cls.bottle = Product.objects.create(name='Bottle', category=cls.category, price=Decimal('80.00'), stock=10)
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def post_json(self, name, payload):
+        return self.client.post(reverse(name), json.dumps(payload), content_type='application/json')
+
+    def cached_totals(self):
+        cart = Cart.objects.get(user=self.user)
+        return cart.item_count, cart.total_quantity, cart.total_price
+
+    def test_totals_are_rounded_to_paise(self):
+        pen = Product.objects.create(name='Pen', price=Decimal('19.99'), stock=10)
+        response = self.post_json('store:add_to_cart_ajax', {'product_id': pen.id, 'quantity': 3})
+        self.assertIn('"total_price": "59.97"', response.content.decode())
+
+        Cart.objects.get(user=self.user).recalculate_totals()
+        self.assertEqual(str(Cart.objects.get(user=self.user).total_price), '59.97')
+        bottle_response = self.post_json('store:add_to_cart_ajax', {'product_id': self.bottle.id, 'quantity': 1})
+        self.assertIn('"total_price": "139.97"', bottle_response.content.decode())
+
+    def test_mutations_keep_cached_totals_in_sync(self):
+        self.post_json('store:add_to_cart_ajax', {'product_id': self.mug.id, 'quantity': 2})
+        self.post_json('store:add_to_cart_ajax', {'product_id': self.bottle.id, 'quantity': 1})
+        self.assertEqual(self.cached_totals(), (2, 3, Decimal('380.00')))
+
+        self.post_json('store:update_cart_ajax', {'product_id': self.mug.id, 'quantity': 4})
+        self.assertEqual(self.cached_totals(), (2, 5, Decimal('680.00')))
+
+        self.post_json('store:remove_from_cart_ajax', {'product_id': self.bottle.id})
+        self.assertEqual(self.cached_totals(), (1, 4, Decimal('600.00')))
+
+        self.post_json('store:clear_cart_ajax', {})
+        self.assertEqual(self.cached_totals(), (0, 0, Decimal('0.00')))
+
+    def test_personalized_items_are_counted(self):
+        self.post_json('store:add_to_cart_ajax', {'product_id': self.bottle.id, 'quantity': 1})
+        personalization = PersonalizationRequest.objects.create(
+            user=self.user, product=self.mug, uploaded_image='personalization_designs/x.png',
+            status='order_accepted', cart_quantity=1,
+        )
+        Cart.objects.get(user=self.user).recalculate_totals()
+
+        self.post_json('store:update_personalization_cart_quantity', {'request_id': personalization.id, 'quantity': 3})
+        self.assertEqual(self.cached_totals(), (2, 4, Decimal('530.00')))
+
+        self.post_json('store:remove_personalization_from_cart', {'request_id': personalization.id})
+        self.assertEqual(self.cached_totals(), (1, 1, Decimal('80.00')))
+
+    def accepted_personalization(self, quantity):
+        personalization = PersonalizationRequest.objects.create(
+            user=self.user, product=self.mug, uploaded_image='personalization_designs/x.png',
+            status='order_accepted', cart_quantity=quantity,
+        )
+        Cart.objects.get(user=self.user).recalculate_totals()
+        return personalization
+
+    def test_rejecting_an_accepted_personalization_updates_totals(self):
+        self.post_json('store:add_to_cart_ajax', {'product_id': self.bottle.id, 'quantity': 1})
+        personalization = self.accepted_personalization(2)
+        self.assertEqual(self.cached_totals(), (2, 3, Decimal('380.00')))
+
+        staff = User.objects.create_user(username='staff', password='pass12345', is_staff=True)
+        self.client.force_login(staff)
+        self.post_json('store:admin_reject_personalization', {'request_id': personalization.id})
+
+        self.assertEqual(self.cached_totals(), (1, 1, Decimal('80.00')))
+
+    def test_admin_status_edits_update_totals(self):
+        self.post_json('store:add_to_cart_ajax', {'product_id': self.bottle.id, 'quantity': 1})
+        personalization = self.accepted_personalization(2)
+        admin_user = User.objects.create_superuser(username='admin', password='pass12345')
+        self.client.force_login(admin_user)
+        url = reverse('admin:store_personalizationrequest_change', args=[personalization.id])
+
+        def edit_status(status):
+            response = self.client.post(url, {
+                'user': self.user.id, 'product': self.mug.id, 'status': status, 'admin_notes': '',
+            })
+            self.assertEqual(response.status_code, 302)
+
+        edit_status('rejected')
+        self.assertEqual(self.cached_totals(), (1, 1, Decimal('80.00')))
+
+        edit_status('order_accepted')
+        self.assertEqual(self.cached_totals(), (2, 3, Decimal('380.00')))
+
+    def test_cart_count_is_a_single_row_read(self):
+        self.post_json('store:add_to_cart_ajax', {'product_id': self.mug.id, 'quantity': 3})
+        # Session + user lookups for the logged-in client, then one cart read
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(reverse('store:cart_count'))
+        self.assertEqual(response.json()['count'], 3)
+        cart_queries = [q for q in ctx.captured_queries if 'store_' in q['sql']]
+        self.assertEqual(len(cart_queries), 1)
+
+    def test_deleting_a_product_updates_carts_holding_it(self):
+        self.post_json('store:add_to_cart_ajax', {'product_id': self.mug.id, 'quantity': 2})
+        self.post_json('store:add_to_cart_ajax', {'product_id': self.bottle.id, 'quantity': 1})
+
+        Product.objects.get(id=self.mug.id).delete()
+
+        self.assertEqual(self.cached_totals(), (1, 1, Decimal('80.00')))
+        self.assertEqual(self.client.get(reverse('store:cart_count')).json()['count'], 1)
+
+    def test_price_changes_reprice_carts_holding_the_product(self):
+        self.post_json('store:add_to_cart_ajax', {'product_id': self.bottle.id, 'quantity': 2})
+
+        bottle = Product.objects.get(id=self.bottle.id)
+        bottle.price = Decimal('100.00')
+        bottle.save()
+
+        self.assertEqual(self.cached_totals(), (1, 2, Decimal('200.00')))
+
+    def test_reconcile_command_repairs_drift(self):
+        self.post_json('store:add_to_cart_ajax', {'product_id': self.mug.id, 'quantity': 2})
+        Cart.objects.filter(user=self.user).update(item_count=7, total_quantity=9, total_price=Decimal('1.00'))
+
+        out = StringIO()
+        call_command('reconcile_cart_totals', '--dry-run', stdout=out)
+        self.assertIn('1 have drifted', out.getvalue())
+        self.assertEqual(self.cached_totals(), (7, 9, Decimal('1.00')))
+
+        call_command('reconcile_cart_totals', stdout=StringIO())
+        self.assertEqual(self.cached_totals(), (1, 2, Decimal('300.00')))
+
+
+class CartSnapshotQueryCountTests(TestCase):
+    """Cart endpoints must not issue more queries as the cart grows"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='shopper', password='pass12345')
+        cls.category = Category.objects.create(name='Caps')
+        cls.products = Product.objects.bulk_create([
+            Product(name=f'Cap {i}', category=cls.category, price=Decimal('99.00'), stock=100)
+            for i in range(12)
+        ])
+
+    def setUp(self):
+        self.client.force_login(self.user)
+        self.cart = Cart.objects.create(user=self.user)
+        Wallet.objects.create(user=self.user)
+        self.personalization = self.add_personalization(self.products[0])
+        CartItem.objects.create(cart=self.cart, product=self.products[1], quantity=1)
+        self.cart.recalculate_totals()
+        # The first request remembers the cart id in the session
+        self.client.get(reverse('store:cart_count'))
+
+    def add_personalization(self, product):
+        return PersonalizationRequest.objects.create(
+            user=self.user, product=product, uploaded_image='personalization_designs/x.png',
+            status='order_accepted', cart_quantity=1,
+        )
+
+    def grow_cart(self):
+        CartItem.objects.bulk_create([
+            CartItem(cart=self.cart, product=product, quantity=2) for product in self.products[2:8]
+        ])
+        for product in self.products[8:]:
+            self.add_personalization(product)
+        self.cart.recalculate_totals()
+
+    def count_queries(self, method, name, payload=None):
+        with CaptureQueriesContext(connection) as ctx:
+            if method == 'post':
+                response = self.client.post(reverse(name), json.dumps(payload), content_type='application/json')
+            else:
+                response = self.client.get(reverse(name))
+        self.assertEqual(response.status_code, 200)
+        return len(ctx.captured_queries)
+
+    def assertConstantQueries(self, method, name, payload=None, grown_payload=None):
+        small = self.count_queries(method, name, payload)
+        self.grow_cart()
+        self.assertEqual(self.count_queries(method, name, grown_payload or payload), small)
+
+    def test_cart_page(self):
+        self.assertConstantQueries('get', 'store:cart')
+
+    def test_checkout_page(self):
+        self.assertConstantQueries('get', 'store:checkout')
+
+    def test_cart_count(self):
+        self.assertConstantQueries('get', 'store:cart_count')
+
+    def test_update_personalization_cart_quantity(self):
+        self.assertConstantQueries(
+            'post', 'store:update_personalization_cart_quantity',
+            {'request_id': self.personalization.id, 'quantity': 2},
+            {'request_id': self.personalization.id, 'quantity': 3},
+        )
+
+    def test_remove_personalization_from_cart(self):
+        # The grown cart uses a personalization that is still in the cart
+        small = self.count_queries('post', 'store:remove_personalization_from_cart', {'request_id': self.personalization.id})
+        self.grow_cart()
+        grown = PersonalizationRequest.objects.filter(cart_quantity__gt=0).last()
+        self.assertEqual(
+            self.count_queries('post', 'store:remove_personalization_from_cart', {'request_id': grown.id}),
+            small,
+        )
+
+    def test_combined_totals(self):
+        response = self.client.post(
+            reverse('store:update_personalization_cart_quantity'),
+            json.dumps({'request_id': self.personalization.id, 'quantity': 3}),
+            content_type='application/json',
+        )
+        self.assertEqual(response.json()['combined_cart_total'], {
+            'total_price': 396.0,
+            'total_items': 4,
+            'item_count': 2,
+        })
+
+
+class AllProductsPaginationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='Bottles')
+        Product.objects.bulk_create([
+            Product(name=f'Bottle {i}', category=category, price=Decimal('50.00'), stock=5)
+            for i in range(30)
+        ])
+
+    def test_cursor_pages_cover_catalog_once(self):
+        response = self.client.get(reverse('store:all_products'))
+        first_page = [product.id for product in response.context['products']]
+        self.assertEqual(first_page, sorted(first_page, reverse=True))
+        self.assertEqual(len(first_page), 24)
+
+        response = self.client.get(reverse('store:all_products'), {'cursor': response.context['next_cursor']})
+        second_page = [product.id for product in response.context['products']]
+        self.assertIsNone(response.context['next_cursor'])
+        self.assertEqual(sorted(first_page + second_page), sorted(Product.objects.values_list('id', flat=True)))
+
+    def test_json_variant(self):
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('store:all_products'), {'format': 'json'})
+        data = response.json()
+        self.assertTrue(data['has_more'])
+        self.assertEqual(data['html'].count('class="product-card'), 24)
+
+
+class HomePageCacheTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.staff = User.objects.create_user(username='admin', password='pass12345', is_staff=True)
+        cls.category = Category.objects.create(name='Hoodies')
+        cls.product = Product.objects.create(name='Zip Hoodie', category=cls.category, price=Decimal('899.00'), stock=4)
+
+    def setUp(self):
+        cache.clear()
+
+    def test_warm_anonymous_hit_needs_no_queries(self):
+        self.client.get(reverse('store:home'))
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('store:home'))
+        self.assertContains(response, 'Zip Hoodie')
+
+    def test_product_write_invalidates_fragments(self):
+        self.client.get(reverse('store:home'))
+        version = get_catalog_version()
+
+        self.client.force_login(self.staff)
+        self.client.post(reverse('store:edit_product', args=[self.product.id]), {
+            'name': 'Pullover Hoodie', 'category': self.category.id, 'price': '899.00',
+            'description': '', 'sizes': [],
+        })
+        self.client.logout()
+
+        self.assertGreater(get_catalog_version(), version)
+        self.assertContains(self.client.get(reverse('store:home')), 'Pullover Hoodie')
+
+    def test_category_delete_invalidates_fragments(self):
+        other = Category.objects.create(name='Caps')
+        self.assertContains(self.client.get(reverse('store:home')), 'Caps')
+        other.delete()
+        self.assertNotContains(self.client.get(reverse('store:home')), 'Caps')
+
+
+class CategoryTreeTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.staff = User.objects.create_user(username='admin', password='pass12345', is_staff=True)
+        cls.apparel = Category.objects.create(name='Apparel')
+        cls.tops = Category.objects.create(name='Tops', parent=cls.apparel)
+        cls.tees = Category.objects.create(name='Tees', parent=cls.tops)
+        cls.mugs = Category.objects.create(name='Mugs')
+        for category in (cls.apparel, cls.tops, cls.tees, cls.mugs):
+            Product.objects.create(name=f'{category.name} Item', category=category, price=Decimal('10.00'), stock=1)
+
+    def setUp(self):
+        cache.clear()
+
+    def test_lookups(self):
+        tree = get_category_tree()
+        self.assertEqual(tree.descendant_ids(self.apparel.id), {self.tops.id, self.tees.id})
+        self.assertEqual(tree.descendant_ids(self.mugs.id, include_self=True), {self.mugs.id})
+        self.assertEqual([node.name for node in tree.breadcrumb(self.tees.id)], ['Apparel', 'Tops', 'Tees'])
+        self.assertEqual(tree.label(self.tees.id), 'Apparel › Tops › Tees')
+        self.assertTrue(tree.has_children(self.tops.id))
+        self.assertFalse(tree.has_children(self.tees.id))
+
+    def test_product_form_labels_need_no_per_option_queries(self):
+        self.client.force_login(self.staff)
+        product = Product.objects.get(category=self.tees)
+        url = reverse('store:edit_product', args=[product.id])
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url)
+        self.assertContains(response, 'Apparel › Tops › Tees')
+        category_queries = [q for q in ctx.captured_queries if 'store_category' in q['sql']]
+        self.assertEqual(len(category_queries), 1)
+
+    def test_category_page_lists_whole_subtree(self):
+        response = self.client.get(reverse('store:category_page', args=[self.apparel.id]))
+        names = {row.name for row in response.context['product_rows']}
+        self.assertEqual(names, {'Apparel Item', 'Tops Item', 'Tees Item'})
+        self.assertEqual([node.name for node in response.context['subcategories']], ['Tops'])
+
+    def test_tree_rebuilds_after_category_change(self):
+        self.assertFalse(get_category_tree().has_children(self.mugs.id))
+        Category.objects.create(name='Travel Mugs', parent=self.mugs)
+        self.assertTrue(get_category_tree().has_children(self.mugs.id))
+
+
+class ProductSearchTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.drinkware = Category.objects.create(name='Drinkware')
+        cls.mug = Product.objects.create(
+            name='Ceramic Mug', category=cls.drinkware, price=Decimal('199.00'),
+            description='Dishwasher safe.',
+        )
+        cls.bottle = Product.objects.create(
+            name='Steel Bottle', category=cls.drinkware, price=Decimal('349.00'),
+            description='Pairs well with a ceramic coaster.',
+        )
+        cls.hoodie = Product.objects.create(name='Zip Hoodie', price=Decimal('899.00'), description='Warm fleece.')
+
+    def names(self, query, **kwargs):
+        return [product.name for product in search_products(query, **kwargs)]
+
+    def test_name_matches_rank_above_description_matches(self):
+        self.assertEqual(self.names('ceramic'), ['Ceramic Mug', 'Steel Bottle'])
+        self.assertCountEqual(self.names('drinkware'), ['Steel Bottle', 'Ceramic Mug'])
+
+    def test_prefix_matching(self):
+        self.assertEqual(self.names('hood'), [])
+        self.assertEqual(self.names('zip hood', prefix=True), ['Zip Hoodie'])
+
+    def test_user_input_is_not_query_syntax(self):
+        self.assertEqual(self.names('mug" OR "hoodie'), [])
+        self.assertEqual(self.names('  ***  '), [])
+
+    def test_index_follows_product_and_category_writes(self):
+        self.hoodie.name = 'Pullover Sweatshirt'
+        self.hoodie.save()
+        self.assertEqual(self.names('pullover'), ['Pullover Sweatshirt'])
+        self.assertEqual(self.names('hoodie'), [])
+
+        self.drinkware.name = 'Kitchen'
+        self.drinkware.save()
+        self.assertEqual(len(self.names('kitchen')), 2)
+
+        self.drinkware.delete()
+        self.assertEqual(self.names('kitchen'), [])
+        self.assertEqual(self.names('bottle'), ['Steel Bottle'])
+
+        self.mug.delete()
+        self.assertEqual(self.names('ceramic'), ['Steel Bottle'])
+
+    def test_large_categories_are_reindexed_without_binding_every_id(self):
+        many = connection.features.max_query_params or 999
+        products = Product.objects.bulk_create([
+            Product(name=f'Tumbler {i}', category=self.drinkware, price=Decimal('99.00')) for i in range(many + 1)
+        ])
+        self.drinkware.name = 'Barware'
+        with CaptureQueriesContext(connection) as ctx:
+            self.drinkware.save()
+        self.assertLess(max(len(query['sql']) for query in ctx.captured_queries), 2000)
+        self.assertEqual(len(search_product_ids('barware', limit=many + 10)), many + 3)
+
+        remove_products(product.id for product in products)
+        self.assertEqual(len(search_product_ids('tumbler', limit=many + 10)), 0)
+        index_products(product.id for product in products)
+        self.assertEqual(len(search_product_ids('tumbler', limit=many + 10)), many + 1)
+
+    def test_search_page_and_suggest_endpoint(self):
+        response = self.client.get(reverse('store:search'), {'q': 'bottle'})
+        self.assertEqual([product.name for product in response.context['products']], ['Steel Bottle'])
+
+        with self.assertNumQueries(2):
+            data = self.client.get(reverse('store:search_suggest'), {'q': 'ste'}).json()
+        self.assertEqual(data['results'][0]['name'], 'Steel Bottle')
+        self.assertEqual(data['results'][0]['url'], reverse('store:product_detail', args=[self.bottle.id]))
+
+
+class CategoryFacetTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = Category.objects.create(name='Tees')
+        cls.small, cls.large = Size.objects.create(code='S'), Size.objects.create(code='L')
+        cls.basic = Product.objects.create(name='Basic Tee', category=cls.category, price=Decimal('249.00'), stock=5)
+        cls.graphic = Product.objects.create(
+            name='Graphic Tee', category=cls.category, price=Decimal('499.00'), stock=0, can_customize=True,
+        )
+        cls.premium = Product.objects.create(name='Premium Tee', category=cls.category, price=Decimal('1299.00'), stock=2)
+        cls.basic.sizes.add(cls.small, cls.large)
+        cls.graphic.sizes.add(cls.large)
+
+    def setUp(self):
+        cache.clear()
+
+    def get(self, **params):
+        return self.client.get(reverse('store:category_page', args=[self.category.id]), params)
+
+    def listed(self, response):
+        return {row.name for row in response.context['product_rows']}
+
+    def test_counts(self):
+        facets = self.get().context['facets']
+        self.assertEqual(facets['total'], 3)
+        self.assertEqual(facets['customizable'], 1)
+        self.assertEqual(facets['in_stock'], 2)
+        self.assertEqual([bucket['count'] for bucket in facets['price']], [1, 1, 0, 1])
+        self.assertEqual(facets['sizes'], [{'code': 'L', 'count': 2}, {'code': 'S', 'count': 1}])
+
+    def test_filters(self):
+        self.assertEqual(self.listed(self.get(size='L')), {'Basic Tee', 'Graphic Tee'})
+        self.assertEqual(self.listed(self.get(size=['L', 'S'])), {'Basic Tee', 'Graphic Tee'})
+        self.assertEqual(self.listed(self.get(size='L', in_stock='1')), {'Basic Tee'})
+        self.assertEqual(self.listed(self.get(price=['under-300', '1000-plus'])), {'Basic Tee', 'Premium Tee'})
+        self.assertEqual(self.listed(self.get(customizable='1')), {'Graphic Tee'})
+        self.assertEqual(len(self.listed(self.get(price='bogus'))), 3)
+
+    def test_counts_are_cached_until_a_product_write(self):
+        self.get()
+        with CaptureQueriesContext(connection) as ctx:
+            self.get()
+        self.assertFalse([q for q in ctx.captured_queries if 'COUNT(' in q['sql']])
+
+        self.graphic.stock = 3
+        self.graphic.save(update_fields=['stock'])
+        self.assertEqual(self.get().context['facets']['in_stock'], 3)
+
+    def test_rows_carry_sorted_size_codes_from_one_query(self):
+        self.get()
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.get()
+        rows = {row.name: row.size_codes for row in response.context['product_rows']}
+        self.assertEqual(rows, {'Basic Tee': ['S', 'L'], 'Graphic Tee': ['L'], 'Premium Tee': []})
+        product_queries = [q for q in ctx.captured_queries if 'store_product' in q['sql']]
+        self.assertEqual(len(product_queries), 1)
+
+    def test_personalize_listing(self):
+        response = self.client.get(reverse('store:personalize_category_products', args=['Tees']), {'in_stock': '1'})
+        self.assertEqual(response.context['facets']['total'], 1)
+        self.assertEqual(list(response.context['products']), [])
+
+
+class ProductPageTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = Category.objects.create(name='Mugs')
+        cls.products = {
+            price: Product.objects.create(name=f'Mug {price}', category=cls.category, price=Decimal(price), stock=5)
+            for price in ('100', '200', '300', '400', '500', '900')
+        }
+
+    def setUp(self):
+        cache.clear()
+
+    def related_names(self, product):
+        return [link.related.name for link in RelatedProduct.objects.filter(product=product).select_related('related')]
+
+    def test_compute_related_prefers_in_stock_then_closest_price(self):
+        rows = [(1, Decimal('100'), 5), (2, Decimal('110'), 0), (3, Decimal('150'), 5), (4, Decimal('400'), 5)]
+        self.assertEqual(compute_related(rows, limit=2)[1], [3, 4])
+        self.assertEqual(compute_related(rows, limit=3)[1], [3, 4, 2])
+
+    def test_related_products_are_precomputed_on_save(self):
+        self.assertEqual(self.related_names(self.products['300']), ['Mug 200', 'Mug 400', 'Mug 100', 'Mug 500'])
+        self.products['900'].price = Decimal('310')
+        self.products['900'].save()
+        self.assertEqual(self.related_names(self.products['300']), ['Mug 900', 'Mug 200', 'Mug 400', 'Mug 100'])
+
+    def test_moving_a_product_refreshes_its_old_category(self):
+        url = reverse('store:product_detail', args=[self.products['300'].id])
+        self.client.get(url)
+        moved = self.products['200']
+        moved.category = Category.objects.create(name='Bottles')
+        moved.save()
+
+        self.assertFalse(RelatedProduct.objects.filter(related=moved).exists())
+        self.assertEqual([p.name for p in self.client.get(url).context['related_products']],
+                         ['Mug 400', 'Mug 100', 'Mug 500', 'Mug 900'])
+
+    def test_saves_that_keep_price_and_category_skip_related_products(self):
+        product = Product.objects.get(id=self.products['300'].id)
+        product.name = 'Travel Mug'
+        with CaptureQueriesContext(connection) as ctx:
+            product.save()
+        self.assertFalse([q for q in ctx.captured_queries if 'store_relatedproduct' in q['sql']])
+
+        product.stock = 3
+        with CaptureQueriesContext(connection) as ctx:
+            product.save(update_fields=['stock'])
+        self.assertFalse([q for q in ctx.captured_queries if q['sql'].startswith('SELECT')])
+
+    def test_price_change_refreshes_only_its_category(self):
+        other = Category.objects.create(name='Bottles')
+        Product.objects.create(name='Bottle', category=other, price=Decimal('250'), stock=5)
+        product = self.products['900']
+        product.price = Decimal('310')
+        with CaptureQueriesContext(connection) as ctx:
+            product.save()
+        related_reads = [q['sql'] for q in ctx.captured_queries
+                         if q['sql'].startswith('SELECT') and 'store_relatedproduct' in q['sql']]
+        self.assertEqual(len(related_reads), 1)
+        self.assertIn(str(self.category.id), related_reads[0])
+
+    def test_warm_page_needs_only_the_stock_query(self):
+        url = reverse('store:product_detail', args=[self.products['300'].id])
+        self.client.get(url)
+        with self.assertNumQueries(1):
+            response = self.client.get(url)
+        self.assertEqual([p.name for p in response.context['related_products']],
+                         ['Mug 200', 'Mug 400', 'Mug 100', 'Mug 500'])
+
+    def test_stock_is_live_and_writes_invalidate(self):
+        product = self.products['300']
+        url = reverse('store:product_detail', args=[product.id])
+        self.client.get(url)
+
+        Product.objects.filter(id=product.id).update(stock=0)
+        self.assertContains(self.client.get(url), 'Out of Stock')
+
+        product.name = 'Travel Mug'
+        product.save()
+        self.assertContains(self.client.get(url), 'Travel Mug')
+
+        self.category.name = 'Drinkware'
+        self.category.save()
+        self.assertContains(self.client.get(url), 'Drinkware')
+
+        product.delete()
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+
+class PlaceOrderTests(TestCase):
+    ADDRESS = {
+        'full_name': 'Asha Rao', 'address_line1': '12 MG Road', 'city': 'Pune', 'state': 'MH',
+        'postal_code': '411001', 'phone': '9999999999', 'payment_method': 'cod',
+    }
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='shopper', password='pass12345')
+        cls.category = Category.objects.create(name='Caps')
+        cls.products = Product.objects.bulk_create([
+            Product(name=f'Cap {i}', category=cls.category, price=Decimal('150.00'), stock=10)
+            for i in range(12)
+        ])
+
+    def setUp(self):
+        self.client.force_login(self.user)
+        self.cart = Cart.objects.create(user=self.user)
+        Wallet.objects.create(user=self.user)
+        address = {key: value for key, value in self.ADDRESS.items() if key != 'payment_method'}
+        UserAddress.objects.create(user=self.user, address_line2='', is_default=True, **address)
+        # The first request remembers the cart id in the session
+        self.client.get(reverse('store:cart_count'))
+
+    def fill_cart(self, products, quantity=2):
+        CartItem.objects.bulk_create([CartItem(cart=self.cart, product=p, quantity=quantity) for p in products])
+        self.cart.recalculate_totals()
+
+    def checkout(self):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.post(reverse('store:checkout'), self.ADDRESS)
+        self.assertEqual(response.status_code, 200)
+        return len(ctx.captured_queries)
+
+    def test_checkout_places_order_and_decrements_stock(self):
+        self.fill_cart(self.products[:3])
+        personalization = PersonalizationRequest.objects.create(
+            user=self.user, product=self.products[0], uploaded_image='personalization_designs/x.png',
+            status='order_accepted', cart_quantity=1,
+        )
+        self.checkout()
+
+        order = Order.objects.get(user=self.user)
+        self.assertEqual(order.items.count(), 4)
+        self.assertEqual(Product.objects.get(id=self.products[0].id).stock, 7)
+        self.assertEqual(Product.objects.get(id=self.products[1].id).stock, 8)
+        self.assertFalse(self.cart.items.exists())
+        personalization.refresh_from_db()
+        self.assertEqual(personalization.cart_quantity, 0)
+
+    def test_checkout_queries_do_not_grow_with_cart(self):
+        self.fill_cart(self.products[:2])
+        small = self.checkout()
+        self.fill_cart(self.products[2:])
+        self.assertEqual(self.checkout(), small)
+
+    def test_stock_conflict_rolls_back_everything(self):
+        self.fill_cart(self.products[:2], quantity=4)
+        items = list(self.cart.items.select_related('product', 'size'))
+        # Another order takes most of the stock after the cart was read
+        Product.objects.filter(id=self.products[1].id).update(stock=3)
+
+        with self.assertRaises(InsufficientStock) as ctx:
+            place_order(self.cart, items, full_name='Asha', address_line1='x', city='y', state='z',
+                        postal_code='1', phone='2')
+        self.assertEqual(ctx.exception.shortfalls, [StockShortfall(self.products[1].id, 'Cap 1', 4, 3)])
+        self.assertEqual(Product.objects.get(id=self.products[0].id).stock, 10)
+        self.assertFalse(Order.objects.exists())
+        self.assertEqual(self.cart.items.count(), 2)
+
+    def test_repeated_submission_returns_the_same_order(self):
+        self.user.email = 'asha@example.com'
+        self.user.save()
+        self.fill_cart(self.products[:2])
+        form = self.client.get(reverse('store:checkout')).context['idempotency_key']
+        data = dict(self.ADDRESS, idempotency_key=form)
+
+        first = self.client.post(reverse('store:checkout'), data)
+        with CaptureQueriesContext(connection) as ctx:
+            repeat = self.client.post(reverse('store:checkout'), data)
+
+        order = Order.objects.get(user=self.user)
+        self.assertEqual(first.context['order'], order)
+        self.assertEqual(repeat.context['order'], order)
+        self.assertFalse(any(query['sql'].startswith(('INSERT', 'UPDATE', 'DELETE')) for query in ctx.captured_queries))
+        self.assertEqual(Product.objects.get(id=self.products[0].id).stock, 8)
+        self.assertEqual(OutboxEmail.objects.filter(to=['asha@example.com']).count(), 1)
+
+    def test_place_order_rejects_a_used_key(self):
+        self.fill_cart(self.products[:1])
+        items = list(self.cart.items.select_related('product', 'size'))
+        fields = dict(user=self.user, full_name='Asha', address_line1='x', city='y', state='z',
+                      postal_code='1', phone='2', idempotency_key='k1')
+        order = place_order(self.cart, items, **fields)
+
+        with self.assertRaises(DuplicateOrder) as ctx:
+            place_order(self.cart, items, **fields)
+        self.assertEqual(ctx.exception.order, order)
+        self.assertEqual(Product.objects.get(id=self.products[0].id).stock, 8)
+
+    def test_another_users_key_is_not_their_duplicate(self):
+        self.fill_cart(self.products[:1])
+        items = list(self.cart.items.select_related('product', 'size'))
+        fields = dict(full_name='Asha', address_line1='x', city='y', state='z',
+                      postal_code='1', phone='2', idempotency_key='shared')
+        place_order(self.cart, items, user=self.user, **fields)
+
+        other = User.objects.create_user(username='other-buyer', password='pass12345')
+        with self.assertRaises(IntegrityError):
+            place_order(self.cart, items, user=other, **fields)
+
+    def test_checkout_with_another_users_key_asks_to_resubmit(self):
+        other = User.objects.create_user(username='other-buyer', password='pass12345')
+        other_cart = Cart.objects.create(user=other)
+        CartItem.objects.create(cart=other_cart, product=self.products[2], quantity=1)
+        place_order(other_cart, list(other_cart.items.select_related('product', 'size')),
+                    user=other, full_name='Ravi', address_line1='x', city='y', state='z',
+                    postal_code='1', phone='2', idempotency_key='shared')
+        self.fill_cart(self.products[:1])
+
+        response = self.client.post(reverse('store:checkout'), dict(self.ADDRESS, idempotency_key='shared'))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.context['errors'])
+        self.assertNotEqual(response.context['idempotency_key'], 'shared')
+        self.assertFalse(Order.objects.filter(user=self.user).exists())
+        self.assertEqual(self.cart.items.count(), 1)
+
+    def test_reserve_stock_is_all_or_nothing(self):
+        first, second = self.products[0], self.products[1]
+        with self.assertRaises(InsufficientStock) as ctx:
+            reserve_stock({first.id: 2, second.id: 11})
+        self.assertEqual(ctx.exception.shortfalls, [StockShortfall(second.id, 'Cap 1', 11, 10)])
+        self.assertEqual(Product.objects.get(id=first.id).stock, 10)
+
+        reserve_stock({first.id: 2, second.id: 10})
+        self.assertEqual(
+            list(Product.objects.filter(id__in=[first.id, second.id]).order_by('id').values_list('stock', flat=True)),
+            [8, 0],
+        )
+
+
+class SearchIndexFlushTests(TransactionTestCase):
+    def test_flush_empties_the_index(self):
+        Product.objects.create(name='Flushed Mug', price=Decimal('99.00'))
+        self.assertEqual(search_product_ids('flushed'), [Product.objects.get().id])
+
+        call_command('flush', interactive=False, verbosity=0)
+
+        self.assertEqual(search_product_ids('flushed'), [])
+
+
+class StockReservationConcurrencyTests(TransactionTestCase):
+    """Parallel checkouts of the same SKU must never sell more than its stock"""
+
+    STOCK = 10
+    BUYERS = 24
+
+    def test_parallel_checkouts_never_oversell(self):
+        product = Product.objects.create(name='Limited Tee', price=Decimal('499.00'), stock=self.STOCK)
+        carts = []
+        for i in range(self.BUYERS):
+            cart = Cart.objects.create(user=User.objects.create_user(username=f'buyer{i}'))
+            CartItem.objects.create(cart=cart, product=product, quantity=1)
+            carts.append(cart)
+
+        outcomes = []
+        start = threading.Barrier(self.BUYERS)
+
+        def checkout(cart):
+            try:
+                items = list(cart.items.select_related('product', 'size'))
+                start.wait()
+                deadline = time.monotonic() + 30
+                while time.monotonic() < deadline:
+                    try:
+                        place_order(cart, items, user=cart.user, full_name='Buyer', address_line1='1 Street',
+                                    city='Pune', state='MH', postal_code='411001', phone='9999999999')
+                        outcomes.append('ordered')
+                        return
+                    except InsufficientStock:
+                        outcomes.append('sold out')
+                        return
+                    except OperationalError:
+                        # SQLite reports a locked table instead of waiting; try again
+                        time.sleep(random.uniform(0.001, 0.01))
+                outcomes.append('gave up')
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=checkout, args=(cart,)) for cart in carts]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        product.refresh_from_db()
+        self.assertEqual(outcomes.count('ordered'), self.STOCK)
+        self.assertEqual(outcomes.count('sold out'), self.BUYERS - self.STOCK)
+        self.assertEqual(product.stock, 0)
+        self.assertEqual(sum(OrderItem.objects.values_list('quantity', flat=True)), self.STOCK)
+
+
+@override_settings(STOCK_HOLDS_ENABLED=True, STOCK_HOLD_SECONDS=600)
+class StockHoldTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.product = Product.objects.create(name='Drop Hoodie', price=Decimal('999.00'), stock=5)
+        cls.early, cls.late = (User.objects.create_user(username=name, password='pass12345') for name in ('early', 'late'))
+
+    def add(self, user, quantity):
+        self.client.force_login(user)
+        return self.client.post(
+            reverse('store:add_to_cart_ajax'),
+            json.dumps({'product_id': self.product.id, 'quantity': quantity}),
+            content_type='application/json',
+        ).json()
+
+    def test_holds_reduce_stock_available_to_other_carts(self):
+        self.assertTrue(self.add(self.early, 4)['success'])
+        hold = StockHold.objects.get(cart__user=self.early)
+        self.assertEqual(hold.quantity, 4)
+
+        self.assertFalse(self.add(self.late, 2)['success'])
+        self.assertTrue(self.add(self.late, 1)['success'])
+
+    def test_checkout_respects_other_carts_holds(self):
+        self.add(self.early, 4)
+        self.add(self.late, 1)
+        # The late cart grows past its share without holding it (e.g. an admin edit)
+        CartItem.objects.filter(cart__user=self.late).update(quantity=3)
+        late_cart = Cart.objects.get(user=self.late)
+        with self.assertRaises(InsufficientStock) as ctx:
+            place_order(late_cart, list(late_cart.items.select_related('product', 'size')),
+                        full_name='Late', address_line1='x', city='y', state='z', postal_code='1', phone='2')
+        self.assertEqual(ctx.exception.shortfalls[0].available, 1)
+
+        early_cart = Cart.objects.get(user=self.early)
+        place_order(early_cart, list(early_cart.items.select_related('product', 'size')),
+                    full_name='Early', address_line1='x', city='y', state='z', postal_code='1', phone='2')
+        self.assertEqual(Product.objects.get(id=self.product.id).stock, 1)
+        self.assertFalse(StockHold.objects.filter(cart=early_cart).exists())
+
+    def test_expired_holds_stop_counting_and_are_swept(self):
+        self.add(self.early, 5)
+        StockHold.objects.update(expires_at=timezone.now())
+        self.assertTrue(self.add(self.late, 5)['success'])
+
+        out = StringIO()
+        call_command('sweep_stock_holds', stdout=out)
+        self.assertIn('Deleted 1 expired', out.getvalue())
+        self.assertEqual(list(StockHold.objects.values_list('cart__user__username', flat=True)), ['late'])
+
+
+class WalletTests(TestCase):
+    def setUp(self):
+        self.wallet = Wallet.objects.create(user=User.objects.create_user(username='payer'))
+
+    def test_stale_instances_do_not_lose_updates(self):
+        stale = Wallet.objects.get(id=self.wallet.id)
+        self.wallet.add_money(500, 'Top up')
+        stale.add_money(200, 'Refund')
+        stale.deduct_money(600, 'Order')
+
+        self.wallet.refresh_from_db()
+        self.assertEqual(self.wallet.balance, Decimal('100.00'))
+        self.assertEqual(
+            list(self.wallet.transactions.order_by('id').values_list('balance_after', flat=True)),
+            [Decimal('500.00'), Decimal('700.00'), Decimal('100.00')],
+        )
+
+    def test_debit_is_conditional_on_the_stored_balance(self):
+        self.wallet.add_money(100)
+        stale = Wallet.objects.get(id=self.wallet.id)
+        self.wallet.deduct_money(80)
+
+        with self.assertRaises(ValueError):
+            stale.deduct_money(50)
+        self.assertEqual(stale.balance, Decimal('20.00'))
+        self.assertEqual(self.wallet.transactions.count(), 2)
+
+
+class WalletConcurrencyTests(TransactionTestCase):
+    """Concurrent credits and debits must keep the balance equal to the ledger"""
+
+    WORKERS = 16
+    OPERATIONS = 10
+
+    def test_parallel_credits_and_debits_match_the_ledger(self):
+        user = User.objects.create_user(username='busy_wallet')
+        wallet = Wallet.objects.create(user=user)
+        wallet.add_money(100, 'Opening balance')
+        outcomes = []
+        start = threading.Barrier(self.WORKERS)
+
+        def worker(index):
+            try:
+                # Each thread works on its own (soon stale) instance
+                own = Wallet.objects.get(id=wallet.id)
+                start.wait()
+                for op in range(self.OPERATIONS):
+                    deadline = time.monotonic() + 30
+                    while time.monotonic() < deadline:
+                        try:
+                            if (index + op) % 2:
+                                own.deduct_money(Decimal('35.00'), 'Order')
+                                outcomes.append('debit')
+                            else:
+                                own.add_money(Decimal('10.00'), 'Refund')
+                                outcomes.append('credit')
+                            break
+                        except ValueError:
+                            outcomes.append('declined')
+                            break
+                        except OperationalError:
+                            # SQLite reports a locked table instead of waiting; try again
+                            time.sleep(random.uniform(0.001, 0.01))
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(self.WORKERS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        wallet.refresh_from_db()
+        expected = Decimal('100.00') + 10 * outcomes.count('credit') - 35 * outcomes.count('debit')
+        self.assertEqual(len(outcomes), self.WORKERS * self.OPERATIONS)
+        self.assertEqual(wallet.balance, expected)
+        self.assertEqual(wallet.ledger_balance(), wallet.balance)
+        self.assertGreaterEqual(wallet.balance, 0)
+        self.assertFalse(wallet.transactions.filter(balance_after__lt=0).exists())
+
+
+class WalletStatementTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='statement', password='pass12345')
+        self.wallet = Wallet.objects.create(user=self.user)
+        self.client.force_login(self.user)
+
+    def test_statement_pages_with_cursor(self):
+        for i in range(5):
+            self.wallet.add_money(10 + i, f'Refund {i}')
+        with mock.patch('store.views.WALLET_STATEMENT_PAGE_SIZE', 2):
+            pages, cursor = [], None
+            while True:
+                data = self.client.get(reverse('store:wallet_statement'), {'cursor': cursor} if cursor else {}).json()
+                pages.append([entry['description'] for entry in data['transactions']])
+                cursor = data['next_cursor']
+                if not data['has_more']:
+                    break
+
+        self.assertEqual(pages, [['Refund 4', 'Refund 3'], ['Refund 2', 'Refund 1'], ['Refund 0']])
+        self.assertEqual(data['balance'], '60.00')
+
+    def test_rollups_follow_the_ledger(self):
+        self.wallet.add_money(500, 'Top up')
+        self.wallet.deduct_money(120, 'Order')
+        old = WalletTransaction.objects.create(
+            wallet=self.wallet, transaction_type='credit', amount=Decimal('40.00'), description='Adjustment'
+        )
+        WalletTransaction.objects.filter(id=old.id).update(created_at=timezone.now() - timedelta(days=62))
+
+        summary = WalletMonthlySummary.objects.get(wallet=self.wallet)
+        self.assertEqual(
+            (summary.credit_total, summary.debit_total, summary.transaction_count),
+            (Decimal('540.00'), Decimal('120.00'), 3),
+        )
+
+        # Backfill regroups by the entries' stored dates
+        self.assertEqual(WalletMonthlySummary.rebuild([self.wallet.id]), 2)
+        # Session, user, wallet and the rollups; the ledger is not read
+        with self.assertNumQueries(4):
+            months = self.client.get(reverse('store:wallet_summary')).json()['months']
+        self.assertEqual([(m['credits'], m['debits'], m['transactions']) for m in months],
+                         [('500.00', '120.00', 2), ('40.00', '0.00', 1)])
+        self.assertContains(self.client.get(reverse('store:wallet')), 'Monthly Summary')
+
+
+class CreateWalletsCommandTests(TestCase):
+    def test_creates_missing_wallets_in_batches(self):
+        users = User.objects.bulk_create([User(username=f'signup{i}') for i in range(7)])
+        Wallet.objects.create(user=users[0], balance=Decimal('50.00'))
+
+        out = StringIO()
+        call_command('create_wallets', dry_run=True, stdout=out)
+        self.assertIn('6 users have no wallet', out.getvalue())
+        self.assertEqual(Wallet.objects.count(), 1)
+
+        # Wallet counts before and after, the id stream and one INSERT per batch of 4
+        with self.assertNumQueries(5):
+            call_command('create_wallets', batch_size=4, stdout=out)
+        self.assertIn('created 6 wallets for 6 users', out.getvalue())
+        self.assertEqual(Wallet.objects.get(user=users[0]).balance, Decimal('50.00'))
+
+        call_command('create_wallets', stdout=out)
+        self.assertIn('All users already have wallets', out.getvalue())
+
+
+class MergeCartsTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='returning', password='pass12345')
+        cls.small, cls.medium = Size.objects.create(code='S'), Size.objects.create(code='M')
+        cls.products = Product.objects.bulk_create([
+            Product(name=f'Merge Tee {i}', price=Decimal('200.00'), stock=5) for i in range(4)
+        ])
+
+    def test_lines_merge_on_product_and_size_with_stock_capped_per_product(self):
+        tee, other, sold_out, fresh = self.products
+        Product.objects.filter(id=sold_out.id).update(stock=0)
+        user_cart = Cart.objects.create(user=self.user)
+        CartItem.objects.bulk_create([
+            CartItem(cart=user_cart, product=tee, size=self.small, quantity=2),
+            CartItem(cart=user_cart, product=tee, size=None, quantity=1),
+            CartItem(cart=user_cart, product=other, quantity=4),
+        ])
+        guest_cart = Cart.objects.create(session_key='guest-session')
+        CartItem.objects.bulk_create([
+            CartItem(cart=guest_cart, product=tee, size=self.small, quantity=2),
+            CartItem(cart=guest_cart, product=tee, size=self.medium, quantity=1),
+            CartItem(cart=guest_cart, product=tee, size=None, quantity=1),
+            CartItem(cart=guest_cart, product=other, quantity=3),
+            CartItem(cart=guest_cart, product=sold_out, quantity=1),
+            CartItem(cart=guest_cart, product=fresh, quantity=9),
+        ])
+
+        merged = merge_carts(self.user, 'guest-session')
+
+        lines = {
+            (item.product_id, item.size.code if item.size else None): item.quantity
+            for item in merged.items.select_related('size')
+        }
+        # Stock (5) caps each product over all its sizes; the user's own lines come first
+        self.assertEqual(lines, {
+            (tee.id, 'S'): 4, (tee.id, None): 1, (other.id, None): 5, (fresh.id, None): 5,
+        })
+        self.assertFalse(Cart.objects.filter(session_key='guest-session').exists())
+        self.assertEqual(merged.total_quantity, 15)
+
+    def test_guest_sizes_share_the_product_stock(self):
+        tee = self.products[0]
+        guest_cart = Cart.objects.create(session_key='sized-guest')
+        CartItem.objects.bulk_create([
+            CartItem(cart=guest_cart, product=tee, size=self.small, quantity=3),
+            CartItem(cart=guest_cart, product=tee, size=self.medium, quantity=3),
+            CartItem(cart=guest_cart, product=tee, size=None, quantity=1),
+        ])
+
+        merged = merge_carts(self.user, 'sized-guest')
+
+        self.assertEqual(merged.total_quantity, 5)
+        self.assertEqual(
+            sorted((item.size.code if item.size else '', item.quantity) for item in merged.items.select_related('size')),
+            [('M', 2), ('S', 3)],
+        )
+
+    def test_merge_statements_do_not_grow_with_the_cart(self):
+        def merge(lines):
+            CartItem.objects.all().delete()
+            guest_cart = Cart.objects.create(session_key=f'guest-{lines}')
+            CartItem.objects.bulk_create([CartItem(cart=guest_cart, product=p) for p in self.products[:lines]])
+            with CaptureQueriesContext(connection) as ctx:
+                merge_carts(self.user, guest_cart.session_key)
+            return len(ctx.captured_queries)
+
+        merge(1)  # creates the user cart
+        self.assertEqual(merge(1), merge(4))
+
+    def test_login_merges_the_guest_cart(self):
+        self.client.post(reverse('store:add_to_cart_ajax'), json.dumps({'product_id': self.products[0].id, 'quantity': 2}),
+                         content_type='application/json')
+        self.client.post(reverse('accounts:custom_login'), {'login_field': 'returning', 'password': 'pass12345'})
+
+        self.assertEqual(Cart.objects.get(user=self.user).items.get().quantity, 2)
+        self.assertFalse(Cart.objects.filter(user=None).exists())
+
+
+class CartResolutionTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.product = Product.objects.create(name='Lazy Tee', price=Decimal('300.00'), stock=10)
+
+    def cart_selects(self, ctx):
+        return [q['sql'] for q in ctx.captured_queries if q['sql'].startswith('SELECT') and 'FROM "store_cart"' in q['sql']]
+
+    def test_read_only_requests_create_nothing(self):
+        for name in ('store:cart_count', 'store:cart', 'store:get_cart_data_ajax', 'store:validate_cart_stock'):
+            response = self.client.get(reverse(name))
+            self.assertEqual(response.status_code, 200)
+            self.assertNotIn('sessionid', response.cookies)
+        self.assertFalse(Cart.objects.exists())
+
+    def test_cart_is_resolved_once_per_request_by_primary_key(self):
+        user = User.objects.create_user(username='lazy', password='pass12345')
+        self.client.force_login(user)
+        add = lambda: self.client.post(
+            reverse('store:add_to_cart_ajax'), json.dumps({'product_id': self.product.id}), content_type='application/json'
+        )
+        self.assertTrue(add().json()['success'])
+        cart = Cart.objects.get(user=user)
+        self.assertEqual(self.client.session['cart_id'], cart.id)
+
+        with CaptureQueriesContext(connection) as ctx:
+            data = add().json()
+        self.assertEqual(data['cart_total']['total_items'], 2)
+        selects = self.cart_selects(ctx)
+        self.assertEqual(len(selects), 1)
+        self.assertIn('"store_cart"."id" = %d' % cart.id, selects[0])
+
+
+class BatchCartUpdateTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='batcher', password='pass12345')
+        cls.small, cls.medium = Size.objects.create(code='S'), Size.objects.create(code='M')
+        cls.products = Product.objects.bulk_create([
+            Product(name=f'Batch Tee {i}', price=Decimal('100.00'), stock=5) for i in range(6)
+        ])
+        cls.products[0].sizes.set([cls.small, cls.medium])
+
+    def setUp(self):
+        self.client.force_login(self.user)
+        self.cart = Cart.objects.create(user=self.user)
+        CartItem.objects.bulk_create([
+            CartItem(cart=self.cart, product=self.products[0], size=self.small, quantity=1),
+            CartItem(cart=self.cart, product=self.products[1], quantity=2),
+            CartItem(cart=self.cart, product=self.products[2], quantity=3),
+        ])
+        self.cart.recalculate_totals()
+
+    def batch(self, operations):
+        return self.client.post(
+            reverse('store:batch_update_cart_ajax'), json.dumps({'operations': operations}),
+            content_type='application/json',
+        ).json()
+
+    def test_operations_apply_together(self):
+        tee, other, removed, fresh = self.products[:4]
+        data = self.batch([
+            {'product_id': tee.id, 'size': 'S', 'quantity': 2},
+            {'product_id': tee.id, 'size': 'M', 'quantity': 3},
+            {'product_id': other.id, 'quantity': 4},
+            {'product_id': removed.id, 'quantity': 0},
+            {'product_id': fresh.id, 'quantity': 1},
+        ])
+
+        self.assertTrue(data['success'], data)
+        lines = {
+            (item.product_id, item.size.code if item.size else None): item.quantity
+            for item in self.cart.items.select_related('size')
+        }
+        self.assertEqual(lines, {(tee.id, 'S'): 2, (tee.id, 'M'): 3, (other.id, None): 4, (fresh.id, None): 1})
+        self.assertEqual(data['cart_total']['total_items'], 10)
+        self.assertTrue(next(item for item in data['items'] if item['product_id'] == removed.id)['item_removed'])
+        self.cart.refresh_from_db()
+        self.assertEqual((self.cart.item_count, self.cart.total_quantity), (4, 10))
+        self.assertEqual(self.cart.total_price, Decimal('1000.00'))
+
+    def test_stock_counts_all_sizes_and_failures_change_nothing(self):
+        tee, other = self.products[:2]
+        data = self.batch([
+            {'product_id': other.id, 'quantity': 1},
+            {'product_id': tee.id, 'size': 'M', 'quantity': 5},
+        ])
+
+        self.assertFalse(data['success'])
+        self.assertIn('Insufficient stock', data['error'])
+        self.assertEqual(self.cart.items.get(product=other).quantity, 2)
+        self.assertFalse(self.cart.items.filter(size=self.medium).exists())
+
+    def test_sizes_are_validated(self):
+        self.assertIn('select a size', self.batch([{'product_id': self.products[0].id, 'quantity': 1}])['error'])
+        self.assertEqual(
+            self.batch([{'product_id': self.products[1].id, 'size': 'XXL', 'quantity': 1}])['error'], 'Invalid size selected'
+        )
+
+    def test_failed_batches_create_no_cart(self):
+        self.client.logout()
+        for operations in (
+            [{'product_id': 999999, 'quantity': 1}],
+            [{'product_id': self.products[1].id, 'quantity': 50}],
+        ):
+            self.assertFalse(self.batch(operations)['success'])
+        self.assertFalse(Cart.objects.filter(user=None).exists())
+
+    def test_malformed_operations_get_a_fixed_message(self):
+        response = self.client.post(
+            reverse('store:batch_update_cart_ajax'),
+            json.dumps({'operations': [{'product_id': 'abc', 'quantity': 1}]}),
+            content_type='application/json',
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['error'], 'Invalid operation data')
+
+    def test_queries_do_not_grow_with_the_batch(self):
+        def run(quantity, products):
+            with CaptureQueriesContext(connection) as ctx:
+                data = self.batch([{'product_id': p.id, 'quantity': quantity} for p in products])
+            self.assertTrue(data['success'], data)
+            return len(ctx.captured_queries)
+
+        self.client.get(reverse('store:cart_count'))  # remembers the cart id in the session
+        get_product_pages([p.id for p in self.products])  # allowed sizes come from cached product pages
+        # Each run updates existing lines and adds new ones
+        self.assertEqual(run(1, self.products[1:4]), run(2, self.products[1:]))
+
+
+class SizeRegistryTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.small = Size.objects.create(code='S')
+        cls.tee = Product.objects.create(name='Sized Tee', price=Decimal('250.00'), stock=10)
+        cls.tee.sizes.set([cls.small])
+
+    def setUp(self):
+        cache.clear()
+
+    def add(self, size):
+        return self.client.post(
+            reverse('store:add_to_cart_ajax'), json.dumps({'product_id': self.tee.id, 'size': size}),
+            content_type='application/json',
+        ).json()
+
+    def test_size_lookups_are_cached(self):
+        self.assertTrue(self.add('S')['success'])
+
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertTrue(self.add('S')['success'])
+        sqls = [q['sql'] for q in ctx.captured_queries]
+        self.assertFalse([sql for sql in sqls if 'store_size' in sql or 'store_product_sizes' in sql])
+
+    def test_size_and_product_changes_are_picked_up(self):
+        self.assertEqual(self.add('M')['error'], 'Invalid size selected')
+        medium = Size.objects.create(code='M')
+        self.assertEqual(self.add('M')['error'], 'Selected size is not available for this product')
+        self.tee.sizes.add(medium)
+        self.assertTrue(self.add('M')['success'])
+
+
+class CartMutationQueryTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='mutator', password='pass12345')
+        cls.product = Product.objects.create(name='Counted Tee', price=Decimal('150.00'), stock=10)
+
+    def setUp(self):
+        self.client.force_login(self.user)
+        self.post('store:add_to_cart_ajax', quantity=1)  # creates the cart, warms the caches
+
+    def post(self, name, **data):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.post(
+                reverse(name), json.dumps({'product_id': self.product.id, **data}), content_type='application/json'
+            ).json()
+        self.assertTrue(response['success'], response)
+        return [q['sql'] for q in ctx.captured_queries]
+
+    def check(self, sqls, queries):
+        # session, user, cart, locked product, cart line, line write, totals UPDATE,
+        # totals aggregate for the response, plus the savepoint pair
+        self.assertEqual(len(self.product_reads(sqls)), 1)
+        self.assertEqual(len(sqls), queries, '\n'.join(sqls))
+
+    def product_reads(self, sqls):
+        # Reads of the product row itself (directly or joined), not the totals aggregate
+        return [sql for sql in sqls if sql.startswith('SELECT') and '"store_product"."stock"' in sql]
+
+    def test_rejected_first_add_leaves_nothing_behind(self):
+        self.client.logout()
+        response = self.client.post(
+            reverse('store:add_to_cart_ajax'), json.dumps({'product_id': self.product.id, 'quantity': 50}),
+            content_type='application/json',
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('Insufficient stock', response.json()['error'])
+        self.assertFalse(Cart.objects.filter(user=None).exists())
+
+    def test_add_reads_the_product_once(self):
+        self.check(self.post('store:add_to_cart_ajax', quantity=2), 10)
+
+    def test_update_reads_the_product_once(self):
+        self.check(self.post('store:update_cart_ajax', quantity=4), 10)
+
+    def test_remove_reads_the_product_once(self):
+        # The locked cart line read brings its product along
+        self.check(self.post('store:remove_from_cart_ajax'), 9)
+        self.assertFalse(CartItem.objects.exists())
@@ -37,10 +37,13 @@ urlpatterns = [
     path('category/<int:category_id>/', views.category_page, name='category_page'),
     path('product/<int:product_id>/', views.product_detail, name='product_detail'),
     path('all-products/', views.all_products, name='all_products'),
+    path('search/', views.search, name='search'),
+    path('search/suggest/', views.search_suggest, name='search_suggest'),
     path('cart/', cart_views.cart_page, name='cart'),
     # Cart AJAX endpoints
     path('cart/add/', cart_views.add_to_cart_ajax, name='add_to_cart_ajax'),
     path('cart/update/', cart_views.update_cart_ajax, name='update_cart_ajax'),
+    path('cart/batch/', cart_views.batch_update_cart_ajax, name='batch_update_cart_ajax'),
     path('cart/remove/', cart_views.remove_from_cart_ajax, name='remove_from_cart_ajax'),
     path('cart/data/', cart_views.get_cart_data_ajax, name='get_cart_data_ajax'),
     path('cart/clear/', cart_views.clear_cart_ajax, name='clear_cart_ajax'),
@@ -48,6 +51,8 @@ urlpatterns = [
     path('cart/validate-stock/', cart_views.validate_cart_stock, name='validate_cart_stock'),
     path('checkout/', views.checkout, name='checkout'),
     path('wallet/', views.wallet_view, name='wallet'),
+    path('wallet/statement/', views.wallet_statement, name='wallet_statement'),
+    path('wallet/summary/', views.wallet_summary, name='wallet_summary'),
     path('return-order/<int:order_id>/', views.return_order, name='return_order'),
     path('track-order/<int:order_id>/', views.track_order, name='track_order'),
     path('order-detail/<int:order_id>/', views.order_detail, name='order_detail'),
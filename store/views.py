@@ -2,65 +2,82 @@ from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth.decorators import user_passes_test, login_required
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib import messages
-from .models import Product, CustomizationRequest, Category, PersonalizationRequest, Order, OrderItem, Wallet, WalletTransaction, UPIPaymentMethod, UserAddress, ReturnRequest, Size
-from .cart_utils import get_cart_items, get_cart_total, clear_cart, calculate_delivery_charges
+from .models import Product, CustomizationRequest, Category, PersonalizationRequest, Order, Wallet, WalletTransaction, UPIPaymentMethod, UserAddress, ReturnRequest, Size
+from .cart_utils import calculate_delivery_charges, sync_personalization_cart_totals, CartSnapshot
 from django import forms
+from django.db import IntegrityError, transaction
+from django.db.models import Q
 from django.template.loader import render_to_string
-from django.http import JsonResponse
+from django.http import Http404, JsonResponse
+from django.urls import reverse
 from django.utils import timezone
 from datetime import timedelta
 from decimal import Decimal
 from django.core.files.storage import default_storage
 from django.core.files.base import ContentFile
 from accounts.email_utils import send_order_confirmation_email, send_personalization_update_email
+from .catalog import get_catalog_version
+from .category_tree import get_category_tree
+from .facets import apply_filters, get_facet_counts, has_active_filters, parse_filters
+from .listing import iter_product_rows
+from .orders import DuplicateOrder, InsufficientStock, find_order_by_key, place_order
+from .product_pages import get_product_page, get_product_pages
+from .search import search_products
+from .sizes import get_size
 import json
+import uuid
 
 # Create your views here.
 
+# Home page fragments are keyed by the catalog version, so this is only an upper bound
+HOME_FRAGMENT_CACHE_TIMEOUT = 60 * 60 * 24
+
+FANDOM_PARENT_NAME = 'Fandom & Superhero Edition'
+
 def home(request):
-    # Get products and top-level categories (parent is null)
-    products = Product.objects.all()
+    # Everything below is lazy: the querysets only run when a cached fragment
+    # for the current catalog version is missing and has to be re-rendered
+    products = Product.objects.select_related('category')
 
     # Dynamic Fandom section: children of a parent category named "Fandom & Superhero Edition"
-    fandom_parent = Category.objects.filter(name__iexact='Fandom & Superhero Edition').first()
+    fandoms = Category.objects.filter(parent__name__iexact=FANDOM_PARENT_NAME)
 
     # Top-level categories for the grid, EXCLUDING the fandom parent so it only appears in the fandom section
-    if fandom_parent:
-        categories = Category.objects.filter(parent__isnull=True).exclude(id=fandom_parent.id).select_related()
-    else:
-        categories = Category.objects.filter(parent__isnull=True).select_related()
-
-    # Featured products (show at least 20 products if available)
-    featured_products = products[:20]  # Show up to 20 products
-    has_more_products = products.count() > 20
-
-    fandoms = fandom_parent.children.all() if fandom_parent else []
+    categories = Category.objects.filter(parent__isnull=True).exclude(name__iexact=FANDOM_PARENT_NAME)
 
     return render(request, 'store/home.html', {
-        'featured_products': featured_products,
+        # Featured products (show at least 20 products if available)
+        'featured_products': products[:20],
         'categories': categories,
         'fandoms': fandoms,
-        'fandom_parent': fandom_parent,
-        'has_more_products': has_more_products,
+        # Truthy when a 21st product exists; fetches at most one row
+        'has_more_products': products.order_by('id')[20:21],
+        'catalog_version': get_catalog_version(),
+        'fragment_cache_timeout': HOME_FRAGMENT_CACHE_TIMEOUT,
     })
 
 from django.shortcuts import get_object_or_404
 
 def category_page(request, category_id):
     category = get_object_or_404(Category, id=category_id)
-    products = Product.objects.filter(category=category).prefetch_related('sizes')
-
-    # Create a list of products with their available sizes
-    products_with_sizes = []
-    for product in products:
-        products_with_sizes.append({
-            'product': product,
-            'available_sizes': list(product.sizes.all())
-        })
+    tree = get_category_tree()
+    # Products of the category and all of its subcategories in one query
+    products = Product.objects.filter(
+        category_id__in=tree.descendant_ids(category.id, include_self=True)
+    )
+    facets = get_facet_counts(f'category:{category.id}', products)
+    filters = parse_filters(request)
+    # One query for product columns and their size codes, no model instances
+    product_rows = list(iter_product_rows(apply_filters(products, filters)))
 
     return render(request, 'store/category_page.html', {
         'category': category,
-        'products_with_sizes': products_with_sizes
+        'breadcrumb': tree.breadcrumb(category.id),
+        'subcategories': tree.children(category.id),
+        'product_rows': product_rows,
+        'facets': facets,
+        'filters': filters,
+        'filters_active': has_active_filters(filters),
     })
 
 def plain_shirt(request):
@@ -180,10 +197,16 @@ def personalize_category_products(request, category_name):
             can_customize=True,
             category__name__iexact=category_name
         ).select_related('category')
+
+    facets = get_facet_counts(f'personalize:{category_name}', products)
+    filters = parse_filters(request)
     
     return render(request, 'store/personalize_category_products.html', {
         'category_name': category_name,
-        'products': products
+        'products': apply_filters(products, filters),
+        'facets': facets,
+        'filters': filters,
+        'filters_active': has_active_filters(filters),
     })
 
 class PersonalizationRequestForm(forms.ModelForm):
@@ -195,7 +218,7 @@ class PersonalizationRequestForm(forms.ModelForm):
 def personalize_product(request, product_id):
     """Personalization form for specific product"""
     product = get_object_or_404(Product, id=product_id)
-    available_sizes = list(product.sizes.all())
+    available_sizes = get_product_page(product.id)['sizes']
     
     if request.method == 'POST':
         form = PersonalizationRequestForm(request.POST, request.FILES)
@@ -207,11 +230,9 @@ def personalize_product(request, product_id):
             # Persist selected size if provided
             selected_size_code = request.POST.get('selected_size')
             if selected_size_code:
-                try:
-                    size_obj = Size.objects.get(code=selected_size_code)
+                size_obj = get_size(selected_size_code)
+                if size_obj is not None:
                     personalization.size = size_obj
-                except Size.DoesNotExist:
-                    pass
 
             personalization.save()
             return redirect('store:cart')
@@ -272,14 +293,17 @@ def admin_accept_order(request):
             
             # Add item to the user's cart directly
             from .models import Cart, CartItem
-            cart, _ = Cart.objects.get_or_create(user=personalization.user)
-            item, created = CartItem.objects.get_or_create(cart=cart, product=personalization.product, defaults={'quantity': 1})
-            if not created:
-                item.quantity += 1
-                item.save()
-            
-            personalization.status = 'order_accepted'
-            personalization.save()
+            with transaction.atomic():
+                cart, _ = Cart.objects.get_or_create(user=personalization.user)
+                item, created = CartItem.objects.get_or_create(cart=cart, product=personalization.product, defaults={'quantity': 1})
+                if not created:
+                    item.quantity += 1
+                    item.save()
+                cart.adjust_totals(lines=1 if created else 0, quantity=1, price=personalization.product.price)
+                
+                personalization.status = 'order_accepted'
+                personalization.save()
+                sync_personalization_cart_totals(personalization, 0)
             
             return JsonResponse({'success': True, 'message': 'Order accepted and item added to user\'s cart.'})
         except Exception as e:
@@ -298,9 +322,11 @@ def approve_personalization(request):
             
             if personalization.status == 'admin_approved' and personalization.admin_final_image:
                 # Mark as order accepted (ready for cart) and set initial quantity
-                personalization.status = 'order_accepted'
-                personalization.cart_quantity = 1
-                personalization.save()
+                with transaction.atomic():
+                    personalization.status = 'order_accepted'
+                    personalization.cart_quantity = 1
+                    personalization.save()
+                    sync_personalization_cart_totals(personalization, 0)
                 
                 # Send email notification about personalization status
                 if personalization.user.email:
@@ -368,8 +394,11 @@ def admin_reject_personalization(request):
             request_id = data.get('request_id')
             
             personalization = get_object_or_404(PersonalizationRequest, id=request_id)
-            personalization.status = 'rejected'
-            personalization.save()
+            with transaction.atomic():
+                old_quantity = personalization.cart_quantity if personalization.status == 'order_accepted' else 0
+                personalization.status = 'rejected'
+                personalization.save()
+                sync_personalization_cart_totals(personalization, old_quantity)
             
             # Send email notification about rejection
             if personalization.user.email:
@@ -415,15 +444,22 @@ def regional_preference(request):
     return render(request, 'store/category_page.html', {'category': 'Regional Preference'})
 
 def product_detail(request, product_id):
-    product = get_object_or_404(Product, id=product_id)
-    
-    # Get related products from the same category (excluding current product)
-    related_products = Product.objects.filter(category=product.category).exclude(id=product_id)[:4]
-    available_sizes = list(product.sizes.all())
+    # Live stock is the only query on a warm cache; the rest comes from the cached page
+    stock = Product.objects.filter(id=product_id).values_list('stock', flat=True).first()
+    page = get_product_page(product_id) if stock is not None else None
+    if page is None:
+        raise Http404('No Product matches the given query.')
+
+    product = page['product']
+    product.stock = stock
+    related_pages = get_product_pages(page['related_ids'])
+    related_products = [
+        related_pages[related_id]['product'] for related_id in page['related_ids'] if related_id in related_pages
+    ]
     return render(request, 'store/product_detail.html', {
         'product': product,
         'related_products': related_products,
-        'available_sizes': available_sizes,
+        'available_sizes': page['sizes'],
     })
 
 def cart(request):
@@ -437,7 +473,66 @@ def wallet_view(request):
     
     return render(request, 'store/wallet.html', {
         'wallet': wallet,
-        'transactions': transactions
+        'transactions': transactions,
+        'monthly_summaries': wallet.monthly_summaries.all()[:WALLET_SUMMARY_MONTHS],
+    })
+
+
+WALLET_STATEMENT_PAGE_SIZE = 50
+WALLET_SUMMARY_MONTHS = 6
+
+@login_required
+def wallet_statement(request):
+    """Wallet ledger as JSON, newest first, with keyset (cursor) pagination.
+
+    ?cursor=<id> continues after the last entry of the previous page; rows
+    come from the (wallet, created_at, id) index, so deep pages cost the same
+    as the first.
+    """
+    wallet, created = Wallet.objects.get_or_create(user=request.user)
+    entries = wallet.transactions.order_by('-created_at', '-id')
+    cursor = request.GET.get('cursor', '')
+    if cursor.isdigit():
+        last = wallet.transactions.filter(id=int(cursor)).values_list('created_at', 'id').first()
+        if last is None:
+            return JsonResponse({'success': False, 'error': 'Invalid cursor'}, status=400)
+        entries = entries.filter(Q(created_at__lt=last[0]) | Q(created_at=last[0], id__lt=last[1]))
+
+    # Fetch one extra row to know whether another page exists
+    page = list(entries.values(
+        'id', 'transaction_type', 'amount', 'description', 'balance_after', 'created_at'
+    )[:WALLET_STATEMENT_PAGE_SIZE + 1])
+    has_more = len(page) > WALLET_STATEMENT_PAGE_SIZE
+    page = page[:WALLET_STATEMENT_PAGE_SIZE]
+    return JsonResponse({
+        'success': True,
+        'balance': str(wallet.balance),
+        'transactions': [
+            dict(entry, amount=str(entry['amount']), balance_after=str(entry['balance_after']))
+            for entry in page
+        ],
+        'next_cursor': page[-1]['id'] if has_more else None,
+        'has_more': has_more,
+    })
+
+@login_required
+def wallet_summary(request):
+    """Monthly credit/debit totals from the precomputed rollups (?months=<n>, default 12)"""
+    months = request.GET.get('months', '')
+    months = min(int(months), 120) if months.isdigit() and int(months) > 0 else 12
+    wallet, created = Wallet.objects.get_or_create(user=request.user)
+    return JsonResponse({
+        'success': True,
+        'months': [
+            {
+                'month': summary.month.strftime('%Y-%m'),
+                'credits': str(summary.credit_total),
+                'debits': str(summary.debit_total),
+                'net': str(summary.net),
+                'transactions': summary.transaction_count,
+            }
+            for summary in wallet.monthly_summaries.all()[:months]
+        ],
     })
 
 
@@ -483,20 +578,77 @@ def track_order(request, order_id):
     })
 
 
+# Products per page on the all-products listing
+ALL_PRODUCTS_PAGE_SIZE = 24
+
 def all_products(request):
-    products = Product.objects.all().order_by('-id')
-    
-    return render(request, 'store/all_products.html', {
-        'products': products,
-    })
+    """Display all products newest first with keyset (cursor) pagination.
+
+    ?cursor=<id> continues after the last product id of the previous page, so
+    deep pages cost the same as the first. ?format=json returns the rendered
+    cards and the next cursor for infinite scroll.
+    """
+    products = Product.objects.select_related('category').order_by('-id')
+    cursor = request.GET.get('cursor', '')
+    if cursor.isdigit():
+        products = products.filter(id__lt=int(cursor))
 
+    # Fetch one extra row to know whether another page exists
+    page = list(products[:ALL_PRODUCTS_PAGE_SIZE + 1])
+    has_more = len(page) > ALL_PRODUCTS_PAGE_SIZE
+    page = page[:ALL_PRODUCTS_PAGE_SIZE]
+    next_cursor = page[-1].id if has_more else None
 
+    if request.GET.get('format') == 'json':
+        html = render_to_string('store/_product_cards.html', {'products': page}, request=request)
+        return JsonResponse({'html': html, 'next_cursor': next_cursor, 'has_more': has_more})
 
-    """Display all products with pagination"""
-    products = Product.objects.all().order_by('-id')
-    
     return render(request, 'store/all_products.html', {
-        'products': products,
+        'products': page,
+        'next_cursor': next_cursor,
+    })
+
+SEARCH_PAGE_SIZE = 24
+SEARCH_SUGGEST_LIMIT = 8
+
+def search(request):
+    """Storefront product search ranked by the full-text index (?q=<terms>&page=<n>)"""
+    query = request.GET.get('q', '').strip()
+    page_number = request.GET.get('page', '')
+    page_number = int(page_number) if page_number.isdigit() and int(page_number) > 0 else 1
+
+    # Fetch one extra row to know whether another page exists
+    products = search_products(
+        query,
+        limit=SEARCH_PAGE_SIZE + 1,
+        offset=(page_number - 1) * SEARCH_PAGE_SIZE,
+        prefix=True,
+    ) if query else []
+    has_more = len(products) > SEARCH_PAGE_SIZE
+
+    return render(request, 'store/search.html', {
+        'query': query,
+        'products': products[:SEARCH_PAGE_SIZE],
+        'page_number': page_number,
+        'next_page': page_number + 1 if has_more else None,
+        'previous_page': page_number - 1 if page_number > 1 else None,
+    })
+
+def search_suggest(request):
+    """Typeahead suggestions: the last term matches as a prefix"""
+    products = search_products(request.GET.get('q', ''), limit=SEARCH_SUGGEST_LIMIT, prefix=True)
+    return JsonResponse({
+        'success': True,
+        'results': [
+            {
+                'id': product.id,
+                'name': product.name,
+                'category': product.category.name if product.category else '',
+                'price': float(product.price),
+                'url': reverse('store:product_detail', args=[product.id]),
+            }
+            for product in products
+        ],
     })
 
 @login_required
@@ -505,34 +657,26 @@ def checkout(request):
     - Validates stock for all items (cart items only - personalized items are now added directly to cart)
     - Creates Order and OrderItems, reduces stock, clears cart
     - Sets delivery_date = today + 5 days (static for now)
+    - The form carries an idempotency key; a repeated POST (double click, retry)
+      shows the order it already placed without writing anything again
     """
+    idempotency_key = request.POST.get('idempotency_key', '')[:64] if request.method == 'POST' else ''
+    if idempotency_key:
+        existing_order = find_order_by_key(idempotency_key, request.user)
+        if existing_order:
+            return render(request, 'store/order_success.html', {'order': existing_order})
+    # Reused when the form is shown again after an error, since no order was placed
+    idempotency_key = idempotency_key or uuid.uuid4().hex
+
     errors = []
     out_of_stock = []
 
-    # Gather items from cart (includes both regular and personalized items)
-    cart_items = get_cart_items(request)
-    cart_total = get_cart_total(request)
-    
-    # Add personalized items to cart totals (same logic as cart_page)
-    personalization_cart_total = Decimal('0.00')
-    personalization_requests = []
-    if request.user.is_authenticated:
-        personalization_requests = PersonalizationRequest.objects.filter(
-            user=request.user,
-            status__in=['pending', 'admin_approved', 'user_approved', 'order_accepted']
-        ).select_related('product').order_by('-created_at')
-        
-        # Calculate total for personalized items in cart
-        for req in personalization_requests:
-            if req.is_in_cart:
-                personalization_cart_total += req.cart_total_price
-    
-    # Calculate combined totals (including personalized items)
-    combined_cart_total = {
-        'total_price': cart_total['total_price'] + personalization_cart_total,
-        'total_items': cart_total['total_items'] + sum(req.cart_quantity for req in personalization_requests if req.is_in_cart),
-        'item_count': cart_total['item_count'] + sum(1 for req in personalization_requests if req.is_in_cart)
-    }
+    # Gather cart lines and personalized items in the cart (same snapshot as cart_page)
+    # Placing an order needs a cart row; showing the form does not
+    snapshot = CartSnapshot.for_request(request, create=request.method == 'POST')
+    cart_items = snapshot.items
+    personalization_cart_total = snapshot.personalization_total
+    combined_cart_total = snapshot.total
 
     # Get active UPI payment methods
     upi_payment_methods = UPIPaymentMethod.objects.filter(is_active=True).order_by('display_order')
@@ -551,21 +695,31 @@ def checkout(request):
         default_address = saved_addresses.filter(is_default=True).first()
     
     # Get personalization requests that are NOT in cart (only show pending personalized items)
-    personalization_items = []
-    personalization_total = Decimal('0.00')
-    if request.user.is_authenticated:
-        # Get cart items to exclude personalized items already in cart
-        cart_product_ids = [item.product.id for item in cart_items]
-        personalization_items = list(
-            PersonalizationRequest.objects.filter(
-                user=request.user,
-                status='admin_approved'  # Only show admin approved but not yet added to cart
-            ).exclude(
-                product_id__in=cart_product_ids  # Exclude items already in cart
-            ).select_related('product')
-        )
-        # Calculate personalization items total
-        personalization_total = sum(item.product.price for item in personalization_items)
+    # Only admin approved but not yet added to cart, excluding products already in cart
+    cart_product_ids = {item.product_id for item in cart_items}
+    personalization_items = [
+        req for req in snapshot.personalization_requests
+        if req.status == 'admin_approved' and req.product_id not in cart_product_ids
+    ]
+    # Calculate personalization items total
+    personalization_total = sum((item.product.price for item in personalization_items), Decimal('0.00'))
+
+    # All cart items are shown as regular items in the order summary; personalized
+    # items only show in the "Available for Approval" section
+    context = {
+        'cart_items': cart_items,
+        'regular_cart_items': cart_items,
+        'personalized_cart_items': [],
+        'personalization_items': personalization_items,
+        'personalization_total': personalization_total,
+        'cart_total': combined_cart_total,  # Use combined totals
+        'delivery_info': snapshot.delivery_info,
+        'upi_payment_methods': upi_payment_methods,
+        'user_wallet': user_wallet,
+        'saved_addresses': saved_addresses,
+        'default_address': default_address,
+        'idempotency_key': idempotency_key,
+    }
 
     if request.method == 'POST':
         # Read address + payment
@@ -580,6 +734,16 @@ def checkout(request):
         upi_provider = request.POST.get('upi_provider', '')
         use_wallet = request.POST.get('use_wallet') == 'on'
         wallet_amount = Decimal(request.POST.get('wallet_amount', '0.00') or '0.00')
+        form_data = {
+            'full_name': full_name,
+            'address_line1': address_line1,
+            'address_line2': address_line2,
+            'city': city,
+            'state': state,
+            'postal_code': postal_code,
+            'phone': phone,
+            'payment_method': payment_method,
+        }
 
         # Basic validation
         required_fields = [full_name, address_line1, city, state, postal_code, phone]
@@ -632,49 +796,57 @@ def checkout(request):
             errors.append('Some items are out of stock. Please remove them or try later:')
 
         if errors:
-            return render(request, 'store/checkout.html', {
-                'cart_items': cart_items,
-                'personalization_items': personalization_items,
-                'personalization_total': personalization_total,
-                'cart_total': combined_cart_total,  # Use combined totals
-                'upi_payment_methods': upi_payment_methods,
-                'user_wallet': user_wallet,
-                'errors': errors,
-                'out_of_stock': out_of_stock,
-                'form': {
-                    'full_name': full_name,
-                    'address_line1': address_line1,
-                    'address_line2': address_line2,
-                    'city': city,
-                    'state': state,
-                    'postal_code': postal_code,
-                    'phone': phone,
-                    'payment_method': payment_method,
-                }
-            })
+            return _render_checkout(request, context, form_data, errors, out_of_stock)
 
         # Determine initial order status based on payment method
         initial_status = 'pending' if payment_method == 'upi' else 'processing'
-        
-        # Create order
-        order = Order.objects.create(
-            user=request.user if request.user.is_authenticated else None,
-            session_key=None if request.user.is_authenticated else getattr(request, 'session', None) and request.session.session_key,
-            full_name=full_name,
-            address_line1=address_line1,
-            address_line2=address_line2 or '',
-            city=city,
-            state=state,
-            postal_code=postal_code,
-            phone=phone,
-            payment_method=final_payment_method,
-            upi_provider=upi_provider if payment_method == 'upi' else None,
-            total_amount=total_amount,
-            wallet_amount_used=wallet_amount_to_use,
-            remaining_amount=remaining_amount,
-            delivery_date=timezone.now().date() + timedelta(days=5),
-            status=initial_status,
-        )
+
+        # Order, order items, stock, personalizations, wallet and cart in one transaction
+        try:
+            order = place_order(
+                snapshot.cart,
+                cart_items,
+                personalized_items=snapshot.personalized_items if request.user.is_authenticated else (),
+                wallet=user_wallet,
+                wallet_amount=wallet_amount_to_use,
+                user=request.user if request.user.is_authenticated else None,
+                session_key=None if request.user.is_authenticated else getattr(request, 'session', None) and request.session.session_key,
+                full_name=full_name,
+                address_line1=address_line1,
+                address_line2=address_line2 or '',
+                city=city,
+                state=state,
+                postal_code=postal_code,
+                phone=phone,
+                payment_method=final_payment_method,
+                upi_provider=upi_provider if payment_method == 'upi' else None,
+                total_amount=total_amount,
+                wallet_amount_used=wallet_amount_to_use,
+                remaining_amount=remaining_amount,
+                delivery_date=timezone.now().date() + timedelta(days=5),
+                status=initial_status,
+                idempotency_key=idempotency_key,
+            )
+        except DuplicateOrder as exc:
+            # A concurrent submission with the same key placed the order first
+            return render(request, 'store/order_success.html', {'order': exc.order})
+        except InsufficientStock as exc:
+            # Stock was taken by another order after the check above
+            errors.append('Some items are out of stock. Please remove them or try later:')
+            out_of_stock = [
+                f"{shortfall.product_name} (need {shortfall.requested}, have {shortfall.available})"
+                for shortfall in exc.shortfalls
+            ]
+        except ValueError as exc:
+            # Wallet balance changed since it was validated
+            errors.append(str(exc))
+        except IntegrityError:
+            # The key is held by another user's order; resubmit under a fresh one
+            errors.append('Your checkout session has expired. Please review your order and submit it again.')
+            context['idempotency_key'] = uuid.uuid4().hex
+
+        if errors:
+            return _render_checkout(request, context, form_data, errors, out_of_stock)
         
         # Save address for authenticated users
         if request.user.is_authenticated:
@@ -704,55 +876,6 @@ def checkout(request):
                     is_default=not UserAddress.objects.filter(user=request.user).exists()  # Set as default if it's the first address
                 )
 
-        # Create order items and reduce stock (only cart items)
-        for item in cart_items:
-            OrderItem.objects.create(
-                order=order,
-                product=item.product,
-                product_name=item.product.name,
-                unit_price=item.product.price,
-                quantity=item.quantity,
-                line_total=item.total_price,
-                size=item.size,
-            )
-            # reduce stock
-            item.product.stock = max(0, item.product.stock - item.quantity)
-            item.product.save(update_fields=['stock'])
-        
-        # Create order items for personalized items in cart
-        if request.user.is_authenticated:
-            personalized_items_in_cart = PersonalizationRequest.objects.filter(
-                user=request.user,
-                status='order_accepted',
-                cart_quantity__gt=0
-            )
-            for req in personalized_items_in_cart:
-                OrderItem.objects.create(
-                    order=order,
-                    product=req.product,
-                    product_name=req.product.name,
-                    unit_price=req.product.price,
-                    quantity=req.cart_quantity,
-                    line_total=req.cart_total_price,
-                    size=req.size,
-                )
-                # reduce stock
-                req.product.stock = max(0, req.product.stock - req.cart_quantity)
-                req.product.save(update_fields=['stock'])
-                # Reset cart quantity after order creation
-                req.cart_quantity = 0
-                req.save(update_fields=['cart_quantity'])
-            
-        # Process wallet payment if used
-        if wallet_amount_to_use > 0 and user_wallet:
-            user_wallet.deduct_money(
-                wallet_amount_to_use,
-                f"Payment for Order #{order.id}"
-            )
-
-        # Clear cart
-        clear_cart(request)
-        
         # Send order confirmation email
         if order.user and order.user.email:
             send_order_confirmation_email(order)
@@ -760,36 +883,16 @@ def checkout(request):
         return render(request, 'store/order_success.html', {'order': order})
 
     # GET: show checkout form and summary
-    # Separate regular and personalized items in cart for display
-    regular_cart_items = []
-    personalized_cart_items = []
-    
-    if request.user.is_authenticated:
-        # For now, let's simplify this:
-        # Since we don't have a direct link between cart items and personalization requests,
-        # and the issue is that products added normally are showing as personalized,
-        # let's treat ALL cart items as regular items for the order summary
-        # The personalized items will only show in the "Available for Approval" section
-        regular_cart_items = cart_items
-        personalized_cart_items = []  # Keep empty for now to fix the immediate issue
-    else:
-        # For guest users, all items are regular
-        regular_cart_items = cart_items
-    
-    # Calculate delivery charges for display
-    delivery_info = calculate_delivery_charges(combined_cart_total['total_price'])
-    
+    return _render_checkout(request, context)
+
+
+def _render_checkout(request, context, form_data=None, errors=(), out_of_stock=()):
+    """Render the checkout page; a rejected submission passes back its form data and errors"""
     return render(request, 'store/checkout.html', {
-        'cart_items': cart_items,
-        'regular_cart_items': regular_cart_items,
-        'personalized_cart_items': personalized_cart_items,
-        'personalization_items': personalization_items,
-        'cart_total': combined_cart_total,  # Use combined totals
-        'delivery_info': delivery_info,
-        'upi_payment_methods': upi_payment_methods,
-        'user_wallet': user_wallet,
-        'saved_addresses': saved_addresses,
-        'default_address': default_address,
+        **context,
+        'form': form_data,
+        'errors': errors,
+        'out_of_stock': out_of_stock,
     })
 
 class ProductForm(forms.ModelForm):
@@ -802,10 +905,8 @@ class ProductForm(forms.ModelForm):
         # Order categories and display hierarchical labels like "Parent › Child"
         self.fields['category'].queryset = Category.objects.all().order_by('parent__name', 'name')
 
-        def make_label(cat: Category):
-            return f"{cat.parent.name} › {cat.name}" if cat.parent else cat.name
-
-        self.fields['category'].label_from_instance = make_label
+        tree = get_category_tree()
+        self.fields['category'].label_from_instance = lambda cat: tree.label(cat.id)
         if 'sizes' in self.fields:
             self.fields['sizes'].queryset = Size.objects.all().order_by('display_order', 'code')
 
@@ -904,7 +1005,9 @@ def update_personalization_cart_quantity(request):
             request_id = data.get('request_id')
             quantity = int(data.get('quantity', 0))
             
-            personalization = get_object_or_404(PersonalizationRequest, id=request_id, user=request.user)
+            personalization = get_object_or_404(
+                PersonalizationRequest.objects.select_related('product'), id=request_id, user=request.user
+            )
             
             if personalization.status != 'order_accepted':
                 return JsonResponse({'success': False, 'error': 'Item not in cart'})
@@ -919,35 +1022,14 @@ def update_personalization_cart_quantity(request):
                     'error': f'Insufficient stock. Available: {personalization.product.stock}'
                 })
             
-            personalization.cart_quantity = quantity
-            personalization.save()
+            with transaction.atomic():
+                old_quantity = personalization.cart_quantity
+                personalization.cart_quantity = quantity
+                personalization.save()
+                sync_personalization_cart_totals(personalization, old_quantity)
             
             # Calculate combined cart totals
-            from .cart_utils import get_cart_total
-            cart_total = get_cart_total(request)
-            
-            # Add personalized items to cart totals
-            personalized_total = Decimal('0.00')
-            personalized_count = 0
-            if request.user.is_authenticated:
-                personalized_requests = PersonalizationRequest.objects.filter(
-                    user=request.user,
-                    status='order_accepted',
-                    cart_quantity__gt=0
-                )
-                for req in personalized_requests:
-                    personalized_total += req.cart_total_price
-                    personalized_count += req.cart_quantity
-            
-            combined_cart_total = {
-                'total_price': float(cart_total['total_price'] + personalized_total),
-                'total_items': cart_total['total_items'] + personalized_count,
-                'item_count': cart_total['item_count'] + len([req for req in PersonalizationRequest.objects.filter(
-                    user=request.user,
-                    status='order_accepted',
-                    cart_quantity__gt=0
-                ) if request.user.is_authenticated])
-            }
+            combined_cart_total = CartSnapshot.for_request(request).as_json()
             
             return JsonResponse({
                 'success': True,
@@ -971,41 +1053,22 @@ def remove_personalization_from_cart(request):
             data = json.loads(request.body)
             request_id = data.get('request_id')
             
-            personalization = get_object_or_404(PersonalizationRequest, id=request_id, user=request.user)
+            personalization = get_object_or_404(
+                PersonalizationRequest.objects.select_related('product'), id=request_id, user=request.user
+            )
             
             if personalization.status != 'order_accepted':
                 return JsonResponse({'success': False, 'error': 'Item not in cart'})
             
             # Set quantity to 0 to remove from cart but keep the personalization request
-            personalization.cart_quantity = 0
-            personalization.save()
+            with transaction.atomic():
+                old_quantity = personalization.cart_quantity
+                personalization.cart_quantity = 0
+                personalization.save()
+                sync_personalization_cart_totals(personalization, old_quantity)
             
             # Calculate combined cart totals
-            from .cart_utils import get_cart_total
-            cart_total = get_cart_total(request)
-            
-            # Add personalized items to cart totals
-            personalized_total = Decimal('0.00')
-            personalized_count = 0
-            if request.user.is_authenticated:
-                personalized_requests = PersonalizationRequest.objects.filter(
-                    user=request.user,
-                    status='order_accepted',
-                    cart_quantity__gt=0
-                )
-                for req in personalized_requests:
-                    personalized_total += req.cart_total_price
-                    personalized_count += req.cart_quantity
-            
-            combined_cart_total = {
-                'total_price': float(cart_total['total_price'] + personalized_total),
-                'total_items': cart_total['total_items'] + personalized_count,
-                'item_count': cart_total['item_count'] + len([req for req in PersonalizationRequest.objects.filter(
-                    user=request.user,
-                    status='order_accepted',
-                    cart_quantity__gt=0
-                ) if request.user.is_authenticated])
-            }
+            combined_cart_total = CartSnapshot.for_request(request).as_json()
             
             return JsonResponse({
                 'success': True,